@@ -0,0 +1,28 @@
+######################################################################################################################
+#  Helpers shared by the benchmarks                                                                                  #
+######################################################################################################################
+
+import importlib.util
+import os
+import sys
+
+codeDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+
+# Function to load code/ec2rds-scheduler.py, which can't be imported by name because of the dash
+def load_scheduler():
+    
+    # Modules next to the handler are importable like in the Lambda runtime
+    if codeDir not in sys.path:
+        sys.path.insert(0, codeDir)
+        
+    spec = importlib.util.spec_from_file_location('ec2rds_scheduler', os.path.join(codeDir, 'ec2rds-scheduler.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Function to set dummy credentials and a region, so no benchmark ever talks to AWS
+def offline_environment():
+    
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
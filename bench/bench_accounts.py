@@ -0,0 +1,64 @@
+######################################################################################################################
+#  Benchmark: fan-out over accounts, the handler in run mode against stubbed STS, EC2, ASG, RDS and CloudWatch       #
+#  responses of several accounts, sequential (one worker) compared to the concurrent pool, and the size of the EMF   #
+#  record of the run, which must fit in a CloudWatch Logs event                                                      #
+#                                                                                                                    #
+#  Usage: python bench/bench_accounts.py [accounts] [EC2 instances per account] [regions] [workers] [latency]        #
+######################################################################################################################
+
+import contextlib
+import io
+import sys
+import time
+
+import boto3
+
+from _scheduler import load_scheduler, offline_environment
+from bench_suite import bench_event
+from fakeaws import FakeAWS
+from fleetgen import generate_accounts
+
+# Largest CloudWatch Logs event, the EMF record of a run is one event
+maxEventBytes = 256 * 1024
+
+# Function to run the handler against a fresh copy of the fleet, returns the duration, the API calls and the size of the
+# EMF record
+def bench_run(scheduler, snapshot, event, latency):
+    
+    fake = FakeAWS(snapshot, latency)
+    scheduler.clientSession = fake.attach(boto3.session.Session())
+    scheduler.clients.clear()
+    scheduler.accountCredentials.clear()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        started = time.time()
+        scheduler.lambda_handler(event, None)
+        duration = time.time() - started
+    scheduler.clients.clear()
+    scheduler.clientSession = None
+    records = [line for line in output.getvalue().split('\n') if line.startswith('{') and '"_aws"' in line]
+    return duration, fake.calls, max(len(r.encode()) for r in records)
+
+def main():
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    ec2Count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    regions = sys.argv[3].split(',') if len(sys.argv) > 3 else ['eu-west-1', 'us-east-1']
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+    latency = float(sys.argv[5]) if len(sys.argv) > 5 else 0.02
+    
+    snapshot = generate_accounts(accounts, ec2Count, ec2Count // 10, regions)
+    accountList = ','.join(['self'] + sorted(snapshot['Accounts']))
+    
+    print ('%d accounts x %d regions, %d EC2 instances per account, %.0fms per API call' % (accounts, len(regions), ec2Count, latency * 1000))
+    print ('%-10s %12s %12s %12s %12s' % ('workers', 'seconds', 'API calls', 'AssumeRole', 'EMF bytes'))
+    for n in (1, workers):
+        event = bench_event(regions, Accounts = accountList, RegionConcurrency = str(n), ASGSupport = 'No', EmbeddedMetrics = 'Yes')
+        duration, calls, emfBytes = bench_run(scheduler, snapshot, event, latency)
+        print ('%-10d %12.3f %12d %12d %12d' % (n, duration, sum(calls.values()), calls['sts.AssumeRole'], emfBytes))
+        assert emfBytes < maxEventBytes, 'EMF record of %d bytes, larger than a CloudWatch Logs event' % emfBytes
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+######################################################################################################################
+#  Benchmark: bookkeeping of the START/STOP and metric lists with Python lists compared to the ActionPlan sets       #
+#                                                                                                                    #
+#  Usage: python bench/bench_action_plan.py [instances ...]                                                          #
+######################################################################################################################
+
+import sys
+import time
+
+from _scheduler import load_scheduler
+
+# Function to create a fleet of (instance, state, action), a third of it started and a third stopped
+def make_fleet(count):
+    
+    fleet = []
+    for n in range(count):
+        if n % 3 == 0:
+            fleet.append(('i-%017x' % n, 'stopped', 'START'))
+        elif n % 3 == 1:
+            fleet.append(('i-%017x' % n, 'running', 'STOP'))
+        else:
+            fleet.append(('i-%017x' % n, 'running', 'None'))
+    return fleet
+
+# Bookkeeping before: lists with 'not in' checks, rebuilt with comprehensions
+def with_lists(fleet):
+    
+    startList = []
+    stopList = []
+    metricUpList = []
+    metricDownList = []
+    for instance_id, state, action in fleet:
+        if state == 'running':
+            metricUpList.append(instance_id)
+        if state == 'stopped':
+            metricDownList.append(instance_id)
+        if action == 'START' and state == 'stopped':
+            if instance_id not in startList:
+                startList.append(instance_id)
+        if action == 'STOP' and state == 'running':
+            if instance_id not in stopList:
+                stopList.append(instance_id)
+    metricDownList = [e for e in metricDownList if e not in startList]
+    metricUpList = [e for e in metricUpList if e not in stopList]
+    return len(startList), len(stopList), len(metricUpList), len(metricDownList)
+
+# Bookkeeping after: the insertion-ordered sets of the action plan
+def with_plan(fleet, scheduler):
+    
+    plan = scheduler.ActionPlan('eu-west-1')
+    for instance_id, state, action in fleet:
+        if state == 'running':
+            plan.metricUpList.add(instance_id)
+        if state == 'stopped':
+            plan.metricDownList.add(instance_id)
+        if action == 'START' and state == 'stopped':
+            if instance_id not in plan.startList:
+                plan.startList.add(instance_id)
+        if action == 'STOP' and state == 'running':
+            if instance_id not in plan.stopList:
+                plan.stopList.add(instance_id)
+    plan.metricDownList.difference_update(plan.startList)
+    plan.metricUpList.difference_update(plan.stopList)
+    plan.to_json()
+    return len(plan.startList), len(plan.stopList), len(plan.metricUpList), len(plan.metricDownList)
+
+def main():
+    
+    scheduler = load_scheduler()
+    counts = [int(a) for a in sys.argv[1:]] or [10000, 50000]
+    
+    print ('%-10s %12s %12s' % ('instances', 'lists s', 'plan s'))
+    for count in counts:
+        fleet = make_fleet(count)
+        started = time.time()
+        before = with_lists(fleet)
+        lists = time.time() - started
+        started = time.time()
+        after = with_plan(fleet, scheduler)
+        plan = time.time() - started
+        assert before == after
+        print ('%-10d %12.3f %12.3f' % (count, lists, plan))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+######################################################################################################################
+#  Benchmark: cold start of a new container, i.e. the import of the handler module and the first and second         #
+#  invocation (plan mode against a small fleet snapshot), measured in fresh processes for every time zone backend    #
+#                                                                                                                    #
+#  Usage: python bench/bench_cold_start.py [runs] [backends]                                                         #
+######################################################################################################################
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from fleetgen import generate_fleet
+
+# Function to measure one cold start in this process, returns the timings as dict
+def cold_start(backend, snapshotPath):
+    
+    import contextlib
+    from _scheduler import load_scheduler, offline_environment
+    
+    offline_environment()
+    started = time.time()
+    scheduler = load_scheduler()
+    imported = time.time()
+    tzLoaded = [name for name in ('pytz', 'zoneinfo') if name in sys.modules]
+    
+    # Imported after the measurement, the bench suite imports boto3 itself
+    from bench_suite import bench_event
+    
+    event = bench_event(['eu-west-1'], FleetSnapshot = snapshotPath, TimeZoneBackend = backend)
+    timings = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for n in range(2):
+            invoked = time.time()
+            scheduler.lambda_handler(event, None)
+            timings.append(time.time() - invoked)
+    
+    return {
+        'Import': imported - started,
+        'FirstInvocation': timings[0],
+        'SecondInvocation': timings[1],
+        'TimeZoneModulesAtImport': tzLoaded
+    }
+
+def main():
+    
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print (json.dumps(cold_start(sys.argv[2], sys.argv[3])))
+        return
+    
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    backends = sys.argv[2].split(',') if len(sys.argv) > 2 else ['pytz', 'zoneinfo']
+    
+    with tempfile.NamedTemporaryFile('w', suffix = '.json', delete = False) as f:
+        json.dump(generate_fleet(200, 20), f)
+        snapshotPath = f.name
+    
+    try:
+        print ('%-10s %12s %18s %18s' % ('backend', 'import ms', 'first call ms', 'second call ms'))
+        for backend in backends:
+            results = []
+            for n in range(runs):
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', backend, snapshotPath])
+                results.append(json.loads(output.decode()))
+            
+            # Medians of the runs
+            median = lambda key: sorted(r[key] for r in results)[len(results) // 2] * 1000
+            print ('%-10s %12.1f %18.1f %18.1f' % (backend, median('Import'), median('FirstInvocation'), median('SecondInvocation')))
+    finally:
+        os.unlink(snapshotPath)
+
+if __name__ == '__main__':
+    main()
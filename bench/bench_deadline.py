@@ -0,0 +1,75 @@
+######################################################################################################################
+#  Benchmark: runs that hit the deadline of the invocation, the handler in run mode against stubbed responses with a   #
+#  short TimeBudget (regions are deferred and checkpointed) and the next run (resumes them), compared to the same     #
+#  two runs without a deadline: time of the runs, regions deferred and resources running at the end                   #
+#                                                                                                                    #
+#  Usage: python bench/bench_deadline.py [EC2 instances per region] [regions] [TimeBudget]                           #
+######################################################################################################################
+
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+import time
+
+import boto3
+
+from _scheduler import load_scheduler, offline_environment
+from bench_suite import bench_event, benchTimestamp
+from fakeaws import FakeAWS
+from fleetgen import generate_fleet
+
+# Function to run the handler with the events one after another against a fresh copy of the fleet and a new inventory
+# store, returns the duration, the output and the resources running at the end
+def bench_runs(scheduler, snapshot, events):
+    
+    store = tempfile.mkdtemp()
+    fake = FakeAWS(snapshot, 0.02)
+    scheduler.clientSession = fake.attach(boto3.session.Session())
+    scheduler.clients.clear()
+    output = io.StringIO()
+    started = time.time()
+    with contextlib.redirect_stdout(output):
+        for event in events:
+            scheduler.lambda_handler(dict(event, InventoryStore = 'file://' + store), None)
+    duration = time.time() - started
+    scheduler.clients.clear()
+    scheduler.clientSession = None
+    shutil.rmtree(store)
+    
+    done = 0
+    for region in fake.regions.values():
+        done += sum(1 for i in region['Instances'] if i['State']['Name'] == 'running')
+        done += sum(1 for d in region['DBInstances'] if d['DBInstanceStatus'] == 'available')
+    return duration, output.getvalue(), done
+
+def main():
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    ec2Count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    regions = sys.argv[2].split(',') if len(sys.argv) > 2 else ['eu-west-1', 'us-east-1', 'eu-central-1', 'ap-southeast-2']
+    timeBudget = sys.argv[3] if len(sys.argv) > 3 else '11'
+    
+    # No rate limits, the stand-in doesn't throttle
+    for service in ('ec2', 'autoscaling', 'rds', 'cloudwatch'):
+        scheduler.governor.serviceRates[service] = (100000, 100000)
+    
+    snapshot = generate_fleet(ec2Count, ec2Count // 10, regions)
+    
+    # The second run is the one of the next window, it resumes what the first one deferred
+    event = bench_event(regions, RegionConcurrency = '1', ASGWaitTimeout = '5')
+    nextEvent = dict(event, Timestamp = benchTimestamp + 300)
+    
+    print ('%d EC2 instances in %d regions, TimeBudget %ss' % (ec2Count, len(regions), timeBudget))
+    print ('%-10s %10s %10s %10s' % ('deadline', 'seconds', 'deferred', 'running'))
+    for name, first in (('none', event), ('budget', dict(event, TimeBudget = timeBudget, RegionBudget = '0.5'))):
+        duration, output, done = bench_runs(scheduler, snapshot, [first, nextEvent])
+        # Regions deferred by the first run, from its checkpoint line
+        checkpoints = [line.split()[2] for line in output.split('\n') if line.startswith('* Checkpoint:')]
+        deferred = int(checkpoints[0]) if checkpoints else 0
+        print ('%-10s %10.2f %10d %10d' % (name, duration, deferred, done))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+######################################################################################################################
+#  Benchmark: EC2 discovery with ec2.instances.all() compared to describe_instances with server-side filters          #
+#                                                                                                                    #
+#  Usage: python bench/bench_ec2_discovery.py [instances] [tagged percentage]                                        #
+######################################################################################################################
+
+import sys
+import time
+
+import boto3
+
+from _scheduler import load_scheduler, offline_environment
+from fakeaws import FakeEC2, ec2_instance
+
+tagName = 'scheduler:ec2-startstop'
+
+# Function to create a fleet where only some instances carry the scheduler tag
+def make_fleet(count, taggedPercentage):
+    
+    fleet = []
+    for n in range(count):
+        tags = {'Name': 'instance-%d' % n, 'Owner': 'team-%d' % (n % 20)}
+        if n % 100 < taggedPercentage:
+            tags[tagName] = 'default'
+        fleet.append(ec2_instance(n, 'running' if n % 3 else 'stopped', tags))
+    return fleet
+
+# Discovery before: every instance is loaded through the resource interface and the tag is searched in Python
+def discover_all(session, fake):
+    
+    ec2 = session.resource('ec2', region_name = 'eu-west-1')
+    fake.attach(ec2.meta.client)
+    found = 0
+    for i in ec2.instances.all():
+        if i.tags != None:
+            for t in i.tags:
+                if t['Key'][:len(tagName)] == tagName:
+                    found += 1
+    return found
+
+# Discovery after: tag key and state are filtered by EC2
+def discover_filtered(session, fake, scheduler):
+    
+    scheduler.customTagName = tagName
+    client = fake.attach(session.client('ec2', region_name = 'eu-west-1'))
+    return sum(1 for _ in scheduler.describe_tagged_instances(client))
+
+def main():
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    taggedPercentage = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    fleet = make_fleet(count, taggedPercentage)
+    
+    print ('Fleet of', count, 'instances,', taggedPercentage, '% tagged')
+    print ('%-10s %8s %8s %12s %10s' % ('discovery', 'found', 'pages', 'bytes', 'seconds'))
+    for name, discover in (('all', lambda s, f: discover_all(s, f)), ('filtered', lambda s, f: discover_filtered(s, f, scheduler))):
+        fake = FakeEC2(fleet)
+        started = time.time()
+        found = discover(boto3.session.Session(), fake)
+        print ('%-10s %8d %8d %12d %10.2f' % (name, found, fake.pages, fake.bytes, time.time() - started))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+######################################################################################################################
+#  Benchmark: a run against request quotas, the handler in run mode against stubbed responses that are throttled     #
+#  beyond a quota per service and region (like AWS), with the API rate governor and with its limits lifted           #
+#                                                                                                                    #
+#  Usage: python bench/bench_governor.py [EC2 instances per region] [regions] [latency]                              #
+######################################################################################################################
+
+import sys
+
+import boto3
+
+from _scheduler import load_scheduler, offline_environment
+from bench_suite import bench_event, call_handler
+from fakeaws import FakeAWS
+from fleetgen import generate_fleet
+
+# Quotas of the stand-in by endpoint prefix: calls per second and burst of a service in a region
+quotas = {
+    'ec2': (4, 8),
+    'autoscaling': (2, 4),
+    'rds': (2, 4),
+    'monitoring': (4, 8)
+}
+
+# Function to run the handler against a fresh copy of the fleet, returns the duration, calls, throttled calls and result
+def bench_run(scheduler, snapshot, event, latency):
+    
+    fake = FakeAWS(snapshot, latency, quotas)
+    scheduler.clientSession = fake.attach(boto3.session.Session())
+    scheduler.clients.clear()
+    scheduler.governor.limiters.clear()
+    result, duration, _ = call_handler(scheduler, event)
+    scheduler.clients.clear()
+    scheduler.clientSession = None
+    
+    # Resources in the state of their action once the run is done
+    done = 0
+    for region in fake.regions.values():
+        done += sum(1 for i in region['Instances'] if i['State']['Name'] == 'running')
+        done += sum(1 for d in region['DBInstances'] if d['DBInstanceStatus'] == 'available')
+    return duration, fake.calls, fake.throttled, done
+
+def main():
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    ec2Count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    regions = sys.argv[2].split(',') if len(sys.argv) > 2 else ['eu-west-1', 'us-east-1']
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+    
+    snapshot = generate_fleet(ec2Count, ec2Count // 10, regions)
+    attach = scheduler.governor.attach
+    event = bench_event(regions, ASGWaitTimeout = '5', CloudWatchMetricsLayout = 'InstanceDimension')
+    
+    print ('%d EC2 instances in %d regions, %.0fms per API call' % (ec2Count, len(regions), latency * 1000))
+    print ('%-10s %10s %12s %12s %12s' % ('governor', 'seconds', 'API calls', 'throttled', 'running'))
+    for name in ('off', 'on'):
+        # Without the governor the clients aren't hooked into its limiters
+        scheduler.governor.attach = attach if name == 'on' else (lambda client, account = None: client)
+        duration, calls, throttled, done = bench_run(scheduler, snapshot, event, latency)
+        print ('%-10s %10.2f %12d %12d %12d' % (name, duration, sum(calls.values()), sum(throttled.values()), done))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+######################################################################################################################
+#  Benchmark: log volume of a run, the handler in run mode against stubbed botocore responses for every log format,   #
+#  verbosity and sample rate: bytes and lines written to stdout (the CloudWatch Logs ingestion of the run)           #
+#                                                                                                                    #
+#  Usage: python bench/bench_logging.py [EC2 instances per region] [regions]                                         #
+######################################################################################################################
+
+import contextlib
+import io
+import sys
+import time
+
+import boto3
+
+from _scheduler import load_scheduler, offline_environment
+from bench_suite import bench_event
+from fakeaws import FakeAWS
+from fleetgen import generate_fleet
+
+# Log settings: format, verbosity and sample rate, the first one is the output without sampling
+settings = [
+    ('text', 'detail', 1.0),
+    ('text', 'detail', 0.1),
+    ('text', 'detail', 0.01),
+    ('text', 'summary', 1.0),
+    ('json', 'detail', 0.1),
+    ('json', 'summary', 1.0)
+]
+
+# Function to run the handler with a log setting against a fresh copy of the fleet, returns the duration and the output
+def bench_run(scheduler, snapshot, event):
+    
+    fake = FakeAWS(snapshot)
+    scheduler.clientSession = fake.attach(boto3.session.Session())
+    scheduler.clients.clear()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        started = time.time()
+        scheduler.lambda_handler(event, None)
+        duration = time.time() - started
+    scheduler.clients.clear()
+    scheduler.clientSession = None
+    return duration, output.getvalue()
+
+def main():
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    ec2Count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    regions = sys.argv[2].split(',') if len(sys.argv) > 2 else ['eu-west-1', 'us-east-1']
+    
+    # No rate limits, the stand-in doesn't throttle
+    for service in ('ec2', 'autoscaling', 'rds', 'cloudwatch'):
+        scheduler.governor.serviceRates[service] = (100000, 100000)
+    
+    snapshot = generate_fleet(ec2Count, ec2Count // 10, regions)
+    
+    print ('%d EC2 instances and %d RDS instances in %d regions' % (ec2Count, ec2Count // 10, len(regions)))
+    print ('%-6s %-8s %6s %10s %12s %10s %10s' % ('format', 'verbose', 'sample', 'seconds', 'bytes', 'lines', 'of text'))
+    baseline = None
+    for logFormat, verbosity, sampleRate in settings:
+        event = bench_event(regions, ASGWaitTimeout = '5', LogFormat = logFormat, LogVerbosity = verbosity, LogSampleRate = sampleRate)
+        duration, output = bench_run(scheduler, snapshot, event)
+        size = len(output.encode())
+        baseline = baseline or size
+        print ('%-6s %-8s %6s %10.2f %12d %10d %9.1f%%' % (logFormat, verbosity, sampleRate, duration, size, output.count('\n'), 100.0 * size / baseline))
+
+if __name__ == '__main__':
+    main()
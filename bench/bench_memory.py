@@ -0,0 +1,72 @@
+######################################################################################################################
+#  Benchmark: memory of a run by fleet size, the handler in run mode against stubbed botocore responses of one region #
+#  measured in a new process per fleet size: peak of the memory allocated during the run (tracemalloc, without the    #
+#  fleet of the stand-in) and peak RSS of the process                                                                 #
+#                                                                                                                    #
+#  Usage: python bench/bench_memory.py [EC2 instances,...]                                                           #
+######################################################################################################################
+
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+# Function to measure one run in this process, returns the measurements as dict
+def measure(ec2Count):
+    
+    import boto3
+    from _scheduler import load_scheduler, offline_environment
+    from bench_suite import bench_event, call_handler
+    from fakeaws import FakeAWS
+    from fleetgen import generate_fleet
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    fake = FakeAWS(generate_fleet(ec2Count, ec2Count // 10))
+    scheduler.clientSession = fake.attach(boto3.session.Session())
+    
+    # No rate limits, the stand-in doesn't throttle
+    for service in ('ec2', 'autoscaling', 'rds', 'cloudwatch'):
+        scheduler.governor.serviceRates[service] = (100000, 100000)
+    
+    # Warm up the clients and the botocore models, so only the run itself is measured
+    call_handler(scheduler, bench_event(['eu-west-1'], Mode = 'plan', Timestamp = 0))
+    gc.collect()
+    
+    rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    _, duration, _ = call_handler(scheduler, bench_event(['eu-west-1'], ASGWaitTimeout = '5'))
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    
+    return {
+        'EC2': ec2Count,
+        'RDS': ec2Count // 10,
+        'Seconds': duration,
+        'RunPeakBytes': peak,
+        'RunPeakBytesPerResource': peak / (ec2Count + ec2Count // 10),
+        'MaxRSSBefore': rssBefore * 1024,
+        'MaxRSS': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+# Function to run every fleet size in a new process and print the measurements
+def main():
+    
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        print (json.dumps(measure(int(sys.argv[2]))))
+        return
+    
+    sizes = [int(n) for n in sys.argv[1].split(',')] if len(sys.argv) > 1 else [5000, 10000, 20000, 40000]
+    
+    print ('%-10s %10s %16s %14s %14s' % ('EC2', 'seconds', 'run peak MB', 'bytes/res.', 'RSS MB'))
+    for ec2Count in sizes:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', str(ec2Count)])
+        r = json.loads(output.decode())
+        print ('%-10d %10.2f %16.1f %14.0f %14.1f' % (r['EC2'], r['Seconds'], r['RunPeakBytes'] / 1e6, r['RunPeakBytesPerResource'], r['MaxRSS'] / 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+######################################################################################################################
+#  Benchmark: cost per instance of scheduler_action, compiled and decided per call compared to the per-run caches    #
+#                                                                                                                    #
+#  Usage: python bench/bench_scheduler_action.py [instances]                                                         #
+######################################################################################################################
+
+import sys
+import time
+
+from _scheduler import load_scheduler
+
+# Tag values shared by the fleet
+tagValues = ['default', '24x7', '24x5', '0800:1800', '0700:1900:utc:all', '0800:1800:Europe/Belgrade', ':1800', '0000:1800:Etc/GMT+1:Mon/1',
+             '1030:1700::mon,tue,fri,1,3,sat/1', '0815:1745::wed,thu', '0800:none::weekdays', '1000:1700:America/New_York:weekdays',
+             '0600:2200:Asia/Tokyo:all', '0900:1700:Australia/Sydney:mon,tue,wed,thu,fri', '1030:1700::5,fri', '2300:0000:utc:sat/2,fri/4']
+
+# Function to reset the per-run caches, like lambda_handler does
+def reset(scheduler):
+    
+    scheduler.compiledSchedules.clear()
+    scheduler.localTimes.clear()
+    scheduler.scheduleActions.clear()
+
+def main():
+    
+    scheduler = load_scheduler()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    fleet = [tagValues[n % len(tagValues)] for n in range(count)]
+    
+    scheduler.defaultStartTime = '0800'
+    scheduler.defaultStopTime = '1800'
+    scheduler.defaultTimeZone = 'Europe/Zurich'
+    scheduler.defaultDaysActive = 'weekdays'
+    scheduler.schedule = 5
+    scheduler.timestamp = time.time()
+    
+    # Every instance parses its tag, resolves the time zone and formats the time (no reuse between instances)
+    started = time.time()
+    for tagValue in fleet:
+        reset(scheduler)
+        scheduler.scheduler_action(tagValue)
+    uncached = time.time() - started
+    
+    # Tag values are compiled and decided once per run
+    reset(scheduler)
+    started = time.time()
+    for tagValue in fleet:
+        scheduler.scheduler_action(tagValue)
+    cached = time.time() - started
+    
+    print ('%d instances, %d distinct tag values' % (count, len(tagValues)))
+    print ('%-10s %12s %14s' % ('decision', 'seconds', 'us/instance'))
+    print ('%-10s %12.4f %14.3f' % ('uncached', uncached, uncached / count * 1e6))
+    print ('%-10s %12.4f %14.3f' % ('cached', cached, cached / count * 1e6))
+    print ('speedup x%.0f' % (uncached / cached))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+######################################################################################################################
+#  Benchmark suite: decision throughput, end-to-end handler time (plan mode against a fleet snapshot and run mode    #
+#  against stubbed botocore responses), peak memory and API calls on a synthetic fleet. Writes the results as JSON,  #
+#  so they can be compared across commits                                                                           #
+#                                                                                                                    #
+#  Usage: python bench/bench_suite.py [EC2 instances] [RDS instances] [regions] [results.json]                       #
+######################################################################################################################
+
+import calendar
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import boto3
+
+from _scheduler import load_scheduler, offline_environment
+from fakeaws import FakeAWS
+from fleetgen import generate_fleet, ec2TagName, rdsTagName
+
+# Runs are planned at Monday 2019-04-15 08:00 Europe/Zurich, when the default schedule starts instances
+benchTimestamp = calendar.timegm((2019, 4, 15, 6, 0, 0))
+
+# Function to get the event of the scheduled rule, with the defaults of the CloudFormation template
+def bench_event(regions, **kwargs):
+    
+    event = {
+        'Schedule': '5minutes',
+        'Regions': ','.join(regions),
+        'RegionConcurrency': '8',
+        'CustomTagName': ec2TagName,
+        'CustomRDSTagName': rdsTagName,
+        'DefaultStartTime': "'0800'",
+        'DefaultStopTime': "'1800'",
+        'DefaultDaysActive': 'weekdays',
+        'DefaultTimeZone': 'Europe/Zurich',
+        'ASGSupport': 'Yes',
+        'ASGWaitTimeout': '60',
+        'RDSSupport': 'Yes',
+        'CloudWatchMetrics': 'Yes',
+        'CloudWatchMetricsLayout': 'MetricPerInstance',
+        'Timestamp': benchTimestamp
+    }
+    event.update(kwargs)
+    return event
+
+# Function to get the commit of the working tree, if any
+def git_commit():
+    
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+# Function to call the handler with its log discarded, returns the result, duration and peak memory (if traced)
+def call_handler(scheduler, event, traced = False):
+    
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if traced:
+            tracemalloc.start()
+        started = time.time()
+        result = scheduler.lambda_handler(event, None)
+        duration = time.time() - started
+        peak = None
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, duration, peak
+
+# Decision throughput: every tagged resource is decided once, with the per-run caches of lambda_handler
+def bench_decisions(scheduler, snapshot):
+    
+    tagValues = []
+    for region in snapshot['Regions'].values():
+        for i in region['Instances']:
+            tagValues.extend(t['Value'] for t in i.get('Tags', []) if t['Key'] == ec2TagName)
+        for d in region['DBInstances'] + region['DBClusters']:
+            tagValues.extend(t['Value'] for t in d['TagList'] if t['Key'] == rdsTagName)
+    
+    scheduler.defaultStartTime = '0800'
+    scheduler.defaultStopTime = '1800'
+    scheduler.defaultTimeZone = 'Europe/Zurich'
+    scheduler.defaultDaysActive = 'weekdays'
+    scheduler.schedule = 5
+    scheduler.timestamp = benchTimestamp
+    scheduler.compiledSchedules.clear()
+    scheduler.localTimes.clear()
+    scheduler.scheduleActions.clear()
+    
+    # Log lines of invalid time zones are not part of the measurement
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.time()
+        actions = [scheduler.scheduler_action(v) for v in tagValues]
+        duration = time.time() - started
+    
+    return {
+        'Decisions': len(tagValues),
+        'DistinctTagValues': len(set(tagValues)),
+        'Seconds': duration,
+        'DecisionsPerSecond': len(tagValues) / duration if duration else None,
+        'Start': actions.count('START'),
+        'Stop': actions.count('STOP')
+    }
+
+# End-to-end plan mode against the fleet snapshot, with the resulting plan summarized
+def bench_plan(scheduler, snapshotPath, event):
+    
+    fleetsnapshot = sys.modules['fleetsnapshot']
+    fleetsnapshot.callCounts.clear()
+    plan, duration, _ = call_handler(scheduler, dict(event, FleetSnapshot = snapshotPath))
+    calls = dict(('%s.%s' % k, v) for k, v in fleetsnapshot.callCounts.items())
+    fleetsnapshot.callCounts.clear()
+    _, _, peak = call_handler(scheduler, dict(event, FleetSnapshot = snapshotPath), traced = True)
+    
+    actions = {}
+    for region in plan['Regions']:
+        for group in ('EC2', 'RDS'):
+            for key, resources in region[group].items():
+                actions[group + key] = actions.get(group + key, 0) + len(resources)
+    
+    return {
+        'Seconds': duration,
+        'PeakBytes': peak,
+        'ApiCalls': sum(calls.values()),
+        'ApiCallsByOperation': calls,
+        'Actions': actions
+    }
+
+# End-to-end run mode against stubbed botocore responses of the fleet, clients and all calls included
+def bench_run(scheduler, snapshot, event, traced = False):
+    
+    fake = FakeAWS(snapshot)
+    scheduler.clientSession = fake.attach(boto3.session.Session())
+    scheduler.clients.clear()
+    _, duration, peak = call_handler(scheduler, event, traced)
+    scheduler.clients.clear()
+    scheduler.clientSession = None
+    return duration, peak, fake.calls
+
+def main():
+    
+    offline_environment()
+    scheduler = load_scheduler()
+    ec2Count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rdsCount = int(sys.argv[2]) if len(sys.argv) > 2 else ec2Count // 10
+    regions = sys.argv[3].split(',') if len(sys.argv) > 3 else ['eu-west-1', 'us-east-1']
+    
+    snapshot = generate_fleet(ec2Count, rdsCount, regions)
+    event = bench_event(regions)
+    
+    with tempfile.NamedTemporaryFile('w', suffix = '.json', delete = False) as f:
+        json.dump(snapshot, f)
+        snapshotPath = f.name
+    
+    try:
+        results = {
+            'Commit': git_commit(),
+            'Python': platform.python_version(),
+            'Fleet': {'EC2': ec2Count, 'RDS': rdsCount, 'Regions': regions, 'Timestamp': benchTimestamp},
+            'Decisions': bench_decisions(scheduler, snapshot),
+            'Plan': bench_plan(scheduler, snapshotPath, event)
+        }
+        
+        duration, _, calls = bench_run(scheduler, snapshot, event)
+        _, peak, _ = bench_run(scheduler, snapshot, event, traced = True)
+        results['Run'] = {
+            'Seconds': duration,
+            'PeakBytes': peak,
+            'ApiCalls': sum(calls.values()),
+            'ApiCallsByOperation': dict(calls)
+        }
+    finally:
+        os.unlink(snapshotPath)
+    
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if len(sys.argv) > 4:
+        with open(sys.argv[4], 'w') as f:
+            f.write(output + '\n')
+    print (output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+######################################################################################################################
+#  Local stand-in for the AWS APIs used by the scheduler, answers botocore calls from memory                          #
+######################################################################################################################
+
+import datetime
+import fnmatch
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+from botocore.awsrequest import AWSResponse
+from botocore.hooks import first_non_none_response
+
+# Function to check an instance against the describe_instances filters
+def matches(instance, filters):
+    
+    for f in filters:
+        if f['Name'] == 'tag-key':
+            keys = [t['Key'] for t in instance.get('Tags', [])]
+            if not any(fnmatch.fnmatchcase(k, v) for k in keys for v in f['Values']):
+                return False
+        elif f['Name'] == 'instance-state-name':
+            if instance['State']['Name'] not in f['Values']:
+                return False
+        elif f['Name'] == 'instance-id':
+            if instance['InstanceId'] not in f['Values']:
+                return False
+        else:
+            raise ValueError('Unsupported filter ' + f['Name'])
+    return True
+
+# In-memory EC2, answers describe_instances with server-side filters and pagination
+class FakeEC2(object):
+    
+    def __init__(self, instances):
+        self.instances = instances
+        self.pages = 0
+        self.bytes = 0
+        
+    def describe_instances(self, params):
+        
+        matching = [i for i in self.instances if matches(i, params.get('Filters', []))]
+        if 'InstanceIds' in params:
+            matching = [i for i in matching if i['InstanceId'] in params['InstanceIds']]
+            
+        # Without MaxResults EC2 returns pages of 1000 instances as well
+        start = int(params.get('NextToken', 0))
+        end = start + params.get('MaxResults', 1000)
+        response = {'Reservations': [{'ReservationId': 'r-' + i['InstanceId'][2:], 'Instances': [i]} for i in matching[start:end]]}
+        if end < len(matching):
+            response['NextToken'] = str(end)
+            
+        self.pages += 1
+        self.bytes += len(json.dumps(response))
+        return response
+    
+    # Function to hook the fake into a botocore client, every supported call is answered from memory
+    def attach(self, client):
+        
+        # The API parameters are only available before they get serialized
+        def remember(params, context, **kwargs):
+            context['fakeParams'] = dict(params)
+            
+        def answer(context, **kwargs):
+            return AWSResponse(None, 200, {}, None), self.describe_instances(context['fakeParams'])
+        
+        client.meta.events.register('before-parameter-build.ec2.DescribeInstances', remember)
+        client.meta.events.register('before-call.ec2.DescribeInstances', answer)
+        return client
+
+# Function to answer a paginated call with one page of items, tokenKey/sizeKey are the pagination parameters of the API
+def page_of(items, params, responseKey, tokenKey, sizeKey, pageSize):
+    
+    start = int(params.get(tokenKey) or 0)
+    end = start + params.get(sizeKey, pageSize)
+    response = {responseKey: items[start:end]}
+    if end < len(items):
+        response[tokenKey] = str(end)
+    return response
+
+# In-memory AWS for a fleet snapshot (see code/fleetsnapshot.py), answers and applies every call the scheduler makes.
+# Instances reach their target state immediately. Hooked into a boto3 session, so it serves all clients created from it.
+# The regions of other accounts ("Accounts": {"123456789012": {"Regions": ...}} in the snapshot) are served to the
+# credentials returned by AssumeRole for a role of the account. Every call takes latency seconds, like a round trip.
+# quotas (endpoint prefix -> rate, burst) limit the calls of a service in a region of an account like AWS does, calls
+# beyond the quota are throttled
+class FakeAWS(object):
+    
+    def __init__(self, snapshot, latency = 0.0, quotas = None):
+        self.latency = latency
+        self.regions = self.index(snapshot['Regions'])
+        self.accounts = dict((account, self.index(s['Regions'])) for account, s in snapshot.get('Accounts', {}).items())
+        self.calls = Counter()
+        self.quotas = quotas or {}
+        self.buckets = {}
+        self.throttled = Counter()
+        self.lock = threading.Lock()
+        
+    # Function to copy the regions of a snapshot, with the resources indexed by ID
+    def index(self, regions):
+        
+        regions = json.loads(json.dumps(regions))
+        for region in regions.values():
+            region['InstancesById'] = dict((i['InstanceId'], i) for i in region['Instances'])
+            region['MembersById'] = dict((j['InstanceId'], j) for j in region['AutoScalingInstances'])
+            region['DBInstancesById'] = dict((d['DBInstanceIdentifier'], d) for d in region['DBInstances'])
+            region['DBClustersById'] = dict((c['DBClusterIdentifier'], c) for c in region['DBClusters'])
+        return regions
+    
+    # Function to get the regions of the account of an access key, the keys of assumed roles are ASIA + account ID
+    def account_regions(self, accessKey):
+        
+        if accessKey and accessKey.startswith('ASIA') and accessKey[4:16] in self.accounts:
+            return self.accounts[accessKey[4:16]]
+        return self.regions
+    
+    # Function to take a token of the quota of a service, False if the call is throttled. key is account, service and region
+    def within_quota(self, key):
+        
+        if key[1] not in self.quotas:
+            return True
+        (rate, burst) = self.quotas[key[1]]
+        with self.lock:
+            now = time.time()
+            (tokens, updated) = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            self.buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+            return tokens >= 1
+        
+    # Function to set the state of instances, returns the state changes as returned by start/stop_instances
+    def set_state(self, region, instanceIds, state, code):
+        
+        changes = []
+        for i in instanceIds:
+            instance = region['InstancesById'][i]
+            changes.append({'InstanceId': i, 'PreviousState': dict(instance['State']), 'CurrentState': {'Code': code, 'Name': state}})
+            instance['State'] = {'Code': code, 'Name': state}
+        return changes
+    
+    # Function to answer an API call of a region
+    def call(self, region, service, operation, params):
+        
+        if operation == 'DescribeRegions':
+            return {'Regions': [{'RegionName': r} for r in self.regions]}
+        if operation == 'AssumeRole':
+            account = params['RoleArn'].split(':')[4]
+            if account not in self.accounts:
+                raise ValueError('Unknown account ' + account)
+            return {'Credentials': {'AccessKeyId': 'ASIA%s%04d' % (account, self.calls['sts.AssumeRole']), 'SecretAccessKey': 'fake', 'SessionToken': 'fake',
+                                    'Expiration': datetime.datetime.utcnow() + datetime.timedelta(hours = 1)}}
+        
+        if operation == 'DescribeInstances':
+            matching = [i for i in region['Instances'] if matches(i, params.get('Filters', []))]
+            if 'InstanceIds' in params:
+                matching = [i for i in matching if i['InstanceId'] in params['InstanceIds']]
+            response = page_of(matching, params, 'Reservations', 'NextToken', 'MaxResults', 1000)
+            response['Reservations'] = [{'ReservationId': 'r-' + i['InstanceId'][2:], 'Instances': [i]} for i in response['Reservations']]
+            return response
+        if operation == 'StartInstances':
+            return {'StartingInstances': self.set_state(region, params['InstanceIds'], 'running', 16)}
+        if operation == 'StopInstances':
+            return {'StoppingInstances': self.set_state(region, params['InstanceIds'], 'stopped', 80)}
+        if operation in ('CreateTags', 'DeleteTags'):
+            for i in params['Resources']:
+                instance = region['InstancesById'][i]
+                keys = [t['Key'] for t in params['Tags']]
+                instance['Tags'] = [t for t in instance.get('Tags', []) if t['Key'] not in keys]
+                if operation == 'CreateTags':
+                    instance['Tags'].extend(params['Tags'])
+            return {}
+        
+        if operation == 'DescribeAutoScalingInstances':
+            members = region['AutoScalingInstances']
+            if 'InstanceIds' in params:
+                members = [j for j in members if j['InstanceId'] in params['InstanceIds']]
+            return page_of(members, params, 'AutoScalingInstances', 'NextToken', 'MaxRecords', 50)
+        if operation == 'DescribeAutoScalingGroups':
+            asgs = [a for a in region['AutoScalingGroups'] if a['AutoScalingGroupName'] in params.get('AutoScalingGroupNames', [a['AutoScalingGroupName']])]
+            return page_of(asgs, params, 'AutoScalingGroups', 'NextToken', 'MaxRecords', 50)
+        if operation in ('EnterStandby', 'ExitStandby'):
+            for i in params['InstanceIds']:
+                region['MembersById'][i]['LifecycleState'] = 'Standby' if operation == 'EnterStandby' else 'InService'
+            return {'Activities': []}
+        
+        if operation == 'DescribeDBInstances':
+            return page_of(region['DBInstances'], params, 'DBInstances', 'Marker', 'MaxRecords', 100)
+        if operation == 'DescribeDBClusters':
+            return page_of(region['DBClusters'], params, 'DBClusters', 'Marker', 'MaxRecords', 100)
+        if operation == 'ListTagsForResource':
+            return {'TagList': []}
+        if operation in ('StartDBInstance', 'StopDBInstance'):
+            dbInstance = region['DBInstancesById'][params['DBInstanceIdentifier']]
+            dbInstance['DBInstanceStatus'] = 'available' if operation == 'StartDBInstance' else 'stopped'
+            return {'DBInstance': dbInstance}
+        if operation in ('StartDBCluster', 'StopDBCluster'):
+            dbCluster = region['DBClustersById'][params['DBClusterIdentifier']]
+            dbCluster['Status'] = 'available' if operation == 'StartDBCluster' else 'stopped'
+            return {'DBCluster': dbCluster}
+        
+        if operation == 'PutMetricData':
+            return {}
+        
+        raise ValueError('Unsupported call %s.%s' % (service, operation))
+    
+    # Function to hook the fake into a boto3 session, before its clients are created
+    def attach(self, session):
+        
+        # The API parameters are only available before they get serialized
+        def remember(params, context, **kwargs):
+            context['fakeParams'] = dict(params)
+            
+        def answer(model, params, context, request_signer, **kwargs):
+            service = model.service_model.endpoint_prefix
+            self.calls[service + '.' + model.name] += 1
+            time.sleep(self.latency)
+            accessKey = request_signer._credentials.access_key
+            regions = self.account_regions(accessKey)
+            region = re.search(r'\.([a-z]{2}(?:-[a-z]+)+-\d)\.', params['url'])
+            
+            # Throttled attempts are retried like botocore does: the retry handlers of the client decide on the retry and its delay
+            attempts = 1
+            while not self.within_quota((accessKey[:16], service, region and region.group(1))):
+                self.throttled[service + '.' + model.name] += 1
+                throttled = (AWSResponse(None, 400, {}, None), {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}, 'ResponseMetadata': {'HTTPStatusCode': 400}})
+                eventName = 'needs-retry.%s.%s' % (model.service_model.service_id.hyphenize(), model.name)
+                delay = first_non_none_response(request_signer._event_emitter.emit(eventName, response = throttled, endpoint = None, operation = model,
+                                                                                    attempts = attempts, caught_exception = None, request_dict = {'context': context}))
+                if delay is None:
+                    return throttled
+                time.sleep(delay)
+                attempts += 1
+                
+            return AWSResponse(None, 200, {}, None), self.call(regions.get(region and region.group(1)), service, model.name, context['fakeParams'])
+        
+        session.events.register('before-parameter-build', remember)
+        session.events.register('before-call', answer)
+        return session
+
+# Function to create an instance as returned by describe_instances, with the usual attributes
+def ec2_instance(number, state = 'running', tags = None):
+    
+    instance = {
+        'InstanceId': 'i-%017x' % number,
+        'ImageId': 'ami-0123456789abcdef0',
+        'InstanceType': 't3.micro',
+        'LaunchTime': '2019-04-16T08:00:00.000Z',
+        'Placement': {'AvailabilityZone': 'eu-west-1a', 'Tenancy': 'default'},
+        'PrivateDnsName': 'ip-10-0-%d-%d.eu-west-1.compute.internal' % (number // 256 % 256, number % 256),
+        'PrivateIpAddress': '10.0.%d.%d' % (number // 256 % 256, number % 256),
+        'State': {'Code': 16 if state == 'running' else 80, 'Name': state},
+        'SubnetId': 'subnet-0123456789abcdef0',
+        'VpcId': 'vpc-0123456789abcdef0',
+        'SecurityGroups': [{'GroupName': 'default', 'GroupId': 'sg-0123456789abcdef0'}],
+        'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-%017x' % number, 'Status': 'attached'}}],
+        'NetworkInterfaces': [{'NetworkInterfaceId': 'eni-%017x' % number, 'PrivateIpAddress': '10.0.%d.%d' % (number // 256 % 256, number % 256)}]
+    }
+    if tags:
+        instance['Tags'] = [{'Key': k, 'Value': v} for k, v in tags.items()]
+    return instance
@@ -0,0 +1,131 @@
+######################################################################################################################
+#  Synthetic fleet generator: EC2 instances, ASGs and RDS instances/clusters in the fleet snapshot format            #
+#  of code/fleetsnapshot.py, tagged with a realistic mix of schedules                                                #
+#                                                                                                                    #
+#  Usage: python bench/fleetgen.py [EC2 instances] [RDS instances] [regions] > snapshot.json                         #
+######################################################################################################################
+
+import json
+import random
+import sys
+
+from fakeaws import ec2_instance
+
+ec2TagName = 'scheduler:ec2-startstop'
+rdsTagName = 'scheduler:rds-startstop'
+
+# Tag values and their weight in the fleet: defaults, 24x7/24x5, weekdays, nth weekdays, month days,
+# midnight edge cases, invalid time zones and disabled schedules
+tagMix = [
+    ('default', 20),
+    ('24x7', 10),
+    ('24x5', 8),
+    ('24x5::Europe/Zurich', 4),
+    ('0800:1800::weekdays', 12),
+    ('0700:1900:utc:all', 6),
+    ('0800:1800:Europe/Belgrade', 4),
+    ('1000:1700:America/New_York:weekdays', 4),
+    ('0600:2200:Asia/Tokyo:all', 3),
+    ('0900:1700:Australia/Sydney:mon,tue,wed,thu,fri', 3),
+    (':1800', 3),
+    ('0800:none::weekdays', 2),
+    ('0000:1800:Etc/GMT+1:mon/1', 2),
+    ('1030:1700::mon,tue,fri,1,3,sat/1', 2),
+    ('1030:1700::1,15', 2),
+    ('1030:1700::5,fri', 1),
+    ('0000:0600:utc:all', 2),
+    ('2300:0000:utc:all', 2),
+    ('2355:0005:Europe/Zurich:weekdays', 1),
+    ('0000:2359::sat,sun', 1),
+    ('0800:1800:Mars/Olympus_Mons', 2),
+    ('0800:1800:europe/zurich:all', 1),
+    ('none', 3),
+    ('', 2)
+]
+
+# Function to pick count tag values following the weights of tagMix
+def tag_values(count, rng):
+    
+    values = [v for v, weight in tagMix]
+    weights = [weight for v, weight in tagMix]
+    return rng.choices(values, weights, k = count)
+
+# Function to generate a region: ec2Count instances (taggedPercentage tagged, asgPercentage in ASGs of asgSize)
+# and rdsCount RDS instances (a tenth of them in Aurora clusters)
+def generate_region(region_name, ec2Count, rdsCount, rng, offset = 0, taggedPercentage = 80, asgPercentage = 20, asgSize = 10):
+    
+    instances = []
+    asgInstances = []
+    asgs = []
+    for n, tagValue in enumerate(tag_values(ec2Count, rng)):
+        tags = {'Name': 'instance-%d' % n, 'Owner': 'team-%d' % (n % 20)}
+        if rng.random() * 100 < taggedPercentage:
+            tags[ec2TagName] = tagValue
+        instance = ec2_instance(offset + n, rng.choice(['running', 'stopped']), tags)
+        instance['Placement']['AvailabilityZone'] = region_name + 'a'
+        instances.append(instance)
+        
+        # Put the first asgPercentage of the fleet in ASGs
+        if n < ec2Count * asgPercentage // 100:
+            asg = 'asg-%s-%d' % (region_name, n // asgSize)
+            if n % asgSize == 0:
+                asgs.append({'AutoScalingGroupName': asg, 'MinSize': asgSize // 2, 'MaxSize': asgSize, 'DesiredCapacity': asgSize, 'Instances': []})
+            member = {'InstanceId': instance['InstanceId'], 'AutoScalingGroupName': asg, 'AvailabilityZone': region_name + 'a',
+                      'LifecycleState': 'InService' if instance['State']['Name'] == 'running' else 'Standby', 'HealthStatus': 'HEALTHY'}
+            asgInstances.append(member)
+            asgs[-1]['Instances'].append(dict((k, v) for k, v in member.items() if k != 'AutoScalingGroupName'))
+    
+    dbInstances = []
+    dbClusters = []
+    for n, tagValue in enumerate(tag_values(rdsCount, rng)):
+        identifier = 'db-%d' % (offset + n)
+        tags = [{'Key': rdsTagName, 'Value': tagValue}]
+        arn = 'arn:aws:rds:%s:123456789012:db:%s' % (region_name, identifier)
+        dbInstance = {'DBInstanceIdentifier': identifier, 'DBInstanceArn': arn, 'Engine': 'postgres', 'DBInstanceClass': 'db.t3.medium',
+                      'DBInstanceStatus': rng.choice(['available', 'stopped', 'available', 'stopped', 'backing-up']),
+                      'MultiAZ': n % 25 == 0, 'ReadReplicaDBInstanceIdentifiers': [], 'TagList': tags}
+        
+        # Every tenth instance is the only member of an Aurora cluster
+        if n % 10 == 0:
+            cluster = 'cluster-%d' % (offset + n)
+            dbInstance['DBClusterIdentifier'] = cluster
+            dbInstance['Engine'] = 'aurora-postgresql'
+            dbClusters.append({'DBClusterIdentifier': cluster, 'DBClusterArn': 'arn:aws:rds:%s:123456789012:cluster:%s' % (region_name, cluster),
+                               'Engine': 'aurora-postgresql', 'EngineMode': 'serverless' if n % 50 == 0 else 'provisioned',
+                               'Status': rng.choice(['available', 'stopped']), 'DBClusterMembers': [{'DBInstanceIdentifier': identifier}], 'TagList': tags})
+        dbInstances.append(dbInstance)
+    
+    return {
+        'Instances': instances,
+        'AutoScalingInstances': asgInstances,
+        'AutoScalingGroups': asgs,
+        'DBInstances': dbInstances,
+        'DBClusters': dbClusters
+    }
+
+# Function to generate a fleet snapshot, the resources are spread evenly over the regions
+def generate_fleet(ec2Count, rdsCount = 0, regions = ('eu-west-1',), seed = 0, **kwargs):
+    
+    rng = random.Random(seed)
+    snapshot = {'Regions': {}}
+    for n, region_name in enumerate(regions):
+        snapshot['Regions'][region_name] = generate_region(region_name, ec2Count // len(regions), rdsCount // len(regions), rng,
+                                                           offset = n * (ec2Count + rdsCount), **kwargs)
+    return snapshot
+
+# Function to generate a fleet snapshot of several accounts: the function's own account and accounts - 1 other accounts
+# (IDs 100000000001, 100000000002, ...), each with a fleet of the given size
+def generate_accounts(accounts, ec2Count, rdsCount = 0, regions = ('eu-west-1',), seed = 0, **kwargs):
+    
+    snapshot = generate_fleet(ec2Count, rdsCount, regions, seed, **kwargs)
+    snapshot['Accounts'] = {}
+    for n in range(1, accounts):
+        snapshot['Accounts']['%012d' % (100000000000 + n)] = generate_fleet(ec2Count, rdsCount, regions, seed + n, **kwargs)
+    return snapshot
+
+if __name__ == '__main__':
+    
+    ec2Count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rdsCount = int(sys.argv[2]) if len(sys.argv) > 2 else ec2Count // 10
+    regions = sys.argv[3].split(',') if len(sys.argv) > 3 else ['eu-west-1']
+    json.dump(generate_fleet(ec2Count, rdsCount, regions), sys.stdout)
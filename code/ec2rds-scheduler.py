@@ -11,203 +11,2051 @@
 #  and limitations under the License.                                                                                #
 ######################################################################################################################
 
-import boto3
 import time
+initStarted = time.time()
+
+import boto3
+import calendar
+import json
 import datetime
+import math
 import re
-import pytz
-from collections import defaultdict
-
-# Function to push CloudWatch metrics
-def putCloudWatchMetric(region, instance_id, instance_state):
-    
-    cw = boto3.client('cloudwatch')
-    
-    cw.put_metric_data(
-        Namespace='EC2RDSScheduler',
-        MetricData=[{
-            'MetricName': instance_id,
-            'Value': instance_state,
-
-            'Unit': 'Count',
-            'Dimensions': [
-                {
-                    'Name': 'Region',
-                    'Value': region
-                }
-            ]
-        }]
+import threading
+import zlib
+import fleetsnapshot
+import governor
+import instrumentation
+import inventorystore
+import runlog
+import tzresolver
+from collections import defaultdict, namedtuple
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of regions processed concurrently
+defaultRegionConcurrency = 8
+
+# Connections per client, enough for the concurrent calls made in a region
+clientPoolSize = 16
+
+# Number of invocations of this Lambda container
+invocations = 0
+
+# Number of instances per describe_instances page (maximum of the API)
+describeInstancesPageSize = 1000
+
+# Tag handing unfinished ASG actions over to the next run
+asgHandoffTagName = 'scheduler:asg-handoff'
+
+# Delay between two checks of the ASG instances (doubled up to asgWaitMaxDelay) and default time to wait for them
+asgWaitDelay = 2
+asgWaitMaxDelay = 16
+defaultASGWaitTimeout = 60
+
+# Number of instances per start_instances/stop_instances call and calls made concurrently per region
+ec2ActionChunkSize = 100
+ec2ActionConcurrency = 4
+
+# Error codes of throttled API calls
+throttlingErrorCodes = instrumentation.throttlingErrorCodes
+
+# RDS start/stop calls made concurrently per region (their rate is the one of RDS in governor.serviceRates)
+rdsActionConcurrency = 8
+
+# Retries of a throttled or failed API call, made by botocore (standard mode: exponential backoff with full jitter up to
+# 20 seconds), the scheduler doesn't retry calls itself
+apiRetries = 5
+
+# Number of data points per put_metric_data request (maximum of the API)
+metricBatchSize = 1000
+
+# Thread-local log buffer (runlog.RegionLog), so the output of a region stays in one block while regions run concurrently
+regionLog = threading.local()
+
+# Thread-local account of the region being processed (None for the account of the Lambda function)
+regionAccount = threading.local()
+
+# Function to write a log line, buffered per region if a region is being processed
+def log(*args):
+    
+    buffer = getattr(regionLog, 'buffer', None)
+    
+    if buffer is None:
+        print (*args)
+    else:
+        buffer.write(' '.join(str(a) for a in args))
+
+# Function to write a detail line about a resource, counted by kind (e.g. Start) and only written if the resource is in
+# the sample of the log (see runlog)
+def log_detail(kind, resource, *args):
+    
+    buffer = getattr(regionLog, 'buffer', None)
+    
+    if buffer is None:
+        if runlog.sampled(resource):
+            print (*args)
+    else:
+        buffer.detail(kind, resource, args)
+
+# Function to start a phase (ec2, rds) in the log of the region
+def log_phase(name):
+    
+    buffer = getattr(regionLog, 'buffer', None)
+    if buffer is not None:
+        buffer.phase(name)
+
+# Set keeping the insertion order of its items, with O(1) add, membership and removal
+class OrderedSet(object):
+    
+    def __init__(self, items = ()):
+        self.items = dict.fromkeys(items)
+        
+    def add(self, item):
+        self.items[item] = None
+        
+    def discard(self, item):
+        self.items.pop(item, None)
+        
+    def update(self, items):
+        for item in items:
+            self.items[item] = None
+            
+    def difference_update(self, items):
+        for item in items:
+            self.items.pop(item, None)
+            
+    def __contains__(self, item):
+        return item in self.items
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __repr__(self):
+        return 'OrderedSet(%r)' % list(self.items)
+
+# Action plan of a region: the instances, ASG members and RDS instances/clusters to start/stop and their metrics
+class ActionPlan(object):
+    
+    def __init__(self, region_name, account = None):
+        self.region_name = region_name
+        self.account = account
+        self.target = target_name(account, region_name)
+        
+        # EC2
+        self.startList = OrderedSet()
+        self.stopList = OrderedSet()
+        self.metricUpList = OrderedSet()
+        self.metricDownList = OrderedSet()
+        
+        # ASG -> instances
+        self.InServiceList = defaultdict(OrderedSet)
+        self.StandbyList = defaultdict(OrderedSet)
+        
+        # ASG instances handed over to the next run
+        self.asgHandoffs = OrderedSet()
+        
+        # RDS
+        self.rdsStartList = OrderedSet()
+        self.rdsStopList = OrderedSet()
+        self.rdsClusterStartList = OrderedSet()
+        self.rdsClusterStopList = OrderedSet()
+        self.rdsMetricUpList = OrderedSet()
+        self.rdsMetricDownList = OrderedSet()
+        
+        # Resources whose action failed -> action and error
+        self.failed = {}
+        
+        # Resources (clusters as cluster:<identifier>) -> forecast running hours in the month, if Forecast is Yes
+        self.forecast = {}
+        
+        # Phases deferred to the next invocation (see regionPhases), merged by the coordinator: [phases, partition] of
+        # every deferred shard
+        self.deferred = []
+        
+        # Metric lists left out of the plan of a shard (too large to return), the metric states are incomplete
+        self.trimmed = False
+        
+    # Function to record the resources that failed an action, failed is a dict resource -> error
+    def add_failures(self, action, failed):
+        
+        for resource, error in failed.items():
+            self.failed[resource] = {
+                'Action': action,
+                'Error': error
+            }
+            
+    # Function to get the plan as dict of lists, e.g. to log or diff it as JSON
+    def to_dict(self):
+        
+        return {
+            'Region': self.region_name,
+            'Account': self.account,
+            'EC2': {
+                'Start': list(self.startList),
+                'Stop': list(self.stopList),
+                'MetricUp': list(self.metricUpList),
+                'MetricDown': list(self.metricDownList)
+            },
+            'ASG': {
+                'InService': dict((asg, list(instances)) for asg, instances in self.InServiceList.items()),
+                'Standby': dict((asg, list(instances)) for asg, instances in self.StandbyList.items()),
+                'Handoff': list(self.asgHandoffs)
+            },
+            'RDS': {
+                'Start': list(self.rdsStartList),
+                'Stop': list(self.rdsStopList),
+                'ClusterStart': list(self.rdsClusterStartList),
+                'ClusterStop': list(self.rdsClusterStopList),
+                'MetricUp': list(self.rdsMetricUpList),
+                'MetricDown': list(self.rdsMetricDownList)
+            },
+            'Failed': self.failed,
+            'Forecast': self.forecast
+        }
+    
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+    
+    # Function to add the lists of a plan document (see to_dict), e.g. of a shard of the region
+    def merge(self, document):
+        
+        self.startList.update(document['EC2']['Start'])
+        self.stopList.update(document['EC2']['Stop'])
+        self.metricUpList.update(document['EC2']['MetricUp'])
+        self.metricDownList.update(document['EC2']['MetricDown'])
+        for asg, instances in document['ASG']['InService'].items():
+            self.InServiceList[asg].update(instances)
+        for asg, instances in document['ASG']['Standby'].items():
+            self.StandbyList[asg].update(instances)
+        self.asgHandoffs.update(document['ASG']['Handoff'])
+        self.rdsStartList.update(document['RDS']['Start'])
+        self.rdsStopList.update(document['RDS']['Stop'])
+        self.rdsClusterStartList.update(document['RDS']['ClusterStart'])
+        self.rdsClusterStopList.update(document['RDS']['ClusterStop'])
+        self.rdsMetricUpList.update(document['RDS']['MetricUp'])
+        self.rdsMetricDownList.update(document['RDS']['MetricDown'])
+        self.failed.update(document['Failed'])
+        self.forecast.update(document.get('Forecast', {}))
+        
+    # Function to count the resources started and stopped by the plan
+    def action_counts(self):
+        
+        started = len(self.startList) + len(self.rdsStartList) + len(self.rdsClusterStartList)
+        stopped = len(self.stopList) + len(self.rdsStopList) + len(self.rdsClusterStopList)
+        return started, stopped
+    
+    # Function to get the resources up (running/available) and down (stopped) once the plan is executed
+    def metric_states(self):
+        
+        up = list(self.metricUpList) + list(self.startList) + list(self.rdsMetricUpList) + list(self.rdsStartList) + list(self.rdsClusterStartList)
+        down = list(self.metricDownList) + list(self.stopList) + list(self.rdsMetricDownList) + list(self.rdsStopList) + list(self.rdsClusterStopList)
+        return up, down
+
+# Region of an account (None for the account of the Lambda function)
+Target = namedtuple('Target', ['account', 'region_name'])
+
+# Function to get the name of a region of an account, e.g. eu-west-1 or 123456789012:eu-west-1
+def target_name(account, region_name):
+    
+    return region_name if account is None else '%s:%s' % (account, region_name)
+
+# Clients by (service, region, endpoint, account, access key, read timeout), created on first use and reused by all
+# regions and warm invocations
+clients = {}
+clientsLock = threading.Lock()
+clientSession = None
+
+# Roles of the accounts to operate in, by account ID
+accountRoles = {}
+
+# Default name of the role entered in the accounts
+defaultAccountRoleName = 'EC2RDS-Scheduler'
+
+# Credentials of the accounts by account ID, kept until credentialsRenewal seconds before they expire, and the locks
+# that let one thread per account assume its role (created under accountLocksLock)
+accountCredentials = {}
+accountLocks = {}
+accountLocksLock = threading.Lock()
+credentialsRenewal = 600
+
+# Endpoint of the clients (None for the AWS endpoints), e.g. a stubbed endpoint to test against
+endpointUrl = None
+
+# Recorded fleet snapshot answering the describe calls instead of AWS (None to use AWS), and snapshots loaded by path
+fleetSnapshot = None
+fleetSnapshots = {}
+
+# Clients created and time spent creating them in the current invocation
+clientStats = {'created': 0, 'seconds': 0.0}
+
+# Function to get the client of a service in a region (None for the region of the Lambda function), in the account of
+# the region being processed
+def get_client(service, region_name = None):
+    
+    account = getattr(regionAccount, 'account', None)
+    
+    # Snapshot clients are read-only views of the snapshot (or of the account in it), they are cheap and not kept
+    if fleetSnapshot is not None:
+        snapshot = fleetSnapshot if account is None else fleetSnapshot.get('Accounts', {}).get(account, {'Regions': {}})
+        return fleetsnapshot.SnapshotClient(service, region_name, snapshot)
+    
+    credentials = None if account is None else account_credentials(account)
+    return cached_client(service, region_name, account, credentials)
+
+# Function to get the client of a service in a region with the credentials of an account (None for the function's own)
+def cached_client(service, region_name, account, credentials):
+    
+    global clientSession
+    
+    # Worker invocations time out with the invocation, in whole seconds so warm invocations mostly reuse the client
+    readTimeout = int(math.ceil(invocationSeconds)) if service == 'lambda' else None
+    key = (service, region_name, endpointUrl, account, credentials and credentials['AccessKeyId'], readTimeout)
+    client = clients.get(key)
+    if client is None:
+        # Boto3 sessions are not thread safe, clients are created one at a time
+        with clientsLock:
+            client = clients.get(key)
+            if client is None:
+                started = time.time()
+                if clientSession is None:
+                    clientSession = boto3.session.Session()
+                kwargs = {}
+                if credentials is not None:
+                    kwargs = {
+                        'aws_access_key_id': credentials['AccessKeyId'],
+                        'aws_secret_access_key': credentials['SecretAccessKey'],
+                        'aws_session_token': credentials['SessionToken']
+                    }
+                config = Config(max_pool_connections = clientPoolSize, retries = {'mode': 'standard', 'max_attempts': apiRetries})
+                # Worker invocations without retries, which would run a shard twice (the client of another timeout is dropped)
+                if service == 'lambda':
+                    config = config.merge(Config(read_timeout = readTimeout, retries = {'max_attempts': 0}))
+                    for k in [k for k in clients if k[:5] == key[:5]]:
+                        del clients[k]
+                client = clientSession.client(service, region_name = region_name, endpoint_url = endpointUrl, config = config, **kwargs)
+                instrumentation.attach(client)
+                governor.attach(client, account)
+                clients[key] = client
+                clientStats['created'] += 1
+                clientStats['seconds'] += time.time() - started
+    return client
+
+# Function to get the credentials of an account, the role of the account is assumed once per account and again
+# before the credentials expire (the clients of expired credentials are dropped)
+def account_credentials(account):
+    
+    credentials = accountCredentials.get(account)
+    if credentials is not None and credentials['Expires'] > time.time() + credentialsRenewal:
+        return credentials
+    
+    lock = accountLocks.get(account)
+    if lock is None:
+        with accountLocksLock:
+            lock = accountLocks.setdefault(account, threading.Lock())
+            
+    with lock:
+        credentials = accountCredentials.get(account)
+        if credentials is None or credentials['Expires'] <= time.time() + credentialsRenewal:
+            sts = cached_client('sts', None, None, None)
+            response = sts.assume_role(RoleArn = accountRoles[account], RoleSessionName = 'EC2RDS-Scheduler')['Credentials']
+            credentials = {
+                'AccessKeyId': response['AccessKeyId'],
+                'SecretAccessKey': response['SecretAccessKey'],
+                'SessionToken': response['SessionToken'],
+                'Expires': calendar.timegm(response['Expiration'].utctimetuple())
+            }
+            with clientsLock:
+                for key in [k for k in clients if k[3] == account]:
+                    del clients[key]
+            accountCredentials[account] = credentials
+            log ('** Assumed role', accountRoles[account])
+    return credentials
+
+# Function to wrap func so it writes to the log buffer (and uses the account) of the current region when it runs in another thread
+def with_region_log(func):
+    
+    buffer = getattr(regionLog, 'buffer', None)
+    account = getattr(regionAccount, 'account', None)
+    
+    def run(*args):
+        regionLog.buffer = buffer
+        regionAccount.account = account
+        try:
+            return func(*args)
+        finally:
+            regionLog.buffer = None
+            regionAccount.account = None
+            
+    return run
+
+# Buffer of the CloudWatch metrics of a region, sent with one client in batches of metricBatchSize data points as they fill
+class MetricBuffer(object):
+    
+    def __init__(self, region_name):
+        self.region_name = region_name
+        self.cw = get_client('cloudwatch', region_name)
+        self.metricData = []
+        self.sent = 0
+        self.requests = 0
+        self.retried = 0
+        self.dropped = 0
+        
+    # Function to add the state of an instance (1 running, 0 stopped)
+    def put(self, instance_id, instance_state):
+        
+        # One metric per instance, named after the instance
+        if metricLayout == 'MetricPerInstance':
+            self.metricData.append({
+                'MetricName': instance_id,
+                'Value': instance_state,
+                'Unit': 'Count',
+                'Dimensions': [
+                    {
+                        'Name': 'Region',
+                        'Value': self.region_name
+                    }
+                ]
+            })
+            
+        # One metric for all instances, with the instance as dimension
+        else:
+            self.metricData.append({
+                'MetricName': 'InstanceState',
+                'Value': instance_state,
+                'Unit': 'Count',
+                'Dimensions': [
+                    {
+                        'Name': 'Region',
+                        'Value': self.region_name
+                    },
+                    {
+                        'Name': 'InstanceId',
+                        'Value': instance_id
+                    }
+                ]
+            })
+            
+        # Full batches are sent right away, the buffer never holds more than one batch
+        if len(self.metricData) >= metricBatchSize:
+            self.send()
+            
+    # Function to send the buffered metrics, a batch that still fails after the retries of botocore is dropped. Retries
+    # are the attempts beyond the first of every request, like in the API statistics of the run
+    def send(self):
+        
+        for n in range(0, len(self.metricData), metricBatchSize):
+            batch = self.metricData[n:n + metricBatchSize]
+            
+            self.requests += 1
+            try:
+                response = self.cw.put_metric_data(Namespace='EC2RDSScheduler', MetricData=batch)
+                self.sent += len(batch)
+            except Exception as e:
+                log ('**** |--> Dropping', len(batch), 'metrics:', e)
+                self.dropped += len(batch)
+                response = getattr(e, 'response', None) or {}
+            self.retried += response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            
+        self.metricData = []
+        
+    # Function to send the remaining metrics and log the totals of the region
+    def flush(self):
+        
+        self.send()
+        log ('**** CloudWatch metrics:', self.sent, 'sent in', self.requests, 'requests,', self.retried, 'retries,', self.dropped, 'dropped')
+
+# Weekdays Interpreter
+weekdays = ['mon', 'tue', 'wed', 'thu', 'fri']
+
+# Monthdays Interpreter (1..31)
+monthdays = re.compile(r'^(0?[1-9]|[12]\d|3[01])$')
+
+# nth weekdays Interpreter
+nthweekdays = re.compile(r'\w{3}/\d{1}')
+
+# Compiled tag value: times, time zone and active days, see compile_schedule
+Schedule = namedtuple('Schedule', ['tagValue', 'fixedAction', 'startTime', 'stopTime', 'tz', 'isValidTimeZone', 'daysActive', 'dayNames', 'monthDays', 'nthWeekdays'])
+
+# Names of the weekdays in tag values, by datetime.weekday()
+weekdayNames = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Minutes of a day, the bits of a day timeline
+dayMinutes = 1440
+
+# Current time in a time zone, see local_time: local date, minute of the day and the run window as (date, bitset of the
+# minutes) of the day and of the day before if the window starts before midnight
+LocalTime = namedtuple('LocalTime', ['date', 'minute', 'windows'])
+
+# START and STOP times of a tag value on a local date as bitsets, bit m is minute m of the day, see day_timeline
+DayTimeline = namedtuple('DayTimeline', ['start', 'stop'])
+
+# Days before the month looked at for the last START/STOP, the state at the start of a forecast month
+forecastLookbackDays = 62
+
+# Per-invocation caches of compiled tag values, local times, day timelines, actions and forecasts (reset by lambda_handler)
+compiledSchedules = {}
+localTimes = {}
+dayTimelines = {}
+scheduleActions = {}
+forecasts = {}
+
+# Transition index of the last full discovery (kept by warm containers): configuration, tag values found, timestamp,
+# whether anything is pending and the metric states of the regions
+transitionIndex = {}
+
+# Default minutes after which a run always does a full discovery, even if no known tag value has a transition
+defaultFullDiscoveryInterval = 60
+
+# Store keeping the inventory of the regions and the transition index between runs (None to keep nothing)
+inventoryStore = None
+
+# Deadline of the invocation (timestamp) from the remaining time of the Lambda context or the TimeBudget of the event,
+# None without either. deadlineReserve seconds of the invocation are kept to store the checkpoint and report the run
+runDeadline = None
+deadlineReserve = 10
+
+# Default seconds a region (or its RDS phase) needs at least, it is deferred to the next invocation if less are left
+defaultRegionBudget = 30
+regionBudget = defaultRegionBudget
+
+# Phases of a region, a deferred region is resumed with the phases it didn't run
+regionPhases = ('ec2', 'rds')
+
+# Store of the checkpoint without InventoryStore, kept by warm containers only
+memoryStore = inventorystore.MemoryStore()
+
+# Seconds after which deferred regions aren't resumed anymore, later runs have decided their resources since
+checkpointMaxAge = 3600
+
+# Owner of the leases of the regions processed by this run and their expiry (the end of the invocation). Invocations
+# without a deadline hold them for the maximum duration of an invocation
+runId = None
+leaseExpires = None
+maxInvocationSeconds = 900
+
+# Shard of a worker invocation (None if the invocation processes whole regions): account, region, partition and number of
+# partitions. Resources are partitioned by a hash of their ID (ASG members by ASG, cluster members by cluster) or of their tag value
+shard = None
+shardPartitioning = 'id'
+
+# Default number of times the coordinator retries failed shards
+defaultShardRetries = 2
+
+# Bytes of the plan of a shard returned to the coordinator at most (the response of an invocation is limited to 6 MB).
+# With InventoryStore plans are stored instead, larger ones are returned without their metric lists
+shardPlanMaxBytes = 4 * 1024 * 1024
+
+# Seconds of a worker invocation the coordinator keeps to invoke it and to get its result, a worker gets the time left
+# to the deadline of the coordinator less shardInvokeMargin as TimeBudget
+shardInvokeMargin = 5
+
+# Seconds of the invocation (up to the timeout of the function), a worker invocation that hasn't returned after them
+# doesn't return to this invocation anymore
+invocationSeconds = maxInvocationSeconds
+
+# Function to check if a resource (ID, or tag value if partitioned by tag value) belongs to the shard of this invocation
+def in_shard(resource, tagValue = None):
+    
+    if shard is None:
+        return True
+    key = tagValue if shardPartitioning == 'tag' and tagValue is not None else resource
+    return zlib.crc32(key.encode()) % shard['Partitions'] == shard['Partition']
+
+# Function to parse a tag value once into a Schedule
+def compile_schedule(tagValue):
+    
+    if tagValue in compiledSchedules:
+        return compiledSchedules[tagValue]
+    
+    # Set default values
+    fixedAction = None
+    isValidTimeZone = True
+    
+    # Get tag values
+    ptag = tagValue.replace(';',':').split(':')
+    
+    # Get default time values
+    startTime = defaultStartTime
+    stopTime = defaultStopTime
+    timeZone = defaultTimeZone
+    daysActive = defaultDaysActive
+    
+    # Check if tag is empty or none
+    if (ptag[0] == '' or ptag[0] == 'none') and len(ptag) == 1:
+        fixedAction = 'None'
+        
+    # Get startTime
+    if len(ptag) >= 1:
+        # Check for default values
+        if ptag[0].lower() not in ('default', 'true'):
+            startTime = ptag[0]
+            # Clear default stopTime if stopTime it's not defined in tag
+            if len(ptag) == 1:
+                stopTime = ''
+                
+    # Support 24x7
+    if startTime == '24x7' and fixedAction is None:
+        fixedAction = 'START'
+        
+    # Get stopTime
+    if len(ptag) >= 2:
+        stopTime = ptag[1]
+        
+    # Default Timzone (not case sensitive)
+    tz = tzresolver.get_ignoring_case(defaultTimeZone)
+    if tz is None:
+        raise ValueError('Invalid default time zone: ' + defaultTimeZone)
+    
+    # Get timezone
+    if len(ptag) >= 3:
+        #Timezone is case senstive (except utc)
+        timeZone = ptag[2]
+        # timeZone is not empty and not DefaultTimeZone
+        if timeZone != defaultTimeZone and timeZone != '':
+            if tzresolver.get(timeZone) is not None:
+                tz = tzresolver.get(timeZone)
+            # No action if timeZone is not supported
+            elif fixedAction is None:
+                log ('Invalid time zone :', timeZone)
+                isValidTimeZone = False
+                
+    # Get active days
+    if len(ptag) >= 4:
+        daysActive = ptag[3].lower()
+        
+    # Index the specific days: weekdays (mon), month days (15) and nth weekdays (mon/1)
+    dayNames = set()
+    monthDays = set()
+    nthWeekdays = set()
+    for d in daysActive.split(','):
+        dayNames.add(d.lower())
+        if monthdays.match(d):
+            monthDays.add(int(d))
+        elif nthweekdays.match(d):
+            (weekday,nthweek) = d.split('/')[:2]
+            if nthweek.isdigit():
+                nthWeekdays.add((weekday.lower(), int(nthweek)))
+                
+    compiled = Schedule(tagValue, fixedAction, startTime, stopTime, tz, isValidTimeZone, daysActive, frozenset(dayNames), frozenset(monthDays), frozenset(nthWeekdays))
+    compiledSchedules[tagValue] = compiled
+    return compiled
+
+# Function to get the bitset of the minutes first to last of a day
+def minute_mask(first, last):
+    
+    return ((1 << (last - first + 1)) - 1) << first
+
+# Function to get the bit of a time value (HHMM) in a day timeline, 0 for anything else (e.g. none)
+def minute_bit(value):
+    
+    if len(value) != 4 or not value.isdigit() or value[:2] > '23' or value[2:] > '59':
+        return 0
+    return 1 << (int(value[:2]) * 60 + int(value[2:]))
+
+# Function to get the time values of the run's timestamp (or of the timestamp at) in a time zone
+def local_time(tz, at = None):
+    
+    if at is None:
+        if tz not in localTimes:
+            localTimes[tz] = local_time(tz, timestamp)
+        return localTimes[tz]
+    
+    # Get datetime
+    datetimevalue = datetime.datetime.fromtimestamp(at, tz)
+    date = datetimevalue.date()
+    minute = datetimevalue.hour * 60 + datetimevalue.minute
+    
+    # The window covers the minutes now minus schedule plus 1min to now, at midnight it starts on the day before
+    first = minute - schedule + 1
+    if first >= 0:
+        windows = ((date, minute_mask(first, minute)),)
+    else:
+        windows = ((date - datetime.timedelta(days=1), minute_mask(dayMinutes + first, dayMinutes - 1)), (date, minute_mask(0, minute)))
+        
+    return LocalTime(date, minute, windows)
+
+# Function to check if a compiled tag value is active on a day (weekday name and day of the month)
+def is_active_day(compiled, dayName, day):
+    
+    # All days support
+    if compiled.daysActive == 'all':
+        return True
+    
+    # Weekdays support
+    if compiled.daysActive == 'weekdays':
+        return dayName in weekdays
+    
+    # Specific days support: mon,tue,wed,thu,fri,sat,sun, month days and nth weekdays
+    # (mon/1 first Monday of the month, tue/2 second Tuesday of the month, ...)
+    if dayName in compiled.dayNames or day in compiled.monthDays:
+        return True
+    for (weekday,nthweek) in compiled.nthWeekdays:
+        if (weekday == dayName) and (day >= (nthweek * 7 - 6)) and (day <= (nthweek * 7)):
+            return True
+    return False
+
+# Function to render the START and STOP times of a compiled tag value on a local date into a day timeline
+def day_timeline(compiled, date):
+    
+    key = (compiled.tagValue, date)
+    if key in dayTimelines:
+        return dayTimelines[key]
+    
+    startTime = compiled.startTime
+    stopTime = compiled.stopTime
+    dayName = weekdayNames[date.weekday()]
+    
+    # 24x5 support: started on Monday at the default start time, stopped on Friday at the default stop time
+    if startTime == '24x5':
+        isActiveDay = dayName in ('mon', 'fri')
+        if dayName == 'mon':
+            startTime = defaultStartTime
+            stopTime = 'none'
+        elif dayName == 'fri':
+            startTime = 'none'
+            stopTime = defaultStopTime
+    else:
+        isActiveDay = is_active_day(compiled, dayName, date.day)
+        
+    # Tag values with a fixed action or an invalid time zone have no times
+    timeline = DayTimeline(0, 0)
+    if isActiveDay and compiled.fixedAction is None and compiled.isValidTimeZone:
+        timeline = DayTimeline(minute_bit(startTime), minute_bit(stopTime))
+        
+    dayTimelines[key] = timeline
+    return timeline
+
+# Function to decide the action of a compiled tag value at a local time: the START/STOP bits of its day timelines in the window
+def schedule_action(compiled, localTime):
+    
+    if compiled.fixedAction is not None:
+        return compiled.fixedAction
+    
+    start = 0
+    stop = 0
+    for date, window in localTime.windows:
+        timeline = day_timeline(compiled, date)
+        start |= timeline.start & window
+        stop |= timeline.stop & window
+        
+    # If both START and STOP match, do noting
+    if start and stop:
+        log ('**** Tag with value', compiled.tagValue, 'is invalid (start- and stopTime fall in the same execution interval)')
+        return 'None'
+    if start:
+        return 'START'
+    if stop:
+        return 'STOP'
+    return 'None'
+
+# Function to interpret the tag of an instance and return the action to do
+# (tag values are compiled once and their action is memoized for the run's timestamp)
+def scheduler_action(tagValue):
+    
+    if tagValue not in scheduleActions:
+        compiled = compile_schedule(tagValue)
+        scheduleActions[tagValue] = schedule_action(compiled, local_time(compiled.tz))
+    return scheduleActions[tagValue]
+
+# Function to forecast the hours a resource with a tag value runs in the month of the run's timestamp (in the time zone
+# of the tag value), running is its current state. The state changes at the START/STOP times of the day timelines, at the
+# start of the month it is the one of the last START/STOP in the forecastLookbackDays before (else the current state)
+def forecast_hours(tagValue, running):
+    
+    key = (tagValue, running)
+    if key in forecasts:
+        return forecasts[key]
+    
+    compiled = compile_schedule(tagValue)
+    firstDay = local_time(compiled.tz).date.replace(day=1)
+    days = calendar.monthrange(firstDay.year, firstDay.month)[1]
+    
+    # 24x7 runs all month, none and untouched resources keep their state
+    if compiled.fixedAction == 'START':
+        minutes = days * dayMinutes
+    elif compiled.fixedAction is not None or not compiled.isValidTimeZone:
+        minutes = days * dayMinutes if running else 0
+    else:
+        # A START and a STOP at the same time cancel out, the highest bit is the last change of a day
+        for n in range(1, forecastLookbackDays + 1):
+            timeline = day_timeline(compiled, firstDay - datetime.timedelta(days=n))
+            changes = timeline.start ^ timeline.stop
+            if changes:
+                running = bool(timeline.start >> (changes.bit_length() - 1) & 1)
+                break
+                
+        minutes = 0
+        for n in range(days):
+            timeline = day_timeline(compiled, firstDay + datetime.timedelta(days=n))
+            changes = timeline.start ^ timeline.stop
+            since = 0
+            while changes:
+                bit = changes & -changes
+                minute = bit.bit_length() - 1
+                if running:
+                    minutes += minute - since
+                running = bool(timeline.start & bit)
+                since = minute
+                changes ^= bit
+            if running:
+                minutes += dayMinutes - since
+                
+    hours = round(minutes / 60.0, 2)
+    forecasts[key] = hours
+    return hours
+
+# Function to find the next START/STOP of tag values in the runs after the run's timestamp up to until, stepping the
+# run windows like the scheduled rule does. Returns tagValue -> (timestamp, action) for the tag values with a transition,
+# fixed actions (24x7, none) have none
+def next_transitions(tagValues, until):
+    
+    transitions = {}
+    
+    # Local times of the runs, shared by the tag values of a time zone
+    runTimes = {}
+    
+    for tagValue in tagValues:
+        compiled = compile_schedule(tagValue)
+        if compiled.fixedAction is not None:
+            continue
+        at = timestamp + schedule * 60
+        while at <= until:
+            if (compiled.tz, at) not in runTimes:
+                runTimes[(compiled.tz, at)] = local_time(compiled.tz, at)
+            action = schedule_action(compiled, runTimes[(compiled.tz, at)])
+            if action != 'None':
+                transitions[tagValue] = (at, action)
+                break
+            at += schedule * 60
+    return transitions
+
+# Function to check if a run can skip discovery, returns why it can't (None if it can). A run is idle if the last full
+# discovery with the same configuration is more recent than fullDiscoveryInterval, left nothing pending and none of the
+# tag values it found has an action in the window of this run
+def full_discovery_reason(config):
+    
+    if transitionIndex.get('Config') != config:
+        return 'no transition index for this configuration'
+    if timestamp - transitionIndex['FullDiscovery'] >= fullDiscoveryInterval * 60:
+        return 'last full discovery older than %d minutes' % fullDiscoveryInterval
+    if transitionIndex['Pending']:
+        return 'ASG handoffs or failed regions of the last full discovery pending'
+    for tagValue in transitionIndex['TagValues']:
+        if compile_schedule(tagValue).fixedAction is None and scheduler_action(tagValue) != 'None':
+            return 'tag value ' + tagValue + ' has a transition'
+    return None
+
+# Function to list the running and stopped instances carrying the scheduler tag, page by page
+def describe_tagged_instances(ec2_client):
+    
+    # Tag key and state are filtered by EC2, only tagged instances (or instances with an ASG handoff) are returned
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'tag-key',
+                'Values': [customTagName + '*', asgHandoffTagName]
+            },
+            {
+                'Name': 'instance-state-name',
+                'Values': ['running', 'stopped']
+            }
+        ],
+        PaginationConfig={'PageSize': describeInstancesPageSize}
     )
+    
+    # Only keep the fields the scheduler needs (values of the scheduler tags, ASG handoff), so no page is kept in memory
+    tagLen = len(customTagName)
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                tagValues = []
+                handoff = None
+                for t in instance.get('Tags') or ():
+                    if t['Key'] == asgHandoffTagName:
+                        handoff = t['Value']
+                    elif t['Key'][:tagLen] == customTagName:
+                        tagValues.append(t['Value'])
+                yield instance['InstanceId'], instance['State']['Name'], tuple(tagValues), handoff
+
+# ASG membership of an instance
+AsgMember = namedtuple('AsgMember', ['asg', 'lifecycleState'])
+
+# Function to index all ASG instances of a region by instance, only ASG name and lifecycle state are kept
+def describe_asg_members(aws_scaling_client):
+    
+    asgmembers = {}
+    paginator = aws_scaling_client.get_paginator('describe_auto_scaling_instances')
+    for page in paginator.paginate():
+        for j in page['AutoScalingInstances']:
+            asgmembers[j['InstanceId']] = AsgMember(j['AutoScalingGroupName'], j['LifecycleState'])
+    return asgmembers
+
+# Function to get ASGs by name, with one describe_auto_scaling_groups call per 100 ASGs
+def describe_asgs(aws_scaling_client, names):
+    
+    asgs = {}
+    paginator = aws_scaling_client.get_paginator('describe_auto_scaling_groups')
+    for n in range(0, len(names), 100):
+        for page in paginator.paginate(AutoScalingGroupNames=names[n:n + 100]):
+            for asg in page['AutoScalingGroups']:
+                asgs[asg['AutoScalingGroupName']] = asg
+    return asgs
+
+# Function to wait until instances are running (pendingRunning) or in standby (pendingStandby), both dicts of instance -> ASG
+# All pending instances are polled with one batched call per state, with exponential backoff until asgWaitTimeout.
+# Returns the instances that got there, the others are left in pendingRunning/pendingStandby
+def wait_for_asg_instances(ec2_client, aws_scaling_client, pendingRunning, pendingStandby):
+    
+    running = {}
+    standby = {}
+    deadline = time.time() + asgWaitTimeout
+    delay = asgWaitDelay
+    
+    # Instances not ready before the end of the budget of the invocation are handed over like the ones that time out
+    if runDeadline is not None:
+        deadline = min(deadline, runDeadline - regionBudget)
+    
+    while True:
+        # The describe calls of the polling give way to the start/stop actions of the region
+        with governor.priority('polling'):
+            # Instances that must be running before they are put in service
+            pending = list(pendingRunning)
+            for n in range(0, len(pending), 200):
+                result = ec2_client.describe_instances(Filters=[{'Name': 'instance-id', 'Values': pending[n:n + 200]}])
+                for reservation in result['Reservations']:
+                    for instance in reservation['Instances']:
+                        if instance['State']['Name'] == 'running' and instance['InstanceId'] in pendingRunning:
+                            running[instance['InstanceId']] = pendingRunning.pop(instance['InstanceId'])
+                            
+            # Instances that must be in standby before they are stopped
+            pending = list(pendingStandby)
+            for n in range(0, len(pending), 50):
+                result = aws_scaling_client.describe_auto_scaling_instances(InstanceIds=pending[n:n + 50])
+                for instance in result['AutoScalingInstances']:
+                    if instance['LifecycleState'] == 'Standby' and instance['InstanceId'] in pendingStandby:
+                        standby[instance['InstanceId']] = pendingStandby.pop(instance['InstanceId'])
+                        
+        if not (pendingRunning or pendingStandby) or time.time() + delay > deadline:
+            return running, standby
+        
+        log ('**** |----> Waiting', delay, 's for', len(pendingRunning), 'instances to enter running state and', len(pendingStandby), 'instances to enter standby state')
+        time.sleep(delay)
+        delay = min(delay * 2, asgWaitMaxDelay)
+
+# Function to set or remove the tag that hands an unfinished ASG action (InService or Standby) over to the next run
+def tag_asg_handoff(ec2_client, instances, handoff):
+    
+    for n in range(0, len(instances), 1000):
+        if handoff is None:
+            ec2_client.delete_tags(Resources=instances[n:n + 1000], Tags=[{'Key': asgHandoffTagName}])
+        else:
+            ec2_client.create_tags(Resources=instances[n:n + 1000], Tags=[{'Key': asgHandoffTagName, 'Value': handoff}])
+
+# Function to start/stop instances (action start_instances or stop_instances) in chunks of ec2ActionChunkSize,
+# ec2ActionConcurrency chunks at a time. A chunk that fails is split in halves until the failing instances are isolated.
+# Returns the instances that failed with their error, the others succeeded
+def execute_ec2_action(ec2, action, instances):
+    
+    call = getattr(ec2, action)
+    
+    # Function to run the action for a chunk, bisecting it on failure
+    def run(chunk):
+        
+        try:
+            call(InstanceIds=chunk)
+            return {}
+        except Exception as e:
+            # Bisecting doesn't help if the call is still throttled after its retries or only a single instance is left
+            errorCode = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if len(chunk) == 1 or errorCode in throttlingErrorCodes:
+                log ('**** |-->', action, 'failed for', ', '.join(chunk), ':', e)
+                return dict.fromkeys(chunk, str(e))
+            failed = run(chunk[:len(chunk) // 2])
+            failed.update(run(chunk[len(chunk) // 2:]))
+            return failed
+        
+    chunks = [instances[n:n + ec2ActionChunkSize] for n in range(0, len(instances), ec2ActionChunkSize)]
+    failed = {}
+    with ThreadPoolExecutor(max_workers = min(ec2ActionConcurrency, len(chunks))) as executor:
+        for result in executor.map(with_region_log(run), chunks):
+            failed.update(result)
+    return failed
+
+# Function to start/stop the EC2 instances (and put ASG members in service/to standby) of a region
+def process_ec2(region_name, plan, inventory = None):
+    
+    # Lists and dicts of the action plan
+    startList = plan.startList
+    stopList = plan.stopList
+    InServiceList = plan.InServiceList
+    StandbyList = plan.StandbyList
+    metricUpList = plan.metricUpList
+    metricDownList = plan.metricDownList
+    
+    # ASG actions handed over by a previous run: instance -> InService/Standby
+    handoffs = {}
+    
+    log_phase('ec2')
+    
+    # Connection to the EC2 using Boto3 client interface
+    ec2 = get_client('ec2', region_name)
+    
+    # List the tagged instances
+    instances = describe_tagged_instances(ec2)
+    
+    if ASGSupport == 'Yes':
+        # Connection to Autoscaling using Boto3 client interface
+        aws_scaling_client = get_client('autoscaling', region_name)
+        
+        # Index all instances in ASGs by instance
+        with instrumentation.Phase(plan.target, 'discovery'):
+            asgmembers = describe_asg_members(aws_scaling_client)
+            
+    log ('*** Populate EC2 lists')
+    
+    # Decisions, without the time spent fetching the pages of instances
+    decisionPhase = instrumentation.Phase(plan.target, 'decision')
+    
+    for instance_id, state, tagValues, handoff in instrumentation.timed(instances, plan.target, 'discovery'):
+        # Members of an ASG belong to the shard of the ASG, also when partitioned by tag value, so a single worker checks the
+        # standby capacity of the ASG
+        if shard is not None:
+            shardKey = instance_id
+            shardTag = True
+            if ASGSupport == 'Yes' and instance_id in asgmembers:
+                shardKey = asgmembers[instance_id].asg
+                shardTag = False
+                
+        # Only running instances can still be put in service or to standby (instances of other shards are left to their workers)
+        if handoff is not None and (shard is None or in_shard(shardKey)):
+            handoffs[instance_id] = handoff if state == 'running' else 'None'
+            
+        # Instances of other shards are left to their workers
+        if shard is not None:
+            tagValues = [tagValue for tagValue in tagValues if in_shard(shardKey, tagValue if shardTag else None)]
+            
+        # One record per instance, with all its tag values
+        if inventory is not None and tagValues:
+            inventory.see(instance_id, tagValues, state, inventorystore.fingerprint(tagValues, state, ASGSupport == 'Yes' and instance_id in asgmembers))
+                    
+        for tagValue in tagValues:
+                    
+            # Add instances to correct metricList
+            if createMetrics == 'Yes':
+                if state == 'running':
+                    metricUpList.add(instance_id)
+                if state == 'stopped':
+                    metricDownList.add(instance_id)
+                    
+            # Get action for instance
+            action = scheduler_action(tagValue = tagValue)
+                            
+            if createForecast == 'Yes' and instance_id not in plan.forecast:
+                plan.forecast[instance_id] = forecast_hours(tagValue, state == 'running')
+                    
+            # Append to start list
+            if action == 'START' and state == 'stopped':
+                if inventory is not None and inventory.issued(instance_id, 'START'):
+                    log_detail ('AlreadyStarted', instance_id, '****', instance_id, 'with tag', tagValue, 'was already started in this window')
+                elif instance_id not in startList:
+                    startList.add(instance_id)
+                    log_detail ('Start', instance_id, '****', instance_id, 'with tag', tagValue, 'added to START list')
+                        
+                    if ASGSupport == 'Yes':
+                        # Check if instance is in ASG
+                        if instance_id in asgmembers:
+                            asg = asgmembers[instance_id].asg
+                            log_detail ('InService', instance_id, '**** |--> is member of ASG ', asg, '--> added to INSERVICE list')
+                            InServiceList[asg].add(instance_id)
+                            
+                # Instance Id already in startList
+                                        
+            # Append to stop list
+            if action == 'STOP' and state == 'running':
+                if inventory is not None and inventory.issued(instance_id, 'STOP'):
+                    log_detail ('AlreadyStopped', instance_id, '****', instance_id, 'with tag', tagValue, 'was already stopped in this window')
+                elif instance_id not in stopList:
+                    stopList.add(instance_id)
+                    log_detail ('Stop', instance_id, '****', instance_id, 'with tag', tagValue, 'added to STOP list')
+                        
+                    if ASGSupport == 'Yes':
+                        # Check if instance is in ASG
+                        if instance_id in asgmembers:
+                            asg = asgmembers[instance_id].asg
+                            log_detail ('Standby', instance_id, '**** |--> is member of ASG ', asg, '--> added to STANDBY list')
+                            StandbyList[asg].add(instance_id)
+                            
+                # Instance Id already in stopList
+                        
+    decisionPhase.stop()
+    
+    # In plan mode the lists are the plan, nothing is changed
+    if mode == 'plan':
+        log ('*** Plan mode, no EC2 actions executed')
+        return
+    
+    # Create buffer for the instances that need a metric update
+    if createMetrics == 'Yes':
+        metrics = MetricBuffer(region_name)
+        
+    log ('*** Execute EC2 actions')
+    
+    if startList or stopList or handoffs:
+        actionPhase = instrumentation.Phase(plan.target, 'action')
+        if startList:
+            log ('**** Starting', len(startList), 'instances:', ', '.join(startList))
+            failed = execute_ec2_action(ec2, 'start_instances', list(startList))
+            
+            # Remove instances that failed to start from startList and INSERVICE list
+            if failed:
+                log ('**** |--> Failed to start', len(failed), 'instances:', ', '.join(failed))
+                plan.add_failures('start_instances', failed)
+                startList.difference_update(failed)
+                for instances in InServiceList.values():
+                    instances.difference_update(failed)
+                    
+            if inventory is not None:
+                inventory.issue(startList, 'START')
+                
+            if createMetrics == 'Yes':
+                # Remove instances in startList from metricDownList
+                metricDownList.difference_update(startList)
+                # Post metrics for instances that were stopped
+                for i in startList:
+                    metrics.put(i, 1)
+        else:
+            log ('**** No Instances to start in region',  region_name)
+        actionPhase.stop()
+        
+        # Instances of finished Standby handoffs, their handoff is removed once they are stopped
+        standbyHandoffs = []
+        
+        asgPhase = instrumentation.Phase(plan.target, 'asg')
+        if ASGSupport == 'Yes':
+            # Instances that have to be running/in standby before their ASG action: instance -> ASG
+            pendingRunning = {}
+            pendingStandby = {}
+            staleHandoffs = set()
+            
+            # Pick up the ASG actions handed over by a previous run, drop the ones that no longer apply
+            if handoffs:
+                for i, handoff in handoffs.items():
+                    j = asgmembers.get(i)
+                    if j is None:
+                        staleHandoffs.add(i)
+                    elif handoff == 'InService' and j.lifecycleState == 'Standby':
+                        pendingRunning[i] = j.asg
+                    elif handoff == 'Standby' and j.lifecycleState in ('EnteringStandby', 'Standby'):
+                        pendingStandby[i] = j.asg
+                    else:
+                        staleHandoffs.add(i)
+                        
+                log ('**** Resuming', len(pendingRunning) + len(pendingStandby), 'ASG actions of a previous run:', ', '.join(list(pendingRunning) + list(pendingStandby)))
+                if staleHandoffs:
+                    log ('**** |--> Dropping stale ASG actions:', ', '.join(staleHandoffs))
+                    tag_asg_handoff(ec2, list(staleHandoffs), None)
+                    
+            if InServiceList:
+                # Loop through ASGs
+                for asg, instances in InServiceList.items():
+                    log_detail ('AsgPending', asg, '**** Putting', len(instances), 'instances in ASG', asg, 'in service once they are running:', ', '.join(instances))
+                    for i in instances:
+                        pendingRunning[i] = asg
+                        
+            else:
+                log ('**** No Instances to put in service in region',  region_name)
+                
+            if StandbyList:
+                # Get the capacities of all ASGs with instances to set to standby at once
+                asgs = describe_asgs(aws_scaling_client, list(StandbyList))
+                
+                # Loop through ASGs
+                for asg, instances in StandbyList.items():
+                    instances = list(instances)
+                    try:
+                        log_detail ('AsgStandby', asg, '**** Putting', len(instances), 'instances in ASG', asg, 'to standby:', ', '.join(instances))
+                        
+                        # Check maximum amount of instances that can be set to Standby depending on Min-Value of ASG
+                        desired = asgs[asg]['DesiredCapacity']
+                        min = asgs[asg]['MinSize']
+                        maxStandby = desired - min
+                        
+                        # If more instances than allowed are in StandbyList, remove them from StandbyList and stopList
+                        if maxStandby <= 0:
+                            log ('**** |--> ASG', asg, 'has values of Desired', desired, 'and Min', min, "--> Can't set any instances to standby")
+                            log ('**** |----> Removing instances from STANDBY and STOP lists:', ', '.join(instances))
+                            stopList.difference_update(instances)
+                            log ('**** Putting no instances in ASG', asg, 'to standby')
+                            continue
+                        
+                        elif len(instances) > maxStandby:
+                            log ('**** |--> ASG', asg, 'has values of Desired', desired, 'and Min', min, '--> Can set only', maxStandby, ' (Desired - Min) instances to standby')
+                            instancesToRemove = instances[maxStandby:]
+                            log ('**** |----> Removing excess instances from STANDBY and STOP lists:', ', '.join(instancesToRemove))
+                            instances = instances[:maxStandby]
+                            stopList.difference_update(instancesToRemove)
+                            log ('**** Putting only', len(instances), 'instances in ASG', asg, 'to standby:', ', '.join(instances))
+                            
+                        # Set instances to Standby
+                        aws_scaling_client.enter_standby(InstanceIds=instances, AutoScalingGroupName=asg, ShouldDecrementDesiredCapacity=True)
+                        
+                        # The instances are stopped once they are in standby
+                        stopList.difference_update(instances)
+                        for i in instances:
+                            pendingStandby[i] = asg
+                            
+                    except Exception as e:
+                        log ('**** |--> ASG', asg, ':', e)
+                        # Remove failed instances from stopList
+                        stopList.difference_update(instances)
+                        log ('**** |----> Removing instances from STOP list:', ', '.join(instances))
+                        
+            else:
+                log ('**** No Instances to put to standby in region', region_name)
+                
+            if pendingRunning or pendingStandby:
+                # Wait for all pending instances at once, bounded by asgWaitTimeout
+                running, standby = wait_for_asg_instances(ec2, aws_scaling_client, pendingRunning, pendingStandby)
+                
+                # Set running instances to InService
+                inService = defaultdict(list)
+                for i, asg in running.items():
+                    inService[asg].append(i)
+                for asg, instances in inService.items():
+                    try:
+                        log_detail ('AsgInService', asg, '**** Putting', len(instances), 'instances in ASG', asg, 'in service:', ', '.join(instances))
+                        aws_scaling_client.exit_standby(InstanceIds=instances, AutoScalingGroupName=asg)
+                    except Exception as e:
+                        log ('**** |--> ASG', asg, ':', e)
+                        # Retry in the next run
+                        pendingRunning.update((i, asg) for i in instances)
+                        
+                # Stop instances in standby
+                for i in standby:
+                    stopList.add(i)
+                        
+                # Hand the unfinished actions over to the next run instead of blocking the region
+                plan.asgHandoffs.update(pendingRunning)
+                plan.asgHandoffs.update(pendingStandby)
+                if pendingRunning:
+                    log ('**** |--> Instances not running in time, putting them in service in the next run:', ', '.join(pendingRunning))
+                    tag_asg_handoff(ec2, [i for i in pendingRunning if handoffs.get(i) != 'InService'], 'InService')
+                if pendingStandby:
+                    log ('**** |--> Instances not in standby in time, stopping them in the next run:', ', '.join(pendingStandby))
+                    tag_asg_handoff(ec2, [i for i in pendingStandby if handoffs.get(i) != 'Standby'], 'Standby')
+                    
+                # Remove the handoff of finished actions, the ones of instances in standby after they are stopped
+                finished = [i for i in handoffs if i not in pendingRunning and i not in pendingStandby and i not in staleHandoffs]
+                standbyHandoffs = [i for i in finished if handoffs[i] == 'Standby' and i in stopList]
+                finished = [i for i in finished if i not in standbyHandoffs]
+                if finished:
+                    tag_asg_handoff(ec2, finished, None)
+        asgPhase.stop()
+        
+        actionPhase = instrumentation.Phase(plan.target, 'action')
+        if stopList:
+            log ('**** Stopping', len(stopList) ,'instances:', ', '.join(stopList))
+            failed = execute_ec2_action(ec2, 'stop_instances', list(stopList))
+            
+            # Remove instances that failed to stop from stopList
+            if failed:
+                log ('**** |--> Failed to stop', len(failed), 'instances:', ', '.join(failed))
+                plan.add_failures('stop_instances', failed)
+                stopList.difference_update(failed)
+                
+            # Instances that failed to stop keep their Standby handoff, the next run stops them again
+            stopped = [i for i in standbyHandoffs if i not in failed]
+            if stopped:
+                tag_asg_handoff(ec2, stopped, None)
+                
+            if inventory is not None:
+                inventory.issue(stopList, 'STOP')
+                
+            if createMetrics == 'Yes':
+                # Remove instances in stopList from metricUpList
+                metricUpList.difference_update(stopList)
+                # Post metrics for instances that were stopped
+                for i in stopList:
+                    metrics.put(i, 0)
+            
+        else:
+            log ('**** No Instances to stop in region', region_name)
+        actionPhase.stop()
+        
+    else:
+        log ('**** Nothing to do')
+    
+    # Post metrics for instances that were not stopped or started
+    if createMetrics == 'Yes':
+        with instrumentation.Phase(plan.target, 'metrics'):
+            for i in metricUpList:
+                metrics.put(i, 1)
+            for i in metricDownList:
+                metrics.put(i, 0)
+            metrics.flush()
+
+# Function to run an RDS action (e.g. start_db_instance) for resources (parameter is the identifier parameter),
+# rdsActionConcurrency calls at a time. Returns the resources that failed with their error, the others succeeded
+def execute_rds_actions(rds, action, parameter, resources):
+    
+    call = getattr(rds, action)
+    
+    # Function to run the action for a resource
+    def run(resource):
+        
+        try:
+            call(**{parameter: resource})
+            return resource, None
+        except Exception as e:
+            log ('**** |-->', action, 'failed for', resource, ':', e)
+            return resource, str(e)
+        
+    failed = {}
+    with ThreadPoolExecutor(max_workers = min(rdsActionConcurrency, len(resources))) as executor:
+        for resource, error in executor.map(with_region_log(run), resources):
+            if error is not None:
+                failed[resource] = error
+    return failed
+
+# Function to get the tags of an RDS resource missing them in the describe response, remembered by the inventory
+# for fullDiscoveryInterval
+def rds_tag_list(rds, arn, inventory):
+    
+    tagList = None
+    if inventory is not None:
+        tagList = inventory.tag_list(arn, fullDiscoveryInterval * 60)
+    if tagList is None:
+        tagList = rds.list_tags_for_resource(ResourceName = arn)['TagList']
+        if inventory is not None:
+            inventory.remember_tag(arn, tagList, customRDSTagName)
+    return tagList
+
+# Discovered RDS instance and cluster, with the values of their scheduler tags
+RdsInstance = namedtuple('RdsInstance', ['identifier', 'state', 'tagValues', 'cluster', 'readReplicas', 'replicaSource', 'multiAZ'])
+RdsCluster = namedtuple('RdsCluster', ['identifier', 'state', 'tagValues', 'engineMode', 'replicationSource'])
+
+# Function to get the values of the scheduler tags of an RDS resource, the tags are queried if missing in the response
+def rds_tag_values(rds, resource, arn, inventory):
+    
+    tagList = resource['TagList'] if 'TagList' in resource else rds_tag_list(rds, resource[arn], inventory)
+    return tuple(t['Value'] for t in tagList if t['Key'][:customRDSTagLen] == customRDSTagName)
+
+# Function to list the tagged RDS instances of a region page by page, only the fields the scheduler needs are kept
+def describe_rds_instances(rds, inventory = None):
+    
+    paginator = rds.get_paginator('describe_db_instances')
+    for page in paginator.paginate():
+        for rds_instance in page['DBInstances']:
+            tagValues = rds_tag_values(rds, rds_instance, 'DBInstanceArn', inventory)
+            if tagValues:
+                yield RdsInstance(rds_instance['DBInstanceIdentifier'], rds_instance['DBInstanceStatus'], tagValues,
+                    rds_instance.get('DBClusterIdentifier'), tuple(rds_instance['ReadReplicaDBInstanceIdentifiers']),
+                    rds_instance.get('ReadReplicaSourceDBInstanceIdentifier'), rds_instance['MultiAZ'])
+
+# Function to list the tagged RDS (Aurora) clusters of a region page by page, only the fields the scheduler needs are kept
+def describe_rds_clusters(rds, inventory = None):
+    
+    paginator = rds.get_paginator('describe_db_clusters')
+    for page in paginator.paginate():
+        for rds_cluster in page['DBClusters']:
+            tagValues = rds_tag_values(rds, rds_cluster, 'DBClusterArn', inventory)
+            if tagValues:
+                yield RdsCluster(rds_cluster['DBClusterIdentifier'], rds_cluster['Status'], tagValues,
+                    rds_cluster.get('EngineMode'), rds_cluster.get('ReplicationSourceIdentifier'))
+
+# Function to start/stop the RDS instances and clusters of a region
+def process_rds(region_name, plan, inventory = None):
+    
+    # Lists of the action plan
+    rdsStartList = plan.rdsStartList
+    rdsStopList = plan.rdsStopList
+    rdsClusterStartList = plan.rdsClusterStartList
+    rdsClusterStopList = plan.rdsClusterStopList
+    metricUpList = plan.rdsMetricUpList
+    metricDownList = plan.rdsMetricDownList
+    
+    rds = get_client('rds', region_name)
+    
+    log_phase('rds')
+    log ('*** Populate RDS lists')
+    
+    # Decisions, without the time spent fetching the pages of instances and clusters
+    decisionPhase = instrumentation.Phase(plan.target, 'decision')
+    
+    for rds_instance in instrumentation.timed(describe_rds_instances(rds, inventory), plan.target, 'discovery'):
+        
+        # Instances of other shards are left to their workers, cluster members belong to the shard of the cluster
+        tagValues = rds_instance.tagValues
+        if shard is not None:
+            tagValues = [tagValue for tagValue in tagValues
+                         if in_shard('cluster:' + rds_instance.cluster if rds_instance.cluster is not None else rds_instance.identifier, tagValue)]
+            
+        # One record per instance, with all its tag values
+        if inventory is not None and tagValues:
+            inventory.see(rds_instance.identifier, tagValues, rds_instance.state, inventorystore.fingerprint(tagValues, rds_instance.state,
+                rds_instance.cluster, rds_instance.readReplicas, rds_instance.replicaSource, rds_instance.multiAZ))
+            
+        for tagValue in tagValues:
+            
+            # Get instance state
+            state = rds_instance.state
+            
+            # Add instances to correct metricList
+            if createMetrics == 'Yes':
+                if state in ['available','starting']:
+                    metricUpList.add(rds_instance.identifier)
+                if state in ['stopped','stopping']:
+                    metricDownList.add(rds_instance.identifier)
+            
+            # Get action for instance
+            action = scheduler_action(tagValue = tagValue)
+            
+            if createForecast == 'Yes' and rds_instance.identifier not in plan.forecast:
+                plan.forecast[rds_instance.identifier] = forecast_hours(tagValue, state in ['available','starting'])
+            
+            # Check for unsupported instances
+            if action != "None":
+                if rds_instance.cluster is not None:
+                    log_detail ('Skipped', rds_instance.identifier, '**** No action against RDS instance', rds_instance.identifier, '(is member of cluster', rds_instance.cluster + ')')
+                    continue
+                
+                if len(rds_instance.readReplicas):
+                    log_detail ('Skipped', rds_instance.identifier, '**** No action against RDS instance', rds_instance.identifier, '(has read replica)')
+                    continue
+                
+                if rds_instance.replicaSource is not None:
+                    log_detail ('Skipped', rds_instance.identifier, '**** No action against RDS instance', rds_instance.identifier, '(is replicating)')
+                    continue
+                
+                if rds_instance.multiAZ:
+                    log_detail ('Skipped', rds_instance.identifier, '**** No action against RDS instance', rds_instance.identifier, '(is in multiple AZs)')
+                    continue
+                
+                if state not in ['available','stopped']:
+                    log_detail ('Skipped', rds_instance.identifier, '**** No action against RDS instance', rds_instance.identifier, '(is in an unsupported state:',state,')')
+                    continue
+                    
+            # Append to start list
+            if action == 'START' and state == 'stopped':
+                if inventory is not None and inventory.issued(rds_instance.identifier, 'START'):
+                    log_detail ('AlreadyStarted', rds_instance.identifier, '****', rds_instance.identifier, 'with tag', tagValue, 'was already started in this window')
+                elif rds_instance.identifier not in rdsStartList:
+                    rdsStartList.add(rds_instance.identifier)
+                    log_detail ('Start', rds_instance.identifier, '****', rds_instance.identifier, 'with tag', tagValue, 'added to RDS START list')
+                # Instance Id already in rdsStartList
+                    
+            # Append to stop list
+            if action == 'STOP' and state == 'available':
+                if inventory is not None and inventory.issued(rds_instance.identifier, 'STOP'):
+                    log_detail ('AlreadyStopped', rds_instance.identifier, '****', rds_instance.identifier, 'with tag', tagValue, 'was already stopped in this window')
+                elif rds_instance.identifier not in rdsStopList:
+                    rdsStopList.add(rds_instance.identifier)
+                    log_detail ('Stop', rds_instance.identifier, '****', rds_instance.identifier, 'with tag', tagValue, 'added to RDS STOP list')
+                # Instance Id already in rdsStopList
+                    
+    for rds_cluster in instrumentation.timed(describe_rds_clusters(rds, inventory), plan.target, 'discovery'):
+        
+        # Clusters of other shards are left to their workers
+        tagValues = rds_cluster.tagValues
+        if shard is not None:
+            tagValues = [tagValue for tagValue in tagValues if in_shard('cluster:' + rds_cluster.identifier, tagValue)]
+            
+        # One record per cluster, with all its tag values. Clusters are recorded as cluster:<identifier>, their identifiers
+        # can be the ones of instances
+        if inventory is not None and tagValues:
+            inventory.see('cluster:' + rds_cluster.identifier, tagValues, rds_cluster.state, inventorystore.fingerprint(tagValues, rds_cluster.state,
+                rds_cluster.engineMode, rds_cluster.replicationSource))
+            
+        for tagValue in tagValues:
+            
+            # Get cluster state
+            state = rds_cluster.state
+            
+            # Add clusters to correct metricList
+            if createMetrics == 'Yes':
+                if state in ['available','starting']:
+                    metricUpList.add(rds_cluster.identifier)
+                if state in ['stopped','stopping']:
+                    metricDownList.add(rds_cluster.identifier)
+            
+            # Get action for cluster
+            action = scheduler_action(tagValue = tagValue)
+            
+            if createForecast == 'Yes' and 'cluster:' + rds_cluster.identifier not in plan.forecast:
+                plan.forecast['cluster:' + rds_cluster.identifier] = forecast_hours(tagValue, state in ['available','starting'])
+            
+            # Check for unsupported clusters
+            if action != "None":
+                if rds_cluster.engineMode == 'serverless':
+                    log_detail ('ClusterSkipped', 'cluster:' + rds_cluster.identifier, '**** No action against RDS cluster', rds_cluster.identifier, '(is serverless)')
+                    continue
+                
+                if rds_cluster.replicationSource is not None:
+                    log_detail ('ClusterSkipped', 'cluster:' + rds_cluster.identifier, '**** No action against RDS cluster', rds_cluster.identifier, '(is replicating)')
+                    continue
+                
+                if state not in ['available','stopped']:
+                    log_detail ('ClusterSkipped', 'cluster:' + rds_cluster.identifier, '**** No action against RDS cluster', rds_cluster.identifier, '(is in an unsupported state:',state,')')
+                    continue
+                        
+            # Append to start list
+            if action == 'START' and state == 'stopped':
+                if inventory is not None and inventory.issued('cluster:' + rds_cluster.identifier, 'START'):
+                    log_detail ('ClusterAlreadyStarted', 'cluster:' + rds_cluster.identifier, '****', rds_cluster.identifier, 'with tag', tagValue, 'was already started in this window')
+                elif rds_cluster.identifier not in rdsClusterStartList:
+                    rdsClusterStartList.add(rds_cluster.identifier)
+                    log_detail ('ClusterStart', 'cluster:' + rds_cluster.identifier, '****', rds_cluster.identifier, 'with tag', tagValue, 'added to RDS cluster START list')
+                # Cluster Id already in rdsClusterStartList
+                
+            # Append to stop list
+            if action == 'STOP' and state == 'available':
+                if inventory is not None and inventory.issued('cluster:' + rds_cluster.identifier, 'STOP'):
+                    log_detail ('ClusterAlreadyStopped', 'cluster:' + rds_cluster.identifier, '****', rds_cluster.identifier, 'with tag', tagValue, 'was already stopped in this window')
+                elif rds_cluster.identifier not in rdsClusterStopList:
+                    rdsClusterStopList.add(rds_cluster.identifier)
+                    log_detail ('ClusterStop', 'cluster:' + rds_cluster.identifier, '****', rds_cluster.identifier, 'with tag', tagValue, 'added to RDS cluster STOP list')
+                # Cluster Id already in rdsClusterStopList
+                    
+    decisionPhase.stop()
+    
+    # In plan mode the lists are the plan, nothing is changed
+    if mode == 'plan':
+        log ('*** Plan mode, no RDS actions executed')
+        return
+    
+    # Create buffer for the instances that need a metric update
+    if createMetrics == 'Yes':
+        metrics = MetricBuffer(region_name)
+        
+    log ('*** Execute RDS actions')
+    
+    if rdsStartList or rdsStopList or rdsClusterStartList or rdsClusterStopList:
+        actionPhase = instrumentation.Phase(plan.target, 'action')
+        # Execute Start and Stop Commands
+        if rdsStartList:
+            log ('**** Starting', len(rdsStartList), 'RDS instances:', ', '.join(rdsStartList))
+            failed = execute_rds_actions(rds, 'start_db_instance', 'DBInstanceIdentifier', list(rdsStartList))
+            
+            # Remove instances that failed to start from rdsStartList
+            if failed:
+                log ('**** |--> Failed to start', len(failed), 'RDS instances:', ', '.join(failed))
+                plan.add_failures('start_db_instance', failed)
+                rdsStartList.difference_update(failed)
+                
+            if inventory is not None:
+                inventory.issue(rdsStartList, 'START')
+                
+            if createMetrics == 'Yes':
+                # Remove instances in rdsStartList from metricDownList
+                metricDownList.difference_update(rdsStartList)
+                # Post metrics for instances that were started
+                for DBInstanceIdentifier in rdsStartList:
+                    metrics.put(DBInstanceIdentifier, 1)
+                
+        else:
+            log ('**** No RDS Instances to Start in region',  region_name)
+            
+        if rdsStopList:
+            log ('**** Stopping', len(rdsStopList) ,'RDS instances:', ', '.join(rdsStopList))
+            failed = execute_rds_actions(rds, 'stop_db_instance', 'DBInstanceIdentifier', list(rdsStopList))
+            
+            # Remove instances that failed to stop from rdsStopList
+            if failed:
+                log ('**** |--> Failed to stop', len(failed), 'RDS instances:', ', '.join(failed))
+                plan.add_failures('stop_db_instance', failed)
+                rdsStopList.difference_update(failed)
+                
+            if inventory is not None:
+                inventory.issue(rdsStopList, 'STOP')
+                
+            if createMetrics == 'Yes':
+                # Remove instances in rdsStopList from metricUpList
+                metricUpList.difference_update(rdsStopList)
+                # Post metrics for instances that were stopped
+                for DBInstanceIdentifier in rdsStopList:
+                    metrics.put(DBInstanceIdentifier, 0)
+                
+        else:
+            log ('**** No RDS Instances to Stop in region', region_name)
+            
+        if rdsClusterStartList:
+            log ('**** Starting', len(rdsClusterStartList), 'RDS clusters:', ', '.join(rdsClusterStartList))
+            failed = execute_rds_actions(rds, 'start_db_cluster', 'DBClusterIdentifier', list(rdsClusterStartList))
+            
+            # Remove clusters that failed to start from rdsClusterStartList
+            if failed:
+                log ('**** |--> Failed to start', len(failed), 'RDS clusters:', ', '.join(failed))
+                plan.add_failures('start_db_cluster', failed)
+                rdsClusterStartList.difference_update(failed)
+                
+            if inventory is not None:
+                inventory.issue(['cluster:' + c for c in rdsClusterStartList], 'START')
+                
+            if createMetrics == 'Yes':
+                # Remove clusters in rdsClusterStartList from metricDownList
+                metricDownList.difference_update(rdsClusterStartList)
+                # Post metrics for clusters that were started
+                for DBClusterIdentifier in rdsClusterStartList:
+                    metrics.put(DBClusterIdentifier, 1)
+                    
+        else:
+            log ('**** No RDS Clusters to Start in region',  region_name)
+            
+        if rdsClusterStopList:
+            log ('**** Stopping', len(rdsClusterStopList) ,'RDS clusters:', ', '.join(rdsClusterStopList))
+            failed = execute_rds_actions(rds, 'stop_db_cluster', 'DBClusterIdentifier', list(rdsClusterStopList))
+            
+            # Remove clusters that failed to stop from rdsClusterStopList
+            if failed:
+                log ('**** |--> Failed to stop', len(failed), 'RDS clusters:', ', '.join(failed))
+                plan.add_failures('stop_db_cluster', failed)
+                rdsClusterStopList.difference_update(failed)
+                
+            if inventory is not None:
+                inventory.issue(['cluster:' + c for c in rdsClusterStopList], 'STOP')
+                
+            if createMetrics == 'Yes':
+                # Remove clusters in rdsClusterStopList from metricUpList
+                metricUpList.difference_update(rdsClusterStopList)
+                # Post metrics for clusters that were stopped
+                for DBClusterIdentifier in rdsClusterStopList:
+                    metrics.put(DBClusterIdentifier, 0)
+                    
+        else:
+            log ('**** No RDS Clusters to Stop in region', region_name)
+        actionPhase.stop()
+        
+    else:
+        log ('**** Nothing to do')
+        
+    # Post metrics for instances that were not stopped or started
+    if createMetrics == 'Yes':
+        with instrumentation.Phase(plan.target, 'metrics'):
+            for i in metricUpList:
+                metrics.put(i, 1)
+            for i in metricDownList:
+                metrics.put(i, 0)
+            metrics.flush()
 
-# Function to interpret the tag of an instance and return the action to do
-def scheduler_action(tagValue):
+# Function to finish a run without discovery: logs the next transition and posts the metric states of the last full discovery
+def idle_run():
     
-    # Weekdays Interpreter
-    weekdays = ['mon', 'tue', 'wed', 'thu', 'fri']
+    upcoming = [(at, tagValue, action) for tagValue, (at, action) in transitionIndex['NextTransitions'].items() if at > timestamp]
+    if upcoming:
+        (at, tagValue, action) = min(upcoming)
+        print ('* No transition in this run, next:', action, 'of tag value', tagValue, 'at', datetime.datetime.utcfromtimestamp(at).strftime('%Y-%m-%d %H:%M UTC'))
+    else:
+        print ('* No transition in this run nor before the next full discovery')
+        
+    if createMetrics == 'Yes':
+        for account, region_name, up, down in transitionIndex['Metrics']:
+            print ('**', target_name(account, region_name))
+            regionAccount.account = account
+            try:
+                with instrumentation.Phase(target_name(account, region_name), 'metrics'):
+                    metrics = MetricBuffer(region_name)
+                    for i in up:
+                        metrics.put(i, 1)
+                    for i in down:
+                        metrics.put(i, 0)
+                    metrics.flush()
+            finally:
+                regionAccount.account = None
+
+# Function to log the API calls and the governor of the run and write its EMF record (if embeddedMetrics is Yes)
+def report_run(embeddedMetrics, duration, properties):
     
-    # Monthdays Interpreter (1..31)
-    monthdays = re.compile(r'^(0?[1-9]|[12]\d|3[01])$')
+    stats = instrumentation.api_stats()
+    print ('* API calls:', sum(s['Calls'] for s in stats), 'calls,', sum(s['Retries'] for s in stats), 'retries,',
+           sum(s['Throttles'] for s in stats), 'throttled,', sum(s['Errors'] for s in stats), 'errors')
+    print ('* Peak RSS:', instrumentation.peak_rss(), 'MB')
     
-    # nth weekdays Interpreter
-    nthweekdays=re.compile('\w{3}/\d{1}')
+    # Time the calls waited for the governor, and the limiters that were throttled with their adapted rate and concurrency
+    limiters = governor.stats()
+    print ('* API governor:', sum(sum(l['Calls'].values()) for l in limiters), 'calls waited %.2fs,' % sum(sum(l['Waited'].values()) for l in limiters),
+           sum(l['Throttles'] for l in limiters), 'throttled')
+    for l in limiters:
+        if l['Throttles']:
+            print ('** Throttled', l['Service'], target_name(l['Account'], l['Region']), l['Throttles'], 'times, rate', l['Rate'], 'calls/s, concurrency', l['Limit'])
+            
+    if embeddedMetrics == 'Yes':
+        instrumentation.emit('EC2RDSScheduler', duration, dict(properties, Governor = governor.summary(limiters)))
+
+# Function to get the seconds left before the deadline of the invocation (None without a deadline)
+def time_left():
     
-    # Set default values
-    Action = 'None'
-    isValidTimeZone = True
-    isActiveDay = False
+    if runDeadline is None:
+        return None
+    return runDeadline - time.time()
+
+# Function to check if less than seconds are left before the deadline of the invocation
+def out_of_time(seconds):
     
-    # Get tag values
-    ptag = tagValue.replace(';',':').split(':')
+    left = time_left()
+    return left is not None and left < seconds
+
+# Function to take the lease of a region (name of its inventory document) until the end of the invocation. Returns False
+# if another run holds it, None if the store failed (the region is processed without a lease)
+def acquire_lease(name):
     
-    # Get default time values
-    startTime = defaultStartTime
-    stopTime = defaultStopTime
-    timeZone = defaultTimeZone
-    daysActive = defaultDaysActive
+    try:
+        return inventoryStore.acquire_lease('lease-' + name, runId, leaseExpires)
+    except Exception as e:
+        log ('** Lease not acquired:', e)
+        return None
 
-    # Check if tag is empty or none
-    if (ptag[0] == '' or ptag[0] == 'none') and len(ptag) == 1:
-        return 'None'
+# Function to give up the lease of a region, an error leaves it to expire
+def release_lease(name):
+    
+    try:
+        inventoryStore.release_lease('lease-' + name, runId)
+    except Exception as e:
+        log ('** Lease not released:', e)
 
-    # Get startTime
-    if len(ptag) >= 1:
-        # Check for default values
-        if ptag[0].lower() not in ('default', 'true'):
-            startTime = ptag[0]
-            # Clear default stopTime if stopTime it's not defined in tag
-            if len(ptag) == 1:
-                stopTime = ''
+# Function to get the name of the inventory document of a region, every shard of a region keeps its own
+def inventory_name(target):
+    
+    if shard is None:
+        return 'inventory-' + target
+    return 'inventory-%s-%dof%d' % (target, shard['Partition'], shard['Partitions'])
+
+# Function to run all phases of a region of an account, returns the status, duration and action plan of the region
+def process_region(target, phases = regionPhases):
+    
+    (account, region_name) = target
+    regionLog.buffer = runlog.RegionLog(target_name(account, region_name))
+    regionAccount.account = account
+    regionStart = time.time()
+    status = 'OK'
+    leased = None
+    
+    # Action plan of the region
+    plan = ActionPlan(region_name, account)
+    
+    try:
+        log ('**', plan.target)
+        
+        # A region that can't be done before the deadline of the invocation is deferred to the next one
+        if out_of_time(regionBudget):
+            log ('** Deferred to the next invocation, %.1fs left' % time_left())
+            plan.deferred = list(phases)
+            status = 'DEFERRED'
+            return status, time.time() - regionStart, plan
             
-    # Support 24x7
-    if startTime  == '24x7':
-        return 'START'
+        # An overlapping run processing the region keeps it, this run defers it to the next invocation
+        if inventoryStore is not None and mode == 'run':
+            leased = acquire_lease(inventory_name(plan.target))
+            if leased is False:
+                log ('** Processed by another run (lease held), deferred to the next invocation')
+                plan.deferred = list(phases)
+                status = 'DEFERRED'
+                return status, time.time() - regionStart, plan
+                
+        # Inventory of the previous run, the region is processed without it if it can't be loaded
+        inventory = None
+        if inventoryStore is not None:
+            try:
+                inventory = inventorystore.RegionInventory(inventoryStore.load(inventory_name(plan.target)), runWindow, timestamp)
+            except Exception as e:
+                log ('** Inventory not loaded:', e)
+                
+        # EC2 and ASG phase, an exception doesn't affect the RDS phase of the region
+        if 'ec2' in phases:
+            try:
+                process_ec2(region_name, plan, inventory)
+            except Exception as e:
+                log ('** Exception:', e)
+                status = 'FAILED'
+            
+        # RDS phase, deferred if the EC2 phase used up the time of the invocation
+        if RDSSupport == 'Yes' and 'rds' in phases:
+            if out_of_time(regionBudget):
+                log ('** RDS phase deferred to the next invocation, %.1fs left' % time_left())
+                plan.deferred = ['rds']
+                status = 'DEFERRED' if status == 'OK' else status
+            else:
+                try:
+                    process_rds(region_name, plan, inventory)
+                except Exception as e:
+                    log ('** Exception:', e)
+                    status = 'FAILED'
+                    
+        # Store the inventory, keeping the resources of a failed or skipped phase from the previous run
+        if inventory is not None:
+            log ('**', inventory.changed, 'of', len(inventory.resources), 'tagged resources new or changed since the last run')
+            if mode == 'run':
+                try:
+                    inventoryStore.save(inventory_name(plan.target), inventory.document(keepUnseen = status != 'OK' or tuple(phases) != regionPhases))
+                except Exception as e:
+                    log ('** Inventory not stored:', e)
+                    
+        if createForecast == 'Yes':
+            log ('** Forecast:', len(plan.forecast), 'tagged resources,', '%.1f' % sum(plan.forecast.values()), 'running hours this month')
+            
+        return status, time.time() - regionStart, plan
+    
+    finally:
+        if leased:
+            release_lease(inventory_name(plan.target))
+            
+        # Write the buffered output of the region in one block
+        regionLog.buffer.flush(Status = status, Duration = round(time.time() - regionStart, 3))
+        regionLog.buffer = None
+        regionAccount.account = None
+
+# Function to process the shard of a worker invocation, returns the result of the shard to the coordinator
+def run_shard(handlerStarted):
+    
+    target = Target(shard['Account'], shard['Region'])
+    name = target_name(*target)
+    print ('* Worker of shard', shard['Partition'] + 1, 'of', shard['Partitions'], 'of', name)
+    
+    status, duration, plan = process_region(target, shard.get('Phases', regionPhases))
+    result = {
+        'Target': name,
+        'Partition': shard['Partition'],
+        'Status': status,
+        'Duration': duration,
+        'Deferred': plan.deferred,
+        'TagValues': sorted(scheduleActions),
+        'Api': instrumentation.api_stats(),
+        'Phases': {name: instrumentation.region_phases(name)},
+        'Governor': governor.stats()
+    }
+    
+    # The plan goes to the inventory store, or into the result if it isn't too large for the response
+    document = plan.to_dict()
+    if inventoryStore is not None:
+        try:
+            inventoryStore.save('plan-' + inventory_name(name), document)
+            result['PlanDocument'] = 'plan-' + inventory_name(name)
+        except Exception as e:
+            print ('* Plan not stored:', e)
+    if 'PlanDocument' not in result:
+        if len(json.dumps(document)) > shardPlanMaxBytes:
+            print ('* Plan too large to return, metric lists left out')
+            for group in ('EC2', 'RDS'):
+                document[group]['MetricUp'] = []
+                document[group]['MetricDown'] = []
+            result['Trimmed'] = True
+        result['Plan'] = document
         
-    # Get stopTime
-    if len(ptag) >= 2:
-        stopTime = ptag[1]
+    # The coordinator merges the API statistics of the workers and writes the metrics of the run, a worker only logs them
+    report_run('No', time.time() - handlerStarted, {'Mode': mode, 'Discovery': 'Shard', 'ColdStart': invocations == 1, 'Status': {name: status}})
+    print ('* Shard finished in %.2fs' % (time.time() - handlerStarted), status)
+    return result
+
+# Function to run a shard in a worker invocation of the function (functionName None: in this process), returns the
+# result of the worker or the error of a failed invocation
+def invoke_shard(functionName, event, shardSpec):
+    
+    workerEvent = dict(event, Shard = shardSpec)
+    
+    # A worker gets the time left to the coordinator, a shard that couldn't process its region in it isn't invoked
+    left = time_left()
+    if left is not None:
+        if left - shardInvokeMargin - deadlineReserve < regionBudget:
+            return {'Status': 'DEFERRED', 'Error': 'not invoked, %.1fs left' % left}
+        workerEvent['TimeBudget'] = left - shardInvokeMargin
+        
+    try:
+        if functionName is None:
+            return lambda_handler(workerEvent, None)
         
-    # Default Timzone
-    tz = pytz.timezone(defaultTimeZone)
+        response = get_client('lambda').invoke(FunctionName = functionName, Payload = json.dumps(workerEvent))
+        result = json.loads(response['Payload'].read().decode())
+        if 'FunctionError' in response:
+            return {'Status': 'FAILED', 'Error': result.get('errorMessage', response['FunctionError'])}
+        return result
+    except Exception as e:
+        return {'Status': 'FAILED', 'Error': str(e)}
+
+# Function to split the regions of all accounts into shardCount shards each, run them in worker invocations (concurrently,
+# or one after the other in this process if functionName is None) and retry failed shards up to shardRetries times while
+# there's time left. Deferred shards aren't retried. deferred (name of a region -> [phases, partition] of its shards, see
+# ActionPlan.deferred) runs only the shards of a checkpoint. Returns the status (FAILED if a shard failed, DEFERRED if a
+# shard was deferred), duration and merged action plan of every region by name, like process_region
+def coordinate(event, targets, functionName, shardCount, shardRetries, concurrency, deferred = None):
     
-    # Get timezone
-    if len(ptag) >= 3:
-        #Timezone is case senstive
-        timeZone = ptag[2]
-        # timeZone is not empty and not DefaultTimeZone
-        if timeZone != defaultTimeZone and timeZone != '':
-            # utc is not included in pytz.all_timezones
-            if timeZone != 'utc':
-                if timeZone in pytz.all_timezones:
-                    tz = pytz.timezone(timeZone)
-                # No action if timeZone is not supported
-                else:
-                    print ('Invalid time zone :', timeZone)
-                    isValidTimeZone = False
-            # utc timezone
-            else:
-                tz = pytz.timezone('utc')
-                
-    # Get datetime
-    datetimevalue = datetime.datetime.fromtimestamp(timestamp, tz)
-    
-    # Set time/day variables
-    now = datetimevalue.strftime('%H%M')
-    
-    # Set nowMin to now minus schedule plus 1min
-    nowMin = datetimevalue + datetime.timedelta(minutes=-schedule+1)
-    nowMin = nowMin.strftime('%H%M')
-        
-    # Set day and date
-    nowDay = datetimevalue.strftime('%a').lower()
-    nowDate = int(datetimevalue.strftime('%d'))
-    
-    # Handle midnight (script must look back to the day before, so set current day to yesterday if needed)
-    if str(now) == '0000':
-        # If startTime isn't 00:00 but matches the range, go one day back
-        if startTime != '0000' and startTime >= str(nowMin):
-            minusOneDay = datetimevalue + datetime.timedelta(days=-1)
-            nowDay = minusOneDay.strftime('%a').lower()
-            nowDate = int(minusOneDay.strftime('%d'))
-            now = '2359'
-            # If startTime and stopTime fall in the same execution, do noting
-            if stopTime == '0000':
-                print ('**** Tag with value', tagValue, 'is invalid (start- and stopTime fall in the same execution interval)')
-                return 'None'
-        # If stopTime isn't 00:00 but matches the range, go one day back
-        if stopTime != '0000' and stopTime >= str(nowMin):
-            minusOneDay = datetimevalue + datetime.timedelta(days=-1)
-            nowDay = minusOneDay.strftime('%a').lower()
-            nowDate = int(minusOneDay.strftime('%d'))
-            now = '2359'
-            # If startTime and stopTime fall in the same execution, do noting
-            if startTime == '0000':
-                print ('**** Tag with value', tagValue, 'is invalid (start- and stopTime fall in the same execution interval)')
-                return 'None'
-        # If start- or stopTime is 00:00, set nowMin to 00:00
-        if startTime == '0000' or stopTime == '0000':
-            nowMin = '0000'
+    global shard
+    global invocations
+    global runDeadline
+    global runId
+    global leaseExpires
+    global invocationSeconds
     
-    # Get active days
-    if len(ptag) >= 4:
-        daysActive = ptag[3].lower()
+    # Workers plan the same point in time as the coordinator
+    workerEvent = dict(event, Execution = 'worker', Timestamp = timestamp)
+    shards = []
+    for t in targets:
+        for phases, p in deferred[target_name(*t)] if deferred else [[list(regionPhases), p] for p in range(shardCount)]:
+            shards.append({'Account': t.account, 'Region': t.region_name, 'Partition': p, 'Partitions': shardCount, 'Phases': phases})
+    outcomes = {}
     
-    # 24x5 support 
-    if startTime  == '24x5':
-       if nowDay == 'mon':
-           startTime = defaultStartTime
-           stopTime = 'none'
-           isActiveDay = True
-       elif nowDay == 'fri':
-           isActiveDay = True
-           startTime = 'none'
-           stopTime = defaultStopTime
-           
-    # All days support
-    elif daysActive == 'all':
-        isActiveDay = True
-        
-    # Weekdays support
-    elif daysActive == 'weekdays':
-        if (nowDay in weekdays):
-            isActiveDay = True
+    pending = shards
+    for attempt in range(shardRetries + 1):
+        if attempt:
+            if out_of_time(regionBudget + deadlineReserve + shardInvokeMargin):
+                print ('* Not retrying', len(pending), 'failed shards, %.1fs left' % time_left())
+                break
+            print ('* Retrying', len(pending), 'failed shards, attempt', attempt + 1, 'of', shardRetries + 1)
             
-    # Specific days support
+        if functionName is None:
+            # A worker in this process sets the globals of its invocation and resets the statistics, the ones of the
+            # coordinator are restored
+            results = []
+            for s in pending:
+                state = (invocations, runDeadline, runId, leaseExpires, invocationSeconds, dict(clientStats), instrumentation.snapshot(), governor.stats())
+                results.append(invoke_shard(None, workerEvent, s))
+                invocations, runDeadline, runId, leaseExpires, invocationSeconds, created, stats, limiters = state
+                clientStats.update(created)
+                instrumentation.reset()
+                instrumentation.merge(*stats)
+                governor.reset()
+                governor.merge(limiters)
+            shard = None
+        else:
+            with ThreadPoolExecutor(max_workers = max(1, concurrency)) as executor:
+                results = list(executor.map(lambda s: invoke_shard(functionName, workerEvent, s), pending))
+                
+        failed = []
+        for s, result in zip(pending, results):
+            name = target_name(s['Account'], s['Region'])
+            outcomes[(name, s['Partition'])] = result
+            if result.get('Status') == 'DEFERRED':
+                print ('** Shard', s['Partition'] + 1, 'of', shardCount, 'of', name, 'deferred:', result.get('Error', 'deadline or lease'))
+            elif result.get('Status') != 'OK':
+                print ('** Shard', s['Partition'] + 1, 'of', shardCount, 'of', name, 'failed:', result.get('Error', result.get('Status')))
+                failed.append(s)
+        pending = failed
+        if not pending:
+            break
+        
+    unfinished = [key for key, result in sorted(outcomes.items()) if result.get('Status') != 'OK']
+    if unfinished:
+        print ('*', len(unfinished), 'of', len(shards), 'shards not finished:', ', '.join('%s %d of %d %s' % (name, p + 1, shardCount, outcomes[(name, p)].get('Status')) for name, p in unfinished))
+        
+    merged = {}
+    for t in targets:
+        name = target_name(*t)
+        plan = ActionPlan(t.region_name, t.account)
+        status = 'OK'
+        duration = 0.0
+        for s in shards:
+            if (s['Account'], s['Region']) != tuple(t):
+                continue
+            result = outcomes[(name, s['Partition'])]
+            if result.get('Status') == 'DEFERRED':
+                status = 'DEFERRED' if status == 'OK' else status
+            elif result.get('Status') != 'OK':
+                status = 'FAILED'
+            # Result of a worker that ran, its plan in the result or in the inventory store
+            if 'Duration' in result:
+                document = result.get('Plan')
+                if 'PlanDocument' in result:
+                    try:
+                        document = inventoryStore.load(result['PlanDocument'])
+                    except Exception as e:
+                        print ('** Plan of shard', s['Partition'] + 1, 'of', shardCount, 'of', name, 'not loaded:', e)
+                if document is not None:
+                    plan.merge(document)
+                plan.trimmed = plan.trimmed or document is None or result.get('Trimmed', False)
+                duration = max(duration, result['Duration'])
+                
+                # The statistics of the run are the ones of the coordinator and the ones of the workers
+                instrumentation.merge(result['Api'], result['Phases'])
+                governor.merge(result['Governor'])
+                
+                # Decide the tag values of the workers, so they are part of the transition index
+                for tagValue in result['TagValues']:
+                    scheduler_action(tagValue)
+                    
+            # Shards deferred by the worker, or not invoked
+            phases = []
+            if 'Duration' in result:
+                phases = result.get('Deferred', [])
+            elif result.get('Status') == 'DEFERRED':
+                phases = s['Phases']
+            if phases:
+                plan.deferred.append([phases, s['Partition']])
+        merged[name] = (status, duration, plan)
+    return merged
+
+# Function to set the point in time the run plans and its window, the decisions cached for another one are dropped
+def set_run_time(when):
+    
+    global timestamp
+    global runWindow
+    
+    timestamp = when
+    
+    # Run window, the same for runs of the same scheduled execution
+    runWindow = int(timestamp // (schedule * 60))
+    
+    # Tag values are compiled and decided once per run
+    compiledSchedules.clear()
+    localTimes.clear()
+    dayTimelines.clear()
+    scheduleActions.clear()
+    forecasts.clear()
+
+# Function to load the regions deferred by earlier invocations of the same configuration from store: a list of runs
+# {'Timestamp': planned time, 'Regions': [[account, region, phases], ...]}, without the ones older than checkpointMaxAge
+def load_checkpoint(store, config):
+    
+    try:
+        checkpoint = store.load('checkpoint') or {}
+    except Exception as e:
+        print ('* Checkpoint not loaded:', e)
+        return []
+    if checkpoint.get('Config') != config:
+        return []
+    return [run for run in checkpoint.get('Runs', []) if run['Timestamp'] >= timestamp - checkpointMaxAge]
+
+# Function to store the runs with deferred regions for the next invocation (none clears the checkpoint)
+def save_checkpoint(store, config, runs):
+    
+    try:
+        store.save('checkpoint', {'Config': config, 'Runs': runs})
+    except Exception as e:
+        print ('* Checkpoint not stored:', e)
+
+# Function to resume the regions deferred by an earlier run, planned at the time of that run so its transitions aren't
+# missed. With the coordinator (coordinator(targets, deferred) runs the deferred shards, see coordinate) the regions
+# carry the deferred shards. Returns the regions deferred again, like the regions of a checkpoint
+def resume_run(run, concurrency, coordinator = None):
+    
+    print ('* Resuming', len(run['Regions']), 'regions deferred by the run at', datetime.datetime.utcfromtimestamp(run['Timestamp']).strftime('%Y-%m-%d %H:%M:%S UTC'))
+    set_run_time(run['Timestamp'])
+    targets = [Target(account, region_name) for account, region_name, deferred in run['Regions']]
+    if coordinator is None:
+        with ThreadPoolExecutor(max_workers = max(1, concurrency)) as executor:
+            results = list(executor.map(process_region, targets, [tuple(phases) for account, region_name, phases in run['Regions']]))
     else:
-        for d in daysActive.split(','):
-            # mon,tue,wed,thu,fri,sat,sun ?
-            if d.lower() == nowDay:
-                    isActiveDay = True
-            # Month days?
-            elif monthdays.match(d):
-                if int(d) == nowDate:
-                     isActiveDay = True
-            # mon/1 first Monday of the month
-            # tue/2 second Tuesday of the month
-            # Fri/3 third Friday of the month
-            # sat/4 forth Saturday of the month
-            elif nthweekdays.match(d):
-                (weekday,nthweek) = d.split('/')
-                if (weekday.lower() == nowDay) and ( nowDate >= (int(nthweek) * 7 - 6)) and (nowDate <= (int(nthweek) * 7)):
-                   isActiveDay = True
-                   
-    # Should instance be started?
-    if startTime >= str(nowMin) and startTime <= str(now) and isActiveDay == True and isValidTimeZone == True:
-        Action = 'START'
-        
-    # Should instance be stopped?    
-    if stopTime >= str(nowMin) and stopTime <= str(now) and isActiveDay == True and isValidTimeZone == True:
-        # If both START and STOP match, do noting
-        if Action == 'START':
-            print ('**** Tag with value', tagValue, 'is invalid (start- and stopTime fall in the same execution interval)')
-            return 'None'
-        Action = 'STOP'
-        
-    return Action
+        merged = coordinator(targets, dict((target_name(account, region_name), deferred) for account, region_name, deferred in run['Regions']))
+        results = [merged[target_name(*t)] for t in targets]
+    return [[t.account, t.region_name, plan.deferred] for t, (status, duration, plan) in zip(targets, results) if plan.deferred]
 
 # Function gets called by CloudWatch event based on configured schedule
 def lambda_handler(event, context):
     
+    global invocations
+    invocations += 1
+    handlerStarted = time.time()
+    clientStats['created'] = 0
+    clientStats['seconds'] = 0.0
+    instrumentation.reset()
+    governor.reset()
+    
     print ('* EC2 and RDS Scheduler started')
+    if invocations == 1:
+        print ('* Cold start, module initialized in %.3fs' % initDuration)
+    else:
+        print ('* Warm start, invocation', invocations, 'of this container,', len(clients), 'clients reused')
     
     # Define global variables
     global defaultStartTime
@@ -215,7 +2063,28 @@ def lambda_handler(event, context):
     global defaultTimeZone
     global defaultDaysActive
     global schedule
-    global timestamp
+    global customTagName
+    global customTagLen
+    global createMetrics
+    global createForecast
+    global ASGSupport
+    global RDSSupport
+    global customRDSTagName
+    global customRDSTagLen
+    global metricLayout
+    global asgWaitTimeout
+    global mode
+    global endpointUrl
+    global fleetSnapshot
+    global fullDiscoveryInterval
+    global inventoryStore
+    global shard
+    global shardPartitioning
+    global runDeadline
+    global regionBudget
+    global runId
+    global leaseExpires
+    global invocationSeconds
     
     ## Set global default values from CloudWatch Rule Input event
     # Customized time values
@@ -225,6 +2094,13 @@ def lambda_handler(event, context):
     defaultDaysActive = event['DefaultDaysActive']
     print('* Default values are StartTime:',defaultStartTime,'StopTime:',defaultStopTime,'TimeZone:',defaultTimeZone,'DaysActive:',defaultDaysActive)
     
+    # Time zones are resolved with pytz (bundled) or zoneinfo (Python 3.9+), auto takes the first one available
+    print ('* Time zones resolved with', tzresolver.select(event.get('TimeZoneBackend', 'auto')))
+    
+    # An invalid default time zone fails the run here, not every region
+    if tzresolver.get_ignoring_case(defaultTimeZone) is None:
+        raise ValueError('Invalid default time zone: ' + defaultTimeZone)
+    
     # Customized tag name
     customTagName = event['CustomTagName']
     customTagLen = len(customTagName)
@@ -236,8 +2112,81 @@ def lambda_handler(event, context):
     customRDSTagName = event['CustomRDSTagName']
     customRDSTagLen = len(customRDSTagName)
     
-    # Get current timestamp
-    timestamp = time.time()
+    # CloudWatch metric per instance or one metric with the instance as dimension
+    metricLayout = event.get('CloudWatchMetricsLayout', 'MetricPerInstance')
+    
+    # Time to wait for ASG instances to be running/in standby before handing the action over to the next run
+    asgWaitTimeout = int(event.get('ASGWaitTimeout', defaultASGWaitTimeout))
+    
+    # Number of regions processed concurrently (over all accounts)
+    regionConcurrency = int(event.get('RegionConcurrency', defaultRegionConcurrency))
+    
+    # Accounts to operate in: account IDs (entered with the role AccountRoleName) or role ARNs, self is the function's own account
+    accounts = [None]
+    accountRoleName = event.get('AccountRoleName', defaultAccountRoleName)
+    if event.get('Accounts'):
+        accounts = []
+        for entry in event['Accounts'].split(','):
+            entry = entry.strip()
+            if entry == 'self':
+                accounts.append(None)
+            elif entry.startswith('arn:'):
+                accounts.append(entry.split(':')[4])
+                accountRoles[entry.split(':')[4]] = entry
+            else:
+                accounts.append(entry)
+                accountRoles[entry] = 'arn:aws:iam::%s:role/%s' % (entry, accountRoleName)
+    
+    # Plan mode only discovers the resources and decides their actions, 'run' executes them
+    mode = event.get('Mode', 'run')
+    
+    # Describe the fleet from a recorded snapshot (always in plan mode) or a stubbed endpoint instead of AWS
+    endpointUrl = event.get('EndpointUrl')
+    fleetSnapshot = None
+    if event.get('FleetSnapshot'):
+        if event['FleetSnapshot'] not in fleetSnapshots:
+            fleetSnapshots[event['FleetSnapshot']] = fleetsnapshot.load_snapshot(event['FleetSnapshot'])
+        fleetSnapshot = fleetSnapshots[event['FleetSnapshot']]
+        mode = 'plan'
+        print ('* Using fleet snapshot', event['FleetSnapshot'])
+    elif endpointUrl:
+        print ('* Using endpoint', endpointUrl)
+        
+    if mode == 'plan':
+        print ('* Plan mode, no actions are executed')
+        
+    # Forecast the running hours of the resources in the month from the START/STOP times of their tag values (no API calls)
+    createForecast = event.get('Forecast', 'No')
+    
+    # single processes all regions in this invocation, coordinator splits them into Shards partitions per region that are
+    # processed by worker invocations of the function (ShardDispatch local: in this process). Workers get their shard in the event
+    execution = event.get('Execution', 'single')
+    shard = event.get('Shard')
+    shardPartitioning = event.get('ShardPartitioning', 'id')
+    
+    # Write the API call statistics and phase durations of the run as one Embedded Metric Format record
+    embeddedMetrics = event.get('EmbeddedMetrics', 'No')
+    
+    # Log of the regions as text or one JSON record per region and phase, with the detail lines of a sample of the resources
+    runlog.configure(event.get('LogFormat', 'text'), event.get('LogVerbosity', 'detail'), event.get('LogSampleRate', 1.0))
+    
+    # Deadline of the invocation from the remaining time of the Lambda context, or TimeBudget seconds (e.g. run locally).
+    # Regions and RDS phases that need more than RegionBudget seconds of it are deferred to the next invocation
+    runDeadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        runDeadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - deadlineReserve
+    if event.get('TimeBudget'):
+        runDeadline = min(runDeadline or float('inf'), handlerStarted + float(event['TimeBudget']) - deadlineReserve)
+    regionBudget = float(event.get('RegionBudget', defaultRegionBudget))
+    invocationSeconds = runDeadline + deadlineReserve - handlerStarted if runDeadline is not None else maxInvocationSeconds
+    
+    # Leases of the regions are held by the run until the end of the invocation
+    runId = '%s@%.6f' % (getattr(context, 'aws_request_id', 'local'), handlerStarted)
+    leaseExpires = runDeadline + deadlineReserve if runDeadline is not None else handlerStarted + maxInvocationSeconds
+    
+    # Skip discovery if no tag value of the last full discovery has a transition (opt-in)
+    earlyExit = event.get('EarlyExit', 'No')
+    fullDiscoveryInterval = int(event.get('FullDiscoveryInterval', defaultFullDiscoveryInterval))
     
      # Get schedule to know what timerange to cover
     scheduleDict =	{
@@ -248,8 +2197,52 @@ def lambda_handler(event, context):
     }
     schedule = scheduleDict[event['Schedule']]
     
-    # Create connection to the EC2 using Boto3 client interface
-    ec2 = boto3.client('ec2')
+    # Get current timestamp, or the timestamp (seconds since epoch) of the event to plan another point in time
+    set_run_time(float(event.get('Timestamp', time.time())))
+    
+    # Store keeping the inventory and the transition index between runs, e.g. file:///tmp/ec2rds-scheduler or dynamodb://Table
+    inventoryStore = None
+    if event.get('InventoryStore'):
+        inventoryStore = inventorystore.open_store(event['InventoryStore'], get_client)
+        print ('* Using inventory store', event['InventoryStore'])
+        
+    # Worker of a shard, the coordinator keeps the transition index
+    if shard is not None:
+        return run_shard(handlerStarted)
+    
+    # Configuration the transition index is valid for
+    config = [event['Regions'], accounts, accountRoleName, customTagName, customRDSTagName, defaultStartTime, defaultStopTime, defaultTimeZone, defaultDaysActive,
+              schedule, ASGSupport, RDSSupport, createMetrics, metricLayout, endpointUrl]
+    
+    # Regions (with the coordinator: shards) deferred by earlier invocations, in the checkpoint of the inventory store or
+    # of the container without one
+    shardCount = int(event.get('Shards', 1)) if execution == 'coordinator' else 1
+    checkpointConfig = config + [execution, shardCount]
+    checkpointStore = inventoryStore or memoryStore
+    resumed = []
+    if mode == 'run':
+        resumed = load_checkpoint(checkpointStore, checkpointConfig)
+        
+    if earlyExit == 'Yes' and mode == 'run' and not resumed:
+        # A new container picks up the transition index of the store
+        if inventoryStore is not None and transitionIndex.get('Config') != config:
+            transitionIndex.clear()
+            try:
+                transitionIndex.update(inventoryStore.load('index') or {})
+            except Exception as e:
+                print ('* Transition index not loaded:', e)
+            
+        reason = full_discovery_reason(config)
+        if reason is None:
+            idle_run()
+            duration = time.time() - handlerStarted
+            report_run(embeddedMetrics, duration, {'Mode': mode, 'Discovery': 'Skipped', 'ColdStart': invocations == 1})
+            print ('* EC2 and RDS Scheduler finished in %.3fs without discovery (%s start)' % (duration, 'cold' if invocations == 1 else 'warm'))
+            return
+        print ('* Full discovery:', reason)
+        
+    # Connection to the EC2 using Boto3 client interface
+    ec2 = get_client('ec2')
     
     # Set regions
     if event['Regions'] == 'all':
@@ -260,6 +2253,8 @@ def lambda_handler(event, context):
         AwsRegionNames = event['Regions'].split(',')
         
     print ('* Operate in regions:', ', '.join(AwsRegionNames))
+    if accounts != [None]:
+        print ('* Operate in accounts:', ', '.join(account or 'self' for account in accounts))
     
     # RDS support?
     if RDSSupport == 'Yes':
@@ -273,333 +2268,112 @@ def lambda_handler(event, context):
     else:
         print ('* ASG support is disabled')
         
-    # Loop through regions
-    for region_name in AwsRegionNames:
-        try:
-            
-            print ('**', region_name)
-            
-            # Declare lists and dicts
-            startList = []
-            stopList = []
-            
-            if ASGSupport == 'Yes':
-                InServiceList = defaultdict(list)
-                StandbyList = defaultdict(list)
-                
-            # Create connection to the EC2 using Boto3 resources interface
-            ec2 = boto3.resource('ec2', region_name = region_name)
-            
-            # List all instances
-            instances = ec2.instances.all()
-            
-            if ASGSupport == 'Yes':
-                # Create connection to Autoscaling using Boto3 client interface
-                aws_scaling_client = boto3.client('autoscaling', region_name = region_name)
-                
-                # List all instances in ASGs
-                next_token = ''
-                while next_token is not None:
-                    if next_token is not '':
-                        describe_result = aws_scaling_client.describe_auto_scaling_instances(NextToken=next_token)
-                        
-                    else:
-                        describe_result = aws_scaling_client.describe_auto_scaling_instances()
-                    next_token = describe_result.get('NextToken')
-                    
-                asgmembers = describe_result.get('AutoScalingInstances')
-                
-            # Create list of instances that need a metric update
-            if createMetrics == 'Yes':
-                metricUpList = []
-                metricDownList = []
-                
-            print ('*** Populate EC2 lists')
-            
-            for i in instances:
-                # Search tag
-                if i.tags != None:
-                    for t in i.tags:
-                        if t['Key'][:customTagLen] == customTagName:
-                            
-                            # Get instance state
-                            state = i.state['Name']
-                            
-                            # Add instances to correct metricList
-                            if createMetrics == 'Yes':
-                                if state == 'running':
-                                    metricUpList.append(i.instance_id)
-                                if state == 'stopped':
-                                    metricDownList.append(i.instance_id)
-                                    
-                            # Get action for instance
-                            action = scheduler_action(tagValue = t['Value'])
-                            
-                            # Append to start list
-                            if action == 'START' and state == 'stopped':
-                                if i.instance_id not in startList:
-                                    startList.append(i.instance_id)
-                                    print ('****', i.instance_id, 'with tag', t['Value'], 'added to START list')
-                                    
-                                    if ASGSupport == 'Yes':
-                                        # Check if instance is in ASG
-                                        for j in asgmembers:
-                                            if i.instance_id == j['InstanceId']:
-                                                print ('**** |--> is member of ASG ', j['AutoScalingGroupName'], '--> added to INSERVICE list')
-                                                InServiceList[j['AutoScalingGroupName']].append(i.instance_id)
-                                                
-                                # Instance Id already in startList
-                                
-                            # Append to stop list
-                            if action == 'STOP' and state == 'running':
-                                if i.instance_id not in stopList:
-                                    stopList.append(i.instance_id)
-                                    print ('****', i.instance_id, 'with tag', t['Value'], 'added to STOP list')
-                                    
-                                    if ASGSupport == 'Yes':
-                                        # Check if instance is in ASG
-                                        for j in asgmembers:
-                                            if i.instance_id == j['InstanceId']:
-                                                print ('**** |--> is member of ASG ', j['AutoScalingGroupName'], '--> added to STANDBY list')
-                                                StandbyList[j['AutoScalingGroupName']].append(i.instance_id)
-                                                
-                                # Instance Id already in stopList
-                                
-            print ('*** Execute EC2 actions')
-            
-            if startList or stopList:
-                if startList:
-                    print ('**** Starting', len(startList), 'instances:', ', '.join(startList))
-                    ec2.instances.filter(InstanceIds=startList).start()
-                    if createMetrics == 'Yes':
-                        # Remove instances in startList from metricDownList
-                        metricDownList = [e for e in metricDownList if e not in startList]
-                        # Post metrics for instances that were stopped
-                        for i in startList:
-                            putCloudWatchMetric(region_name, i, 1)
-                else:
-                    print ('**** No Instances to start in region',  region_name)
-                    
-                if ASGSupport == 'Yes':
-                    if InServiceList:
-                        # Loop through ASGs
-                        for asg, instances in InServiceList.items():
-                            try:
-                                print ('**** Putting', len(instances), 'instances in ASG', asg, 'in service:', ', '.join(instances))
-                                
-                                # Make sure the instances are started before proceeding
-                                for i in instances:
-                                    print ('**** |--> Checking if instance', i, 'is in running state')
-                                    instance_state = ec2.Instance(i).state['Name']
-                                    
-                                    while instance_state != 'running':
-                                        instance_state = ec2.Instance(i).state['Name']
-                                        print ('**** |----> Waiting for instance', i, 'to enter running state')
-                                        time.sleep(3)
-                                        
-                                # Set instances to InService
-                                aws_scaling_client.exit_standby(InstanceIds=instances, AutoScalingGroupName=asg)
-                                
-                            except Exception as e:
-                                print ('**** |-->', e)
-                                
-                    else:
-                        print ('**** No Instances to put in service in region',  region_name)
-                        
-                    if StandbyList:
-                        # Loop through ASGs
-                        for asg, instances in StandbyList.items():
-                            try:
-                                print ('**** Putting', len(instances), 'instances in ASG', asg, 'to standby:', ', '.join(instances))
-                                
-                                # Check maximum amount of instances that can be set to Standby depending on Min-Value of ASG
-                                asg_result = aws_scaling_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg])
-                                desired = asg_result['AutoScalingGroups'][0]['DesiredCapacity']
-                                min = asg_result['AutoScalingGroups'][0]['MinSize']
-                                maxStandby = desired - min
-                                
-                                # If more instances than allowed are in StandbyList, remove them from StandbyList and stopList
-                                if maxStandby <= 0:
-                                    print ('**** |--> ASG', asg, 'has values of Desired', desired, 'and Min', min, "--> Can't set any instances to standby")
-                                    print ('**** |----> Removing instances from STANDBY and STOP lists:', ', '.join(instances))
-                                    stopList = [e for e in stopList if e not in instances]
-                                    print ('**** Putting no instances in ASG', asg, 'to standby')
-                                    continue
-                                
-                                elif len(instances) > maxStandby:
-                                    print ('**** |--> ASG', asg, 'has values of Desired', desired, 'and Min', min, '--> Can set only', maxStandby, ' (Desired - Min) instances to standby')
-                                    instancesToRemove = instances[maxStandby:]
-                                    print ('**** |----> Removing excess instances from STANDBY and STOP lists:', ', '.join(instancesToRemove))
-                                    instances = instances[:maxStandby]
-                                    stopList = [e for e in stopList if e not in instancesToRemove]
-                                    print ('**** Putting only', len(instances), 'instances in ASG', asg, 'to standby:', ', '.join(instances))
-                                    
-                                # Set instances to Standby
-                                aws_scaling_client.enter_standby(InstanceIds=instances, AutoScalingGroupName=asg, ShouldDecrementDesiredCapacity=True)
-                                
-                                # Make sure the instances are in Standby before proceeding
-                                for i in instances:
-                                    print ('**** |--> Checking if instance', i, 'is in standby state')
-                                    instance_result = aws_scaling_client.describe_auto_scaling_instances(InstanceIds=[i])
-                                    instance_state = instance_result['AutoScalingInstances'][0]['LifecycleState']
-                                    
-                                    while instance_state != 'Standby':
-                                        instance_result = aws_scaling_client.describe_auto_scaling_instances(InstanceIds=[i])
-                                        instance_state = instance_result['AutoScalingInstances'][0]['LifecycleState']
-                                        print ('**** |----> Waiting for instance', i, 'to enter standby state')
-                                        time.sleep(3)
-                                        
-                            except Exception as e:
-                                print ('**** |-->', e)
-                                # Remove failed instances from stopList
-                                stopList = [e for e in stopList if e not in instances]
-                                print ('**** |----> Removing instances from STOP list:', ', '.join(instances))
-                                
-                    else:
-                        print ('**** No Instances to put to standby in region', region_name)
-                        
-                if stopList:
-                    print ('**** Stopping', len(stopList) ,'instances:', ', '.join(stopList))
-                    ec2.instances.filter(InstanceIds=stopList).stop()
-                    if createMetrics == 'Yes':
-                        # Remove instances in stopList from metricUpList
-                        metricUpList = [e for e in metricUpList if e not in stopList]
-                        # Post metrics for instances that were stopped
-                        for i in stopList:
-                            putCloudWatchMetric(region_name, i, 0)
-                    
-                else:
-                    print ('**** No Instances to stop in region', region_name)
-                    
-            else:
-                print ('**** Nothing to do')
-            
-            # Post metrics for instances that were not stopped or started
-            if createMetrics == 'Yes':
-                for i in metricUpList:
-                    putCloudWatchMetric(region_name, i, 1)
-                for i in metricDownList:
-                    putCloudWatchMetric(region_name, i, 0)
-                
-        except Exception as e:
-            print ('** Exception:', e)
-            continue
+    # Process the regions of all accounts concurrently, every region runs its EC2, ASG and RDS phases in its own worker
+    targets = [Target(account, region_name) for account in accounts for region_name in AwsRegionNames]
+    names = [target_name(*target) for target in targets]
+    
+    # The coordinator runs shards of the regions (all of them, or the deferred ones of a checkpoint) in worker invocations
+    coordinator = None
+    if execution == 'coordinator':
+        functionName = None
+        if event.get('ShardDispatch', 'lambda') != 'local':
+            functionName = event.get('WorkerFunction') or (context and context.invoked_function_arn)
+            if not functionName:
+                raise ValueError('No function to dispatch the shards to, set WorkerFunction or ShardDispatch local')
+        shardRetries = int(event.get('ShardRetries', defaultShardRetries))
+        coordinator = lambda targets, deferred = None: coordinate(event, targets, functionName, shardCount, shardRetries, regionConcurrency, deferred)
         
-        if RDSSupport == 'Yes':
-            # Declare Lists
-            rdsStartList = []
-            rdsStopList = []
-            
-        # Create list of instances that need a metric update
-        if createMetrics == 'Yes':
-            metricUpList = []
-            metricDownList = []
+    # Deferred regions are resumed before the regions of this run, which are planned at its own time again
+    deferred = []
+    if resumed:
+        runTimestamp = timestamp
+        for run in resumed:
+            regions = resume_run(run, regionConcurrency, coordinator)
+            if regions:
+                deferred.append({'Timestamp': run['Timestamp'], 'Regions': regions})
+        set_run_time(runTimestamp)
+        
+    if execution == 'coordinator':
+        print ('* Coordinating', len(targets) * shardCount, 'shards of', len(targets), 'regions (' + (functionName or 'in this process') + ')')
+        results = coordinator(targets)
+    else:
+        print ('* Processing', len(targets), 'regions with', min(regionConcurrency, len(targets)), 'workers')
+        with ThreadPoolExecutor(max_workers = max(1, regionConcurrency)) as executor:
+            results = dict(zip(names, executor.map(process_region, targets)))
+        
+    # Per-region timing summary
+    print ('* Region timings:')
+    for name in names:
+        status, duration, plan = results[name]
+        phases = instrumentation.region_phases(name)
+        print ('**', name, '%.2fs' % duration, status, '(' + ', '.join('%s %.2fs' % (phase, phases[phase]) for phase in phases) + ')')
+        
+    # Per-account summary
+    if accounts != [None]:
+        print ('* Account summary:')
+        for account in accounts:
+            plans = [results[target_name(account, region_name)] for region_name in AwsRegionNames]
+            failed = sum(1 for status, duration, plan in plans if status != 'OK')
+            started = sum(plan.action_counts()[0] for status, duration, plan in plans)
+            stopped = sum(plan.action_counts()[1] for status, duration, plan in plans)
+            print ('**', account or 'self', len(plans) - failed, 'regions OK,', failed, 'failed,', started, 'started,', stopped, 'stopped')
+        
+    if createForecast == 'Yes':
+        hours = [results[name][2].forecast for name in names]
+        print ('* Forecast:', sum(len(h) for h in hours), 'tagged resources,', '%.1f' % sum(sum(h.values()) for h in hours), 'running hours this month')
+        
+    # Regions deferred by the deadline or an overlapping run are resumed by the next invocation
+    if mode == 'run':
+        regions = [[t.account, t.region_name, results[name][2].deferred] for t, name in zip(targets, names) if results[name][2].deferred]
+        if regions:
+            deferred.append({'Timestamp': timestamp, 'Regions': regions})
+        if deferred or resumed:
+            save_checkpoint(checkpointStore, checkpointConfig, deferred)
+            print ('* Checkpoint:', sum(len(run['Regions']) for run in deferred), 'regions deferred to the next invocation')
             
+    print ('* Created', clientStats['created'], 'clients in %.3fs' % clientStats['seconds'])
+    duration = time.time() - handlerStarted
+    report_run(embeddedMetrics, duration, {'Mode': mode, 'Discovery': 'Full', 'ColdStart': invocations == 1,
+                                           'Status': dict((name, results[name][0]) for name in names)})
+    print ('* EC2 and RDS Scheduler finished in %.2fs (%s start)' % (duration, 'cold' if invocations == 1 else 'warm'))
+    
+    # Index the tag values found, the next run may skip discovery
+    if mode == 'run':
+        tagValues = sorted(scheduleActions)
+        transitionIndex.clear()
+        transitionIndex.update({
+            'Config': config,
+            'TagValues': tagValues,
+            'FullDiscovery': timestamp,
+            'Pending': any(results[name][0] != 'OK' or results[name][2].asgHandoffs or results[name][2].trimmed for name in names),
+            'Metrics': [[target.account, target.region_name] + list(results[name][2].metric_states()) for target, name in zip(targets, names)],
+            'NextTransitions': next_transitions(tagValues, timestamp + fullDiscoveryInterval * 60)
+        })
+        if inventoryStore is not None:
             try:
-                rds = boto3.client('rds', region_name =  region_name)
-                rds_instances = rds.describe_db_instances()
-                
-                print ('*** Populate RDS lists')
-                
-                for rds_instance in rds_instances['DBInstances']:
-                    
-                    # Query RDS instance tags 
-                    response = rds.list_tags_for_resource( ResourceName = rds_instance['DBInstanceArn'])
-                    tags = response['TagList']
-                    
-                    for t in tags:
-                        # Search tag
-                        if t['Key'][:customRDSTagLen] == customRDSTagName:
-                            
-                            # Get instance state
-                            state = rds_instance['DBInstanceStatus']
-                            
-                            # Add instances to correct metricList
-                            if createMetrics == 'Yes':
-                                if state in ['available','starting']:
-                                    metricUpList.append(rds_instance['DBInstanceIdentifier'])
-                                if state in ['stopped','stopping']:
-                                    metricDownList.append(rds_instance['DBInstanceIdentifier'])
-                            
-                            # Get action for instance
-                            action = scheduler_action(tagValue = t['Value'])
-                            
-                            # Check for unsupported instances
-                            if action != "None":
-                                if len(rds_instance['ReadReplicaDBInstanceIdentifiers']):
-                                    print ('**** No action against RDS instance', rds_instance['DBInstanceIdentifier'], '(has read replica)')
-                                    continue
-                                
-                                if 'ReadReplicaSourceDBInstanceIdentifier' in rds_instance.keys():
-                                    print ('**** No action against RDS instance', rds_instance['DBInstanceIdentifier'], '(is replicating)')
-                                    continue
-                                
-                                if rds_instance['MultiAZ']:
-                                    print ('**** No action against RDS instance', rds_instance['DBInstanceIdentifier'], '(is in multiple AZs)')
-                                    continue
-                                
-                                if state not in ['available','stopped']:
-                                    print ('**** No action against RDS instance', rds_instance['DBInstanceIdentifier'], '(is in an unsupported state:',state,')')
-                                    continue
-                            
-                            # Append to start list
-                            if action == 'START' and state == 'stopped':
-                                if rds_instance['DBInstanceIdentifier'] not in rdsStartList:
-                                    rdsStartList.append(rds_instance['DBInstanceIdentifier'])
-                                    print ('****', rds_instance['DBInstanceIdentifier'], 'with tag', t['Value'], 'added to RDS START list')
-                                # Instance Id already in rdsStartList
-                                
-                            # Append to stop list
-                            if action == 'STOP' and state == 'available':
-                                if rds_instance['DBInstanceIdentifier'] not in rdsStopList:
-                                    rdsStopList.append(rds_instance['DBInstanceIdentifier'])
-                                    print ('****', rds_instance['DBInstanceIdentifier'], 'with tag', t['Value'], 'added to RDS STOP list')
-                                # Instance Id already in rdsStopList
-                                
-                print ('*** Execute RDS actions')
-                
-                if rdsStartList or rdsStopList:
-                    # Execute Start and Stop Commands
-                    if rdsStartList:
-                        print ('**** Starting', len(rdsStartList), 'RDS instances:', ', '.join(rdsStartList))
-                        for DBInstanceIdentifier in rdsStartList:
-                            rds.start_db_instance(DBInstanceIdentifier = DBInstanceIdentifier)
-                            if createMetrics == 'Yes':
-                                # Remove instances in rdsStartList from metricDownList
-                                metricDownList = [e for e in metricDownList if e not in rdsStartList]
-                                # Post metrics for instances that were started
-                                putCloudWatchMetric(region_name, DBInstanceIdentifier, 1)
-                            
-                    else:
-                        print ('**** No RDS Instances to Start in region',  region_name)
-                        
-                    if rdsStopList:
-                        print ('**** Stopping', len(rdsStopList) ,'RDS instances:', ', '.join(rdsStopList))
-                        for DBInstanceIdentifier in rdsStopList:
-                            rds.stop_db_instance(DBInstanceIdentifier = DBInstanceIdentifier)
-                            if createMetrics == 'Yes':
-                                # Remove instances in rdsStopList from metricUpList
-                                metricUpList = [e for e in metricUpList if e not in rdsStopList]
-                                # Post metrics for instances that were stopped
-                                putCloudWatchMetric(region_name, DBInstanceIdentifier, 0)
-                            
-                    else:
-                        print ('**** No RDS Instances to Stop in region', region_name)
-                        
-                else:
-                    print ('**** Nothing to do')
-                    
-                # Post metrics for instances that were not stopped or started
-                if createMetrics == 'Yes':
-                    for i in metricUpList:
-                        putCloudWatchMetric(region_name, i, 1)
-                    for i in metricDownList:
-                        putCloudWatchMetric(region_name, i, 0)
-                    
+                inventoryStore.save('index', transitionIndex)
             except Exception as e:
-                print ('** Exception:', e)
-                continue
-            
-    print ('* EC2 and RDS Scheduler finished')
+                print ('* Transition index not stored:', e)
+        
+    # Emit the action plan as one record per region (a log event is limited to 256 KB), the complete plan is returned
+    # to the caller of the function
+    if mode == 'plan':
+        fullPlan = {
+            'Timestamp': datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'Regions': [results[name][2].to_dict() for name in names],
+            'Status': dict((name, results[name][0]) for name in names)
+        }
+        for name, region in zip(names, fullPlan['Regions']):
+            print (json.dumps(dict(region, Timestamp = fullPlan['Timestamp'], Target = name, Status = results[name][0]), sort_keys=True))
+        return fullPlan
     
+# Time spent importing and initializing the module (cold start)
+initDuration = time.time() - initStarted
+
+# Run the handler locally with an event from a JSON file, e.g. a plan against a recorded fleet snapshot
+if __name__ == '__main__':
+    import sys
+    with open(sys.argv[1]) as f:
+        lambda_handler(json.load(f), None)
+
 #EOF
@@ -0,0 +1,154 @@
+######################################################################################################################
+#  Recorded fleet snapshot: a read-only stand-in for the EC2, Autoscaling and RDS clients used by the scheduler      #
+#                                                                                                                    #
+#  A snapshot is a JSON file of the form                                                                             #
+#      {"Regions": {"eu-west-1": {"Instances": [...], "AutoScalingInstances": [...], "AutoScalingGroups": [...],     #
+#                                 "DBInstances": [...], "DBClusters": [...]}}}                                       #
+#  with the items as returned by the describe calls, and optionally the regions of other accounts under              #
+#      "Accounts": {"123456789012": {"Regions": {...}}}                                                              #
+#  Record one with                                                                                                   #
+#      python fleetsnapshot.py eu-west-1,us-east-1 snapshot.json                                                     #
+######################################################################################################################
+
+import fnmatch
+import json
+import sys
+from collections import Counter
+
+# Items per page returned by the snapshot clients
+pageSize = 1000
+
+# API calls answered from snapshots, by (service, operation)
+callCounts = Counter()
+
+# Describe calls answered from a snapshot: operation -> (service, key of the items in the region, key of the items in the response)
+operations = {
+    'describe_instances': ('ec2', 'Instances', 'Reservations'),
+    'describe_auto_scaling_instances': ('autoscaling', 'AutoScalingInstances', 'AutoScalingInstances'),
+    'describe_auto_scaling_groups': ('autoscaling', 'AutoScalingGroups', 'AutoScalingGroups'),
+    'describe_db_instances': ('rds', 'DBInstances', 'DBInstances'),
+    'describe_db_clusters': ('rds', 'DBClusters', 'DBClusters')
+}
+
+# Function to load a snapshot from a file
+def load_snapshot(path):
+    
+    with open(path) as f:
+        return json.load(f)
+
+# Function to check an instance against describe_instances filters
+def matches_filters(instance, filters):
+    
+    for f in filters:
+        if f['Name'] == 'tag-key':
+            keys = [t['Key'] for t in instance.get('Tags', [])]
+            if not any(fnmatch.fnmatchcase(k, v) for k in keys for v in f['Values']):
+                return False
+        elif f['Name'] == 'instance-state-name':
+            if instance['State']['Name'] not in f['Values']:
+                return False
+        elif f['Name'] == 'instance-id':
+            if instance['InstanceId'] not in f['Values']:
+                return False
+        else:
+            raise ValueError('Filter not supported by fleet snapshots: ' + f['Name'])
+    return True
+
+# Paginator over the pages of a snapshot client call
+class SnapshotPaginator(object):
+    
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+    
+    def paginate(self, **kwargs):
+        
+        kwargs.pop('PaginationConfig', None)
+        nextToken = 0
+        while nextToken is not None:
+            page = getattr(self.client, self.operation)(NextToken = nextToken, **kwargs)
+            nextToken = page.get('NextToken')
+            yield page
+
+# Read-only client of a service in a region, answering the describe calls of the scheduler from a snapshot.
+# Any other call (start, stop, tags, metrics, ...) raises an AttributeError, so nothing can be changed by mistake
+class SnapshotClient(object):
+    
+    def __init__(self, service, region_name, snapshot):
+        self.service = service
+        self.region_name = region_name
+        self.snapshot = snapshot
+    
+    def get_paginator(self, operation):
+        return SnapshotPaginator(self, operation)
+    
+    # Function to answer a describe call with one page of the snapshot's items
+    def describe(self, operation, kwargs):
+        
+        (service, itemsKey, responseKey) = operations[operation]
+        callCounts[(service, operation)] += 1
+        items = self.snapshot['Regions'].get(self.region_name, {}).get(itemsKey, [])
+        
+        if operation == 'describe_instances':
+            items = [i for i in items if matches_filters(i, kwargs.get('Filters', []))]
+            if 'InstanceIds' in kwargs:
+                items = [i for i in items if i['InstanceId'] in kwargs['InstanceIds']]
+        elif operation == 'describe_auto_scaling_instances' and 'InstanceIds' in kwargs:
+            items = [i for i in items if i['InstanceId'] in kwargs['InstanceIds']]
+        elif operation == 'describe_auto_scaling_groups' and 'AutoScalingGroupNames' in kwargs:
+            items = [i for i in items if i['AutoScalingGroupName'] in kwargs['AutoScalingGroupNames']]
+        
+        start = int(kwargs.get('NextToken') or 0)
+        page = items[start:start + pageSize]
+        if operation == 'describe_instances':
+            page = [{'Instances': [i]} for i in page]
+        
+        response = {responseKey: page}
+        if start + pageSize < len(items):
+            response['NextToken'] = str(start + pageSize)
+        return response
+    
+    def __getattr__(self, name):
+        
+        if name in operations and operations[name][0] == self.service:
+            return lambda **kwargs: self.describe(name, kwargs)
+        raise AttributeError('%s.%s is not available in a fleet snapshot (read-only)' % (self.service, name))
+    
+    def describe_regions(self, **kwargs):
+        
+        callCounts[('ec2', 'describe_regions')] += 1
+        return {'Regions': [{'RegionName': r} for r in self.snapshot['Regions']]}
+    
+    def list_tags_for_resource(self, ResourceName):
+        
+        callCounts[('rds', 'list_tags_for_resource')] += 1
+        return {'TagList': []}
+
+# Function to record the describe responses of regions into a snapshot, with the default credentials
+def record_snapshot(regions):
+    
+    import boto3
+    
+    snapshot = {'Regions': {}}
+    for region_name in regions:
+        items = {}
+        for operation, (service, itemsKey, responseKey) in sorted(operations.items()):
+            client = boto3.client(service, region_name = region_name)
+            items[itemsKey] = []
+            for page in client.get_paginator(operation).paginate():
+                if operation == 'describe_instances':
+                    for reservation in page['Reservations']:
+                        items[itemsKey].extend(reservation['Instances'])
+                else:
+                    items[itemsKey].extend(page[responseKey])
+        snapshot['Regions'][region_name] = items
+    return snapshot
+
+if __name__ == '__main__':
+    
+    if len(sys.argv) != 3:
+        print ('Usage: python fleetsnapshot.py REGION[,REGION...] SNAPSHOT.json')
+        sys.exit(1)
+    
+    with open(sys.argv[2], 'w') as f:
+        json.dump(record_snapshot(sys.argv[1].split(',')), f, default=str)
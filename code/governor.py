@@ -0,0 +1,273 @@
+######################################################################################################################
+#  API rate governor: every call of a client waits for a token and a concurrency slot of the limiter of its service   #
+#  in its region and account. Rates and concurrency adapt to throttling (AIMD), waiting calls are served by priority: #
+#  start/stop actions before discovery, polling and metrics                                                          #
+######################################################################################################################
+
+import threading
+import time
+from collections import defaultdict
+
+from instrumentation import throttlingErrorCodes
+
+# Priorities of the calls, served in this order
+priorities = ('action', 'discovery', 'polling', 'metrics')
+
+# Priorities of the operations, other operations (describe and list calls) are discovery
+operationPriorities = {
+    'StartInstances': 'action',
+    'StopInstances': 'action',
+    'CreateTags': 'action',
+    'DeleteTags': 'action',
+    'EnterStandby': 'action',
+    'ExitStandby': 'action',
+    'StartDBInstance': 'action',
+    'StopDBInstance': 'action',
+    'StartDBCluster': 'action',
+    'StopDBCluster': 'action',
+    'PutMetricData': 'metrics'
+}
+
+# Seconds a call of a priority waits at most behind calls of higher priorities, then it is served like an action
+maxWaits = {'action': 0.0, 'discovery': 5.0, 'polling': 10.0, 'metrics': 30.0}
+
+# Rate (calls per second) and burst of a service in a region of an account, other services get defaultRate
+serviceRates = {
+    'ec2': (20, 100),
+    'autoscaling': (10, 20),
+    'rds': (5, 10),
+    'cloudwatch': (50, 100)
+}
+defaultRate = (10, 20)
+
+# Concurrent calls of a service in a region of an account, the limit adapts between 1 and maxConcurrency
+maxConcurrency = 16
+
+# Longest wait before the state of a limiter is checked again (seconds)
+maxPoll = 1.0
+
+# Calls per second a successful call adds to the rate of its limiter
+rateIncrease = 0.1
+
+# Throttles within this many seconds of a decrease count as the same congestion and don't decrease rate and limit again
+decreaseInterval = 1.0
+
+# Limiters by (account, service, region), kept by warm containers so the adapted rates carry over to the next run
+limiters = {}
+limitersLock = threading.Lock()
+
+# Priority of the calls made by the current thread (None for the priority of the operation)
+current = threading.local()
+
+# Limiter of the calls of a service in a region: a token bucket (rate calls per second, bursts of up to burst calls) and
+# a concurrency limit. A throttled call halves rate and limit (once per decreaseInterval), a successful call raises the
+# rate by rateIncrease and the limit by one per limit calls. The rate doesn't go below an eighth of the configured
+# rate
+class Limiter(object):
+    
+    def __init__(self, rate, burst):
+        self.maxRate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.limit = float(maxConcurrency)
+        self.inflight = 0
+        self.decreased = 0.0
+        self.waiters = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.reset()
+    
+    # Function to clear the statistics of the limiter
+    def reset(self):
+        
+        self.calls = defaultdict(int)
+        self.waited = defaultdict(float)
+        self.throttles = 0
+    
+    # Function to wait until a call of a priority may be made: there is a token, a free slot and no waiting call before it.
+    # Waiting calls are served by priority and in order, a call waiting longer than maxWaits of its priority goes first
+    def acquire(self, priority):
+        
+        started = time.time()
+        with self.condition:
+            self.sequence += 1
+            waiter = (priorities.index(priority), started + maxWaits[priority], self.sequence)
+            self.waiters.append(waiter)
+            
+            while True:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                first = min(self.waiters, key = lambda w: (0 if w[1] <= now else w[0], w[1], w[2]))
+                if first is waiter and self.inflight < self.limit and self.tokens >= 1:
+                    break
+                
+                # The first call waits for its token or a free slot, the others for their turn or their deadline
+                timeout = maxPoll
+                if first is waiter and self.tokens < 1:
+                    timeout = min(timeout, (1 - self.tokens) / self.rate)
+                elif first is not waiter and waiter[1] > now:
+                    timeout = min(timeout, waiter[1] - now)
+                self.condition.wait(timeout)
+            
+            self.waiters.remove(waiter)
+            self.tokens -= 1
+            self.inflight += 1
+            self.calls[priority] += 1
+            self.waited[priority] += now - started
+            self.condition.notify_all()
+    
+    # Function to end a call, succeeded raises rate and limit
+    def release(self, succeeded):
+        
+        with self.condition:
+            self.inflight -= 1
+            if succeeded:
+                self.rate = min(self.maxRate, self.rate + rateIncrease)
+                self.limit = min(maxConcurrency, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+    
+    # Function to record a throttled attempt of a call
+    def throttled(self):
+        
+        with self.condition:
+            self.throttles += 1
+            now = time.time()
+            if now - self.decreased < decreaseInterval:
+                return
+            self.decreased = now
+            self.rate = max(self.maxRate / 8.0, self.rate / 2.0)
+            self.limit = max(1.0, self.limit / 2.0)
+
+# Function to get the limiter of a service in a region of an account
+def get_limiter(account, service, region_name):
+    
+    key = (account, service, region_name)
+    limiter = limiters.get(key)
+    if limiter is None:
+        with limitersLock:
+            limiter = limiters.get(key)
+            if limiter is None:
+                limiter = Limiter(*serviceRates.get(service, defaultRate))
+                limiters[key] = limiter
+    return limiter
+
+# Context manager running the calls of the current thread with a priority, e.g. polling
+class priority(object):
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def __enter__(self):
+        self.outer = getattr(current, 'priority', None)
+        current.priority = self.name
+        return self
+    
+    def __exit__(self, *args):
+        current.priority = self.outer
+
+# Function to hook the calls of a client of an account (None for the function's own) into the limiter of its service
+# and region. The limiter is acquired before any other handler of the call (e.g. stubs answering it)
+def attach(client, account = None):
+    
+    limiter = get_limiter(account, client.meta.service_model.service_name, client.meta.region_name)
+    
+    def before_call(model, context = None, **kwargs):
+        limiter.acquire(getattr(current, 'priority', None) or operationPriorities.get(model.name, 'discovery'))
+        if context is not None:
+            context['governorAcquired'] = True
+    
+    # Every throttled attempt (retried by botocore) reduces rate and limit
+    def needs_retry(response = None, request_dict = None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in throttlingErrorCodes:
+            limiter.throttled()
+            if request_dict is not None:
+                request_dict['context']['governorThrottled'] = True
+    
+    # Calls answered by a stub have no attempts, their throttling is only seen in the response
+    def after_call(http_response = None, parsed = None, context = None, **kwargs):
+        if context is None or not context.pop('governorAcquired', False):
+            return
+        if (parsed or {}).get('Error', {}).get('Code') in throttlingErrorCodes and not context.get('governorThrottled'):
+            limiter.throttled()
+        limiter.release(http_response is not None and http_response.status_code < 300)
+    
+    def after_call_error(context = None, **kwargs):
+        if context is not None and context.pop('governorAcquired', False):
+            limiter.release(False)
+    
+    events = client.meta.events
+    events.register_first('before-call', before_call)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
+    return client
+
+# Limiters listed one by one in the summary of a run at most, and the seconds their calls must have waited in total to be
+# listed (throttled limiters always are), the others are summed up by service so the EMF record stays small
+maxListedLimiters = 20
+listedWaitThreshold = 1.0
+
+# Function to clear the statistics of all limiters at the start of a run, their rates and limits are kept
+def reset():
+    
+    with limitersLock:
+        for limiter in limiters.values():
+            limiter.reset()
+
+# Function to get the statistics of the run by limiter: calls and seconds waited by priority, throttles, rate and limit
+def stats():
+    
+    with limitersLock:
+        items = list(limiters.items())
+    result = []
+    for (account, service, region_name), limiter in items:
+        with limiter.condition:
+            if not limiter.calls:
+                continue
+            result.append({
+                'Account': account,
+                'Service': service,
+                'Region': region_name,
+                'Calls': dict(limiter.calls),
+                'Waited': dict((name, round(seconds, 4)) for name, seconds in limiter.waited.items()),
+                'Throttles': limiter.throttles,
+                'Rate': round(limiter.rate, 2),
+                'Limit': round(limiter.limit, 2)
+            })
+    return result
+
+# Function to add the statistics of the limiters of another invocation (see stats), e.g. of a worker. Rates and limits
+# stay the ones of the limiters of this process
+def merge(stats):
+    
+    for s in stats:
+        limiter = get_limiter(s['Account'], s['Service'], s['Region'])
+        with limiter.condition:
+            for name, calls in s['Calls'].items():
+                limiter.calls[name] += calls
+            for name, seconds in s['Waited'].items():
+                limiter.waited[name] += seconds
+            limiter.throttles += s['Throttles']
+
+# Function to summarize the statistics of the limiters (see stats) for the EMF record of a run: the limiters that were
+# throttled or waited at least listedWaitThreshold seconds (the maxListedLimiters with the most throttles and waits) one
+# by one, the calls, seconds waited and throttles of the others by service
+def summary(limiters):
+    
+    listed = [l for l in limiters if l['Throttles'] or sum(l['Waited'].values()) >= listedWaitThreshold]
+    listed.sort(key = lambda l: (l['Throttles'], sum(l['Waited'].values())), reverse = True)
+    listed = listed[:maxListedLimiters]
+    
+    services = {}
+    for l in limiters:
+        if any(l is other for other in listed):
+            continue
+        service = services.setdefault(l['Service'], {'Limiters': 0, 'Calls': 0, 'Waited': 0.0, 'Throttles': 0})
+        service['Limiters'] += 1
+        service['Calls'] += sum(l['Calls'].values())
+        service['Waited'] = round(service['Waited'] + sum(l['Waited'].values()), 4)
+        service['Throttles'] += l['Throttles']
+    return {'Limiters': listed, 'Services': services}
@@ -0,0 +1,222 @@
+######################################################################################################################
+#  Instrumentation of a run: API calls counted through the botocore events of the clients and phase durations of    #
+#  every region, emitted as one CloudWatch Embedded Metric Format (EMF) log record per run                           #
+######################################################################################################################
+
+import json
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Error codes of throttled API calls
+throttlingErrorCodes = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', 'Throttled')
+
+# Phases of a region, in the order they are reported
+phases = ('discovery', 'decision', 'asg', 'action', 'metrics')
+
+# API call statistics by (service, operation, region) and phase durations by region and phase of the current run
+apiStats = defaultdict(lambda: {'Calls': 0, 'Attempts': 0, 'Throttles': 0, 'Errors': 0, 'Latency': 0.0, 'MaxLatency': 0.0})
+phaseTimes = defaultdict(lambda: defaultdict(float))
+statsLock = threading.Lock()
+
+# Phase measured by the current thread, to exclude nested phases from its duration
+currentPhase = threading.local()
+
+# Function to clear the statistics at the start of a run
+def reset():
+    
+    with statsLock:
+        apiStats.clear()
+        phaseTimes.clear()
+
+# Function to hook the request lifecycle events of a client, so all its calls are counted
+def attach(client):
+    
+    region_name = client.meta.region_name
+    
+    # Key of the stats from an event name like before-call.ec2.DescribeInstances
+    def key(event_name):
+        (service, operation) = event_name.split('.')[1:3]
+        return (service, operation, region_name)
+    
+    def before_call(event_name, context = None, **kwargs):
+        if context is not None:
+            context['instrumentationStarted'] = time.time()
+    
+    # Every HTTP attempt creates a request, attempts beyond the first of a call are retries
+    def request_created(event_name, **kwargs):
+        with statsLock:
+            apiStats[key(event_name)]['Attempts'] += 1
+    
+    # Every attempt is checked for a retry, throttled attempts are counted here
+    def needs_retry(event_name, response = None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in throttlingErrorCodes:
+            with statsLock:
+                apiStats[key(event_name)]['Throttles'] += 1
+    
+    def after_call(event_name, http_response = None, context = None, **kwargs):
+        done(event_name, context, http_response is None or http_response.status_code >= 300)
+    
+    def after_call_error(event_name, context = None, **kwargs):
+        done(event_name, context, True)
+    
+    def done(event_name, context, failed):
+        latency = 0.0
+        if context is not None and 'instrumentationStarted' in context:
+            latency = time.time() - context.pop('instrumentationStarted')
+        with statsLock:
+            stats = apiStats[key(event_name)]
+            stats['Calls'] += 1
+            stats['Errors'] += failed
+            stats['Latency'] += latency
+            stats['MaxLatency'] = max(stats['MaxLatency'], latency)
+    
+    events = client.meta.events
+    events.register('before-call', before_call)
+    events.register('request-created', request_created)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    events.register('after-call-error', after_call_error)
+    return client
+
+# Function to add the duration of a phase of a region
+def add_phase(region_name, name, seconds):
+    
+    with statsLock:
+        phaseTimes[region_name][name] += seconds
+
+# Phase of a region, measured from its creation to stop() (or as context manager). Nested phases are only counted
+# once, by the innermost phase
+class Phase(object):
+    
+    def __init__(self, region_name, name):
+        self.region_name = region_name
+        self.name = name
+        self.outer = getattr(currentPhase, 'nested', None)
+        self.nested = [0.0]
+        currentPhase.nested = self.nested
+        self.started = time.time()
+    
+    def stop(self):
+        
+        elapsed = time.time() - self.started
+        add_phase(self.region_name, self.name, elapsed - self.nested[0])
+        currentPhase.nested = self.outer
+        if self.outer is not None:
+            self.outer[0] += elapsed
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.stop()
+
+# Function to iterate over a generator and count the time spent in it as phase, e.g. the pages of a describe call
+def timed(iterable, region_name, name):
+    
+    iterator = iter(iterable)
+    while True:
+        with Phase(region_name, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+# Function to get the API statistics of the run as list, retries are the attempts beyond the first of every call
+def api_stats():
+    
+    with statsLock:
+        items = sorted(apiStats.items())
+    
+    stats = []
+    for (service, operation, region_name), s in items:
+        stats.append({
+            'Service': service,
+            'Operation': operation,
+            'Region': region_name,
+            'Calls': s['Calls'],
+            'Retries': max(0, s['Attempts'] - s['Calls']) if s['Attempts'] else 0,
+            'Throttles': s['Throttles'],
+            'Errors': s['Errors'],
+            'AvgLatency': round(s['Latency'] / s['Calls'], 4) if s['Calls'] else 0.0,
+            'MaxLatency': round(s['MaxLatency'], 4)
+        })
+    return stats
+
+# Function to get the API statistics and the phase durations of all regions of the run, e.g. to merge them again after
+# a reset
+def snapshot():
+    
+    with statsLock:
+        names = list(phaseTimes)
+    return api_stats(), dict((name, region_phases(name)) for name in names)
+
+# Function to add the statistics of another invocation (see api_stats and region_phases), e.g. of a worker
+def merge(stats, regionPhases):
+    
+    with statsLock:
+        for s in stats:
+            total = apiStats[(s['Service'], s['Operation'], s['Region'])]
+            total['Calls'] += s['Calls']
+            total['Attempts'] += s['Calls'] + s['Retries']
+            total['Throttles'] += s['Throttles']
+            total['Errors'] += s['Errors']
+            total['Latency'] += s['AvgLatency'] * s['Calls']
+            total['MaxLatency'] = max(total['MaxLatency'], s['MaxLatency'])
+        for region_name, times in regionPhases.items():
+            for name, seconds in times.items():
+                phaseTimes[region_name][name] += seconds
+
+# Function to get the phase durations of a region
+def region_phases(region_name):
+    
+    with statsLock:
+        times = dict(phaseTimes.get(region_name, {}))
+    return dict((name, round(times[name], 4)) for name in phases if name in times)
+
+# Function to get the peak resident memory of the process (the Lambda container) in MB, ru_maxrss is in KB on Linux
+def peak_rss():
+    
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / (1048576.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+# Function to get the EMF record of the run: totals as metrics without dimensions (so they can be graphed), the
+# statistics by API call and the phases by region as properties of the record (so they can be queried in Logs Insights)
+def emf_record(namespace, duration, properties):
+    
+    stats = api_stats()
+    with statsLock:
+        regions = list(phaseTimes)
+    
+    record = {
+        'RunDuration': round(duration, 4),
+        'ApiCalls': sum(s['Calls'] for s in stats),
+        'ApiRetries': sum(s['Retries'] for s in stats),
+        'ApiThrottles': sum(s['Throttles'] for s in stats),
+        'ApiErrors': sum(s['Errors'] for s in stats),
+        'MaxRSS': peak_rss()
+    }
+    metrics = [{'Name': 'RunDuration', 'Unit': 'Seconds'}] + [{'Name': name, 'Unit': 'Count'} for name in ('ApiCalls', 'ApiRetries', 'ApiThrottles', 'ApiErrors')]
+    metrics.append({'Name': 'MaxRSS', 'Unit': 'Megabytes'})
+    
+    for name in phases:
+        metric = name.capitalize() + 'Duration'
+        record[metric] = round(sum(phaseTimes[r].get(name, 0.0) for r in regions), 4)
+        metrics.append({'Name': metric, 'Unit': 'Seconds'})
+    
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [[]], 'Metrics': metrics}]
+    }
+    record['Api'] = stats
+    record['Phases'] = dict((r, region_phases(r)) for r in regions)
+    record.update(properties)
+    return record
+
+# Function to write the EMF record of the run to the log
+def emit(namespace, duration, properties):
+    
+    print (json.dumps(emf_record(namespace, duration, properties), sort_keys=True))
@@ -0,0 +1,303 @@
+######################################################################################################################
+#  Inventory store: what the scheduler keeps between runs, i.e. the resources of every region (tag value, state,    #
+#  fingerprint and last action) and the transition index of the last full discovery                                  #
+#                                                                                                                    #
+#  Documents are stored as JSON in a local directory (file:///tmp/ec2rds-scheduler) or in a DynamoDB table           #
+#  (dynamodb://TableName, partition key Name of type String), compressed and split into items below the size limit  #
+#  or, without a store, in the memory of the container (kept by warm containers only). Leases keep concurrent runs    #
+#  from processing the same region                                                                                   #
+######################################################################################################################
+
+import json
+import os
+import threading
+import time
+import zlib
+
+# Seconds after which remembered tags of resources that weren't seen again are dropped
+tagRecordMaxAge = 86400
+
+# Bytes per DynamoDB item of a document (the item size limit is 400 KB)
+dynamodbPartSize = 350 * 1024
+
+# Function to open the store of a URL, get_client(service) returns the boto3 client of a service
+def open_store(url, get_client):
+    
+    if url.startswith('file://'):
+        return FileStore(url[len('file://'):])
+    if url.startswith('dynamodb://'):
+        return DynamoDBStore(get_client('dynamodb'), url[len('dynamodb://'):])
+    raise ValueError('Unsupported inventory store: ' + url)
+
+# Function to check if a lease (document with Owner and Expires) may be taken by owner
+def lease_free(lease, owner, now):
+    
+    return lease is None or lease.get('Owner') == owner or lease.get('Expires', 0) < now
+
+# Function to get the fingerprint of the values deciding the action of a resource
+def fingerprint(*values):
+    
+    return '%08x' % zlib.crc32(json.dumps(values, sort_keys=True, default=str).encode())
+
+# Store keeping every document in a JSON file of a directory
+class FileStore(object):
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def path(self, name):
+        return os.path.join(self.directory, name + '.json')
+    
+    def load(self, name):
+        
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    # Documents are replaced atomically, a reader never sees half a document
+    def save(self, name, document):
+        
+        temp = self.path(name) + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(document, f, separators=(',', ':'))
+        os.replace(temp, self.path(name))
+    
+    # Leases are kept as generations, files name.1.lease, name.2.lease, ... The highest generation holds the lease, a run
+    # takes (or gives back) a lease by linking a complete file as the next generation, which fails if another run did first
+    def lease_path(self, name, generation):
+        return os.path.join(self.directory, '%s.%d.lease' % (name, generation))
+    
+    # Function to get the generations of the lease name, oldest first
+    def lease_generations(self, name):
+        
+        prefix = name + '.'
+        generations = []
+        for entry in os.listdir(self.directory):
+            if entry.startswith(prefix) and entry.endswith('.lease') and entry[len(prefix):-len('.lease')].isdigit():
+                generations.append(int(entry[len(prefix):-len('.lease')]))
+        return sorted(generations)
+    
+    # Function to get the highest generation of the lease name and its lease (0 and None without any). Raises
+    # FileNotFoundError if a newer generation replaced it meanwhile
+    def current_lease(self, name):
+        
+        generations = self.lease_generations(name)
+        if not generations:
+            return 0, None
+        with open(self.lease_path(name, generations[-1])) as f:
+            return generations[-1], json.load(f)
+    
+    # Function to write lease as generation of the lease name, returns False if another run wrote it first
+    def write_lease(self, name, generation, lease):
+        
+        temp = '%s.%d.%d.tmp' % (self.path(name), os.getpid(), threading.get_ident())
+        with open(temp, 'w') as f:
+            json.dump(lease, f)
+        try:
+            os.link(temp, self.lease_path(name, generation))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp)
+    
+    # Function to write lease as the generation after the current one of the lease name if the current one is free for
+    # owner. Returns False if it isn't, or if another run wrote a generation meanwhile. The generations before the new
+    # one are removed
+    def replace_lease(self, name, owner, lease):
+        
+        try:
+            generation, current = self.current_lease(name)
+        except FileNotFoundError:
+            return False
+        if not lease_free(current, owner, time.time()) or not self.write_lease(name, generation + 1, lease):
+            return False
+        
+        # A run that listed the generations before an older one was removed may have written into the gap, the highest
+        # generation wins
+        generations = self.lease_generations(name)
+        if generations[-1] != generation + 1:
+            return False
+        for older in generations[:-1]:
+            try:
+                os.remove(self.lease_path(name, older))
+            except FileNotFoundError:
+                pass
+        return True
+    
+    # Function to take the lease name for owner until expires (timestamp), returns False if another owner holds it
+    def acquire_lease(self, name, owner, expires):
+        
+        return self.replace_lease(name, owner, {'Owner': owner, 'Expires': expires})
+    
+    # Function to give up the lease name of owner, the next generation is an expired lease
+    def release_lease(self, name, owner):
+        
+        try:
+            generation, current = self.current_lease(name)
+        except FileNotFoundError:
+            return
+        if (current or {}).get('Owner') == owner:
+            self.replace_lease(name, owner, {'Owner': owner, 'Expires': 0})
+
+# Store keeping every document in the memory of the container, kept by warm containers only
+class MemoryStore(object):
+    
+    def __init__(self):
+        self.documents = {}
+        self.lock = threading.Lock()
+    
+    def load(self, name):
+        
+        document = self.documents.get(name)
+        return None if document is None else json.loads(document)
+    
+    # Documents are kept serialized, a reader never shares the objects of the writer
+    def save(self, name, document):
+        
+        self.documents[name] = json.dumps(document, separators=(',', ':'))
+    
+    def acquire_lease(self, name, owner, expires):
+        
+        with self.lock:
+            if not lease_free(self.load(name), owner, time.time()):
+                return False
+            self.save(name, {'Owner': owner, 'Expires': expires})
+            return True
+    
+    def release_lease(self, name, owner):
+        
+        with self.lock:
+            if (self.load(name) or {}).get('Owner') == owner:
+                del self.documents[name]
+
+# Store keeping every document in items of a DynamoDB table: the item Name holds the first part and the number of parts,
+# the items Name#1, Name#2, ... the others. All parts carry the version of the document, mixed versions are ignored
+class DynamoDBStore(object):
+    
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+    
+    def get(self, key):
+        return self.client.get_item(TableName=self.table, Key={'Name': {'S': key}}, ConsistentRead=True).get('Item')
+    
+    def load(self, name):
+        
+        head = self.get(name)
+        if head is None:
+            return None
+        
+        version = head['Version']['S']
+        data = head['Data']['B']
+        for n in range(1, int(head['Parts']['N'])):
+            part = self.get('%s#%d' % (name, n))
+            if part is None or part['Version']['S'] != version:
+                return None
+            data += part['Data']['B']
+        return json.loads(zlib.decompress(data).decode())
+    
+    # The other parts are written before the head, so the head only refers to complete versions
+    def save(self, name, document):
+        
+        data = zlib.compress(json.dumps(document, separators=(',', ':')).encode())
+        parts = [data[n:n + dynamodbPartSize] for n in range(0, len(data), dynamodbPartSize)]
+        version = '%.6f' % time.time()
+        
+        for n in range(1, len(parts)):
+            self.client.put_item(TableName=self.table, Item={'Name': {'S': '%s#%d' % (name, n)}, 'Version': {'S': version}, 'Data': {'B': parts[n]}})
+        self.client.put_item(TableName=self.table, Item={'Name': {'S': name}, 'Version': {'S': version}, 'Parts': {'N': str(len(parts))}, 'Data': {'B': parts[0]}})
+    
+    # Function to write the lease item of name if condition holds, returns False if it doesn't. Attributes are referred
+    # to by #name, #owner and #expires (Name and Owner are reserved words)
+    def put_lease(self, name, owner, expires, condition, values):
+        
+        names = dict((key, attribute) for key, attribute in (('#name', 'Name'), ('#owner', 'Owner'), ('#expires', 'Expires')) if key in condition)
+        try:
+            self.client.put_item(TableName=self.table, Item={'Name': {'S': name}, 'Owner': {'S': owner}, 'Expires': {'N': '%.3f' % expires}},
+                                 ConditionExpression=condition, ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+            return True
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False
+            raise
+    
+    # Function to take the lease name for owner until expires (timestamp) with a conditional write, returns False if another
+    # owner holds it
+    def acquire_lease(self, name, owner, expires):
+        
+        return self.put_lease(name, owner, expires, 'attribute_not_exists(#name) OR #owner = :owner OR #expires < :now',
+                              {':owner': {'S': owner}, ':now': {'N': '%.3f' % time.time()}})
+    
+    # Function to give up the lease name of owner, by letting it expire (only PutItem is needed)
+    def release_lease(self, name, owner):
+        
+        self.put_lease(name, owner, 0, '#owner = :owner', {':owner': {'S': owner}})
+
+# Inventory of a region for a run: the records of the previous run and the ones of this run.
+#   Resources: resource -> {'Tags': tag values, 'State': state, 'Fingerprint': fingerprint, 'Action': last action, 'Window': run window of the action}
+#   Tags: ARN -> {'Tag': [key, value] of the scheduler tag or None, 'Seen': timestamp}, for resources whose tags had to be listed
+class RegionInventory(object):
+    
+    def __init__(self, document, window, now):
+        document = document or {}
+        self.previous = document.get('Resources', {})
+        self.resources = {}
+        self.tags = document.get('Tags', {})
+        self.window = window
+        self.now = now
+        self.changed = 0
+    
+    # Function to record a resource seen in this run with its tag values, returns True if it is new or changed since the
+    # previous run
+    def see(self, resource, tagValues, state, fingerprint):
+        
+        previous = self.previous.get(resource, {})
+        self.resources[resource] = {
+            'Tags': list(tagValues),
+            'State': state,
+            'Fingerprint': fingerprint,
+            'Action': previous.get('Action'),
+            'Window': previous.get('Window')
+        }
+        changed = previous.get('Fingerprint') != fingerprint
+        self.changed += changed
+        return changed
+    
+    # Function to check if the action of a resource was already issued by an earlier run of the same window
+    def issued(self, resource, action):
+        
+        previous = self.previous.get(resource, {})
+        return previous.get('Action') == action and previous.get('Window') == self.window
+    
+    # Function to record the actions issued in this run
+    def issue(self, resources, action):
+        
+        for resource in resources:
+            record = self.resources.setdefault(resource, {'Tags': [], 'State': None, 'Fingerprint': None})
+            record['Action'] = action
+            record['Window'] = self.window
+    
+    # Function to get the scheduler tag of a resource as TagList, if it was listed less than maxAge seconds ago
+    def tag_list(self, arn, maxAge):
+        
+        record = self.tags.get(arn)
+        if record is None or record['Seen'] < self.now - maxAge:
+            return None
+        return [{'Key': record['Tag'][0], 'Value': record['Tag'][1]}] if record['Tag'] else []
+    
+    # Function to remember the scheduler tag of a resource whose tags were listed
+    def remember_tag(self, arn, tagList, tagName):
+        
+        tag = [[t['Key'], t['Value']] for t in tagList if t['Key'][:len(tagName)] == tagName]
+        self.tags[arn] = {'Tag': tag[0] if tag else None, 'Seen': self.now}
+    
+    # Function to get the document to store, resources that weren't seen (e.g. phase failed) are kept if keepUnseen
+    def document(self, keepUnseen = False):
+        
+        resources = dict(self.previous, **self.resources) if keepUnseen else self.resources
+        tags = dict((arn, record) for arn, record in self.tags.items() if record['Seen'] >= self.now - tagRecordMaxAge)
+        return {'Resources': resources, 'Tags': tags}
@@ -0,0 +1,121 @@
+######################################################################################################################
+#  Log of the regions: the output of a region is buffered and written in one block when the region is done, as text   #
+#  lines or as one JSON record per phase of the region. Detail lines about single resources are counted by kind and   #
+#  only written for a sample of the resources                                                                        #
+######################################################################################################################
+
+import json
+import sys
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+
+# Output format (text, json), verbosity (summary: no detail lines, detail: sampled detail lines) and the share of the
+# resources whose detail lines are written, set by configure() for a run
+logFormat = 'text'
+logVerbosity = 'detail'
+logSampleRate = 1.0
+
+# Buckets of the sampling, a resource is in the sample if the hash of its ID falls into the first logSampleRate of them
+sampleBuckets = 10000
+
+# Blocks of regions processed concurrently are written one after another
+writeLock = threading.Lock()
+
+# Function to set format, verbosity and sample rate of the log of a run
+def configure(format = 'text', verbosity = 'detail', sampleRate = 1.0):
+    
+    global logFormat, logVerbosity, logSampleRate
+    
+    if format not in ('text', 'json'):
+        raise ValueError('Invalid log format: ' + format)
+    if verbosity not in ('summary', 'detail'):
+        raise ValueError('Invalid log verbosity: ' + verbosity)
+    logFormat = format
+    logVerbosity = verbosity
+    logSampleRate = min(1.0, max(0.0, float(sampleRate)))
+
+# Function to check if the detail lines of a resource are written. The hash of the ID keeps the same resources in the
+# sample from run to run, so the lines of a resource can be followed over several runs
+def sampled(resource):
+    
+    if logVerbosity != 'detail':
+        return False
+    if logSampleRate >= 1.0:
+        return True
+    return zlib.crc32(resource.encode()) % sampleBuckets < logSampleRate * sampleBuckets
+
+# Function to write a block of lines to stdout in one write
+def write(lines):
+    
+    if not lines:
+        return
+    with writeLock:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+# Buffered log of a region (target). Lines go to the record of the current phase (region, ec2, rds), which also counts
+# the detail lines by kind (e.g. Start, AlreadyStopped). The IDs are in the lines of the actions (e.g. Starting 12
+# instances: ...), only the detail lines of the resources in the sample are kept
+class RegionLog(object):
+    
+    def __init__(self, target):
+        self.target = target
+        self.lines = []
+        self.records = OrderedDict()
+        self.phase('region')
+    
+    # Function to start a phase of the region, lines and details go to its record from now on
+    def phase(self, name):
+        
+        if name not in self.records:
+            self.records[name] = {'Lines': [], 'Counts': defaultdict(int), 'Logged': 0}
+        self.current = self.records[name]
+    
+    # Function to add a line
+    def write(self, line):
+        
+        if logFormat == 'text':
+            self.lines.append(line)
+        else:
+            self.current['Lines'].append(line)
+    
+    # Function to add a detail line about a resource (the args of log), written only if the resource is in the sample
+    def detail(self, kind, resource, args):
+        
+        record = self.current
+        record['Counts'][kind] += 1
+        if sampled(resource):
+            record['Logged'] += 1
+            self.write(' '.join(str(a) for a in args))
+    
+    # Function to get the lines of the log: the text lines followed by the counts of phases with detail lines that weren't
+    # written, or one JSON record per phase (fields adds e.g. the status of the region to the record of the region phase)
+    def output(self, **fields):
+        
+        if logFormat == 'text':
+            lines = list(self.lines)
+            for name, record in self.records.items():
+                total = sum(record['Counts'].values())
+                if record['Logged'] < total:
+                    lines.append('*** %s: %d of %d detail lines written (%s)' % (name, record['Logged'], total,
+                                 ', '.join('%d %s' % (n, kind) for kind, n in record['Counts'].items())))
+            return lines
+        
+        lines = []
+        for name, record in self.records.items():
+            if not (record['Lines'] or record['Counts'] or name == 'region'):
+                continue
+            entry = OrderedDict([('Target', self.target), ('Phase', name)])
+            if name == 'region':
+                entry.update(sorted(fields.items()))
+            entry['Counts'] = record['Counts']
+            entry['Logged'] = record['Logged']
+            entry['Lines'] = record['Lines']
+            lines.append(json.dumps(entry))
+        return lines
+    
+    # Function to write the log of the region in one block
+    def flush(self, **fields):
+        
+        write(self.output(**fields))
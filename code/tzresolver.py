@@ -0,0 +1,89 @@
+######################################################################################################################
+#  Time zone resolver: time zone names are resolved on first use and cached by name, with the tz database of pytz   #
+#  (bundled with the function) or of the standard library module zoneinfo (Python 3.9+)                              #
+######################################################################################################################
+
+# Backends in the order tried by 'auto'
+backends = ('pytz', 'zoneinfo')
+
+# Backend in use, chosen by select() or on first use
+backend = None
+
+# Files of the system tz database that aren't time zone names (pytz doesn't have them either)
+nonZoneNames = frozenset(('Factory', 'localtime', 'posixrules'))
+nonZonePrefixes = ('posix/', 'right/', '/', '.')
+
+# Resolved time zones by name, None for names that aren't valid time zones
+zones = {}
+
+# Time zone names of the database by their lower case, loaded on the first lookup ignoring case
+caseNames = {}
+
+# Function to choose the backend ('auto' takes the first importable one), the cache is cleared if it changes
+def select(name = 'auto'):
+    
+    global backend
+    
+    candidates = backends if name == 'auto' else (name,)
+    for candidate in candidates:
+        if candidate == backend:
+            return backend
+        try:
+            __import__(candidate)
+        except ImportError:
+            continue
+        backend = candidate
+        zones.clear()
+        caseNames.clear()
+        return backend
+    raise ValueError('No time zone backend available: ' + name)
+
+# Function to load a time zone with the backend, None if the name is unknown. Names are case sensitive
+def load(name):
+    
+    # pytz.timezone also accepts case variants, only the names of the database count
+    if backend == 'pytz':
+        import pytz
+        return pytz.timezone(name) if name in pytz.all_timezones_set else None
+    
+    import zoneinfo
+    
+    # Keys are paths of the database, paths outside of it and case variants (on case-insensitive file systems) are no zones
+    if not name or name in nonZoneNames or name.startswith(nonZonePrefixes) or '..' in name.split('/'):
+        return None
+    try:
+        zone = zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError, OSError):
+        return None
+    return zone if str(zone) == name else None
+
+# Function to get the time zone of a name (utc is UTC as well), None if the name is unknown
+def get(name):
+    
+    if name in zones:
+        return zones[name]
+    
+    if backend is None:
+        select()
+    zone = load('UTC' if name == 'utc' else name)
+    zones[name] = zone
+    return zone
+
+# Function to get the time zone of a name ignoring its case (e.g. europe/zurich, like pytz.timezone), None if the name
+# is unknown
+def get_ignoring_case(name):
+    
+    zone = get(name)
+    if zone is not None:
+        return zone
+    
+    if not caseNames:
+        if backend == 'pytz':
+            import pytz
+            names = pytz.all_timezones
+        else:
+            import zoneinfo
+            names = zoneinfo.available_timezones()
+        caseNames.update((n.lower(), n) for n in names)
+    canonical = caseNames.get(name.lower())
+    return get(canonical) if canonical is not None else None